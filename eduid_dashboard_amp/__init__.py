@@ -1,8 +1,31 @@
+import bson
+import copy
+import hashlib
+import heapq
+import random
+import pymongo
+from collections import namedtuple
+from itertools import islice
+from bson import json_util
+from bson.son import SON
 from datetime import datetime
-from eduid_userdb.dashboard import DashboardUserDB
+from eduid_userdb import UserDB
+from eduid_userdb.dashboard import DashboardUser, DashboardUserDB
+from eduid_userdb.exceptions import EduIDUserDBError, UserDoesNotExist, UserHasUnknownData
 from eduid_userdb.util import UTC
 from celery.utils.log import get_task_logger
 
+from eduid_dashboard_amp import db, raw
+from eduid_dashboard_amp.arrays import array_operations
+from eduid_dashboard_amp.breaker import CircuitBreaker, CircuitOpen, OPEN
+from eduid_dashboard_amp.cache import LRUCache, MongoFingerprintStore
+from eduid_dashboard_amp.coalesce import Coalescer
+from eduid_dashboard_amp.lanes import BULK, BULK_CONCURRENCY, BULK_POOL_OPTIONS, INTERACTIVE, Lane
+from eduid_dashboard_amp.log import EventLogger
+from eduid_dashboard_amp.metrics import Metrics, StatsdSink, clock
+from eduid_dashboard_amp.profiling import Profiler
+from eduid_dashboard_amp.shards import make_router
+
 logger = get_task_logger(__name__)
 
 WHITELIST_SET_ATTRS = (
@@ -13,7 +36,7 @@ WHITELIST_SET_ATTRS = (
     'preferredLanguage',
     'mail',
 
-    # TODO: Arrays must use put or pop, not set, but need more deep refacts
+    # Arrays are set in full, see attribute_fetcher_arrays() for updating them element by element
     'norEduPersonNIN',  # Old format
     'nins',  # New format
     'eduPersonEntitlement',
@@ -36,14 +59,101 @@ WHITELIST_UNSET_ATTRS = (
     'sn',  # Old format
 )
 
+# Rule for one attribute in a compiled filter plan, see compile_filter_plan()
+AttributeRule = namedtuple('AttributeRule', ['attr', 'unset', 'transform'])
+
+# Result of apply_operations(): user ids written, and {user_id: exception} for the failed ones
+BulkResult = namedtuple('BulkResult', ['synced', 'failed'])
+
+# Result of attribute_fetcher_arrays(): ordered operations, and the full update dict to fall back to
+ArrayUpdate = namedtuple('ArrayUpdate', ['user_id', 'operations', 'attributes'])
+
+# Top level keys accepted by eduid_userdb when parsing a user. Anything else
+# in a dashboard document makes the User constructor raise UserHasUnknownData.
+KNOWN_ATTRS = frozenset((
+    '_id',
+    'eduPersonPrincipalName',
+    'subject',
+    'givenName',
+    'surname',
+    'sn',
+    'displayName',
+    'preferredLanguage',
+    'mail',
+    'mailAliases',
+    'phone',
+    'mobile',
+    'nins',
+    'norEduPersonNIN',
+    'eduPersonEntitlement',
+    'passwords',
+    'tou',
+    'terminated',
+    'modified_ts',
+    'letter_proofing_data',
+    'locked_identity',
+    'orcid',
+    'profiles',
+    'revoked_ts',
+    # obsolete attributes, silently dropped by eduid_userdb
+    'postalAddress',
+    'date',
+    'csrf',
+))
+
+# Fields that affect the update dict: the whitelisted attributes, the old
+# format attributes they are converted from and the attributes eduid_userdb
+# needs to validate the user.
+FINGERPRINT_ATTRS = frozenset(WHITELIST_SET_ATTRS + WHITELIST_UNSET_ATTRS + (
+    '_id',
+    'eduPersonPrincipalName',
+    'revoked_ts',
+))
+
+# Fields read from the dashboard userdb in projection mode, also modified_ts
+# for reading changed users in order and checking that a user is fresh.
+PROJECTION_ATTRS = FINGERPRINT_ATTRS | frozenset(('modified_ts',))
+
+# Name of the computed field holding unknown top level keys in projection mode
+UNKNOWN_ATTRS_FIELD = '_unknown_attrs'
+
+# Number of user ids resolved per $in query in attribute_fetcher_many()
+BATCH_SIZE = 1000
+
+# Default location of the central eduid user database
+CENTRAL_DB_NAME = 'eduid_am'
+CENTRAL_COLLECTION = 'attributes'
+
+# Collection in the dashboard database where attribute_fetcher_cached() keeps the fingerprints
+FINGERPRINT_COLLECTION = 'dashboard_amp_fingerprints'
+
+# Number of user fingerprints kept in memory by attribute_fetcher_cached(), without a fingerprint collection
+FINGERPRINT_CACHE_SIZE = 10000
+
+# Seconds and number of user ids to remember as missing from the dashboard userdb
+NEGATIVE_CACHE_TTL = 10
+NEGATIVE_CACHE_SIZE = 10000
+
+# pymongo errors meaning that a read did not finish in time. WaitQueueTimeoutError
+# only exists in pymongo >= 4.2, older versions raise a plain ConnectionFailure.
+TIMEOUT_ERRORS = tuple(error for error in (
+    pymongo.errors.ExecutionTimeout,
+    pymongo.errors.NetworkTimeout,
+    pymongo.errors.ServerSelectionTimeoutError,
+    getattr(pymongo.errors, 'WaitQueueTimeoutError', None),
+) if error is not None)
+
+# Fraction of the documents whose size is measured for the document_bytes metric
+DOCUMENT_BYTES_SAMPLE_RATE = 0.01
 
-def value_filter(attr, value):
-    if value:
-        # Check it we need to filter values for this attribute
-        #if attr == 'norEduPersonNIN':
-        #   value = filter_nin(value)
-        pass
-    return value
+# Consecutive connection failures that open the circuit breaker, and seconds before trying again
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 5.0
+
+# Indexes on the dashboard userdb, created by ensure_indexes()
+DASHBOARD_INDEXES = {
+    'modified_ts-idx': {'key': [('modified_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]},
+}
 
 
 def filter_nin(value):
@@ -61,13 +171,235 @@ def filter_nin(value):
     return result
 
 
+# Functions applied to non-empty values of an attribute before it is set in
+# the central userdb, compiled into the filter plan by compile_filter_plan()
+VALUE_TRANSFORMS = {
+    # 'norEduPersonNIN': filter_nin,
+}
+
+
+class AttributeFetcherTimeout(Exception):
+    """
+    Reading from the Dashboard private userdb did not finish before the deadline.
+
+    The read can be retried (preferably with a backoff).
+    """
+    pass
+
+
 class DashboardAMPContext(object):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.dashboard_userdb = DashboardUserDB(db_uri)
+    def __init__(self, db_uri, projection_reads=False,
+                 central_db_name=CENTRAL_DB_NAME, central_collection=CENTRAL_COLLECTION,
+                 fingerprint_cache_size=FINGERPRINT_CACHE_SIZE, fingerprint_collection=FINGERPRINT_COLLECTION,
+                 pool_options=None, filter_plan=None, coalesce_window=0.0, raw_fast_path=False,
+                 negative_cache_ttl=NEGATIVE_CACHE_TTL, negative_cache_size=NEGATIVE_CACHE_SIZE,
+                 metrics=None, log_sample_rate=1.0, profiler=None, lanes=None, read_preference=None,
+                 shard_uris=None, router=None, deadline_ms=None,
+                 breaker_threshold=BREAKER_THRESHOLD, breaker_reset_timeout=BREAKER_RESET_TIMEOUT,
+                 dashboard_db_name=None, document_bytes_sample_rate=DOCUMENT_BYTES_SAMPLE_RATE):
+        self.projection_reads = projection_reads
+        self.document_bytes_sample_rate = document_bytes_sample_rate
+        # None for the database name that eduid_userdb uses for the dashboard userdb
+        self.dashboard_db_name = dashboard_db_name
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        # One circuit breaker per dashboard userdb and lane, shared by all views of this context
+        self._breakers = {}
+        self.deadline_ms = deadline_ms
+        # The client's server selection timeout follows the deadline of the context, not of views with another one
+        self._client_deadline_ms = deadline_ms
+        self.shard_uris = shard_uris or []
+        self.router = router
+        self.shard = None
+        self.read_preference = read_preference
+        self.lanes = lanes or {
+            INTERACTIVE: Lane(INTERACTIVE),
+            BULK: Lane(BULK, concurrency=BULK_CONCURRENCY, pool_options=BULK_POOL_OPTIONS),
+        }
+        self.lane = self.lanes[INTERACTIVE]
+        self.profiler = profiler
+        self.metrics = metrics or Metrics()
+        self.log = EventLogger(logger, log_sample_rate)
+        self.missing_users = LRUCache(negative_cache_size, ttl=negative_cache_ttl)
+        self.raw_fast_path = raw_fast_path
+        self.coalescer = Coalescer(coalesce_window)
+        self.filter_plan = filter_plan or compile_filter_plan()
+        self.pool_options = pool_options or {}
+        self._db_uri = db_uri
+        self._central_db_name = central_db_name
+        self._central_collection = central_collection
+        self._central_userdb = None
+        # A fingerprint store per process is only safe with a single worker, see attribute_fetcher_cached()
+        if fingerprint_collection:
+            self.fingerprints = MongoFingerprintStore(
+                lambda: self.dashboard_userdb._coll.database[fingerprint_collection])
+        else:
+            self.fingerprints = LRUCache(fingerprint_cache_size)
+
+    def for_lane(self, name):
+        """
+        A view of this context that does its database work in another lane.
+
+        Everything except the lane, e.g. caches and metrics, is shared with
+        this context.
+
+        :param name: Lane name, e.g. eduid_dashboard_amp.lanes.BULK
+
+        :type name: str
+
+        :rtype: DashboardAMPContext
+        """
+        if self.lane.name == name:
+            return self
+        other = copy.copy(self)
+        other.lane = self.lanes[name]
+        return other
+
+    def with_deadline(self, deadline_ms):
+        """
+        A view of this context with another deadline for reads.
+
+        The server selection timeout of the clients is not changed, so waiting
+        for a server is still limited by the deadline of the context.
+
+        :param deadline_ms: Milliseconds a read may take, None for no limit
+
+        :type deadline_ms: int | None
+
+        :rtype: DashboardAMPContext
+        """
+        if self.deadline_ms == deadline_ms:
+            return self
+        other = copy.copy(self)
+        other.deadline_ms = deadline_ms
+        return other
+
+    def for_shard(self, index):
+        """
+        A view of this context that reads from one of the dashboard userdb shards.
+
+        Everything except the dashboard userdb, e.g. the central userdb, caches
+        and metrics, is shared with this context.
+
+        :param index: Shard index, see router
+
+        :type index: int
+
+        :rtype: DashboardAMPContext
+        """
+        if self.shard == index:
+            return self
+        other = copy.copy(self)
+        other.shard = index
+        return other
+
+    @property
+    def shards(self):
+        """
+        Views of this context for all the dashboard userdb shards, or just this context if not sharded.
+
+        :rtype: list of DashboardAMPContext
+        """
+        if not self.shard_uris or self.shard is not None:
+            return [self]
+        return [self.for_shard(index) for index in range(len(self.shard_uris))]
+
+    @property
+    def dashboard_uri(self):
+        """
+        Connection string of the dashboard userdb of this context (or shard view).
+
+        :rtype: str | unicode
+        """
+        if self.shard is not None:
+            return self.shard_uris[self.shard]
+        return self._db_uri
+
+    @property
+    def breaker(self):
+        """
+        The circuit breaker of this context's dashboard userdb and lane.
+
+        The lanes have connection pools of their own, so e.g. timeouts in a
+        saturated bulk lane must not make the interactive reads fail fast.
+
+        :rtype: eduid_dashboard_amp.breaker.CircuitBreaker
+        """
+        name = 'dashboard' if self.shard is None else 'shard{}'.format(self.shard)
+        lane = self.lane.name
+        breaker = self._breakers.get((name, lane))
+        if breaker is None:
+            breaker = self._breakers.setdefault((name, lane), CircuitBreaker(
+                name, self.breaker_threshold, self.breaker_reset_timeout,
+                on_change=lambda changed: self._breaker_changed(changed, lane)))
+            self.metrics.gauge('circuit_open', 0, circuit=name, lane=lane)
+        return breaker
+
+    def _breaker_changed(self, breaker, lane):
+        self.metrics.gauge('circuit_open', 1 if breaker.state == OPEN else 0, circuit=breaker.name, lane=lane)
+        self.metrics.incr('circuit_changes_total', circuit=breaker.name, lane=lane, state=breaker.state)
+        logger.warning('Circuit breaker {!r} of the {!s} lane is now {!s}'.format(breaker.name, lane, breaker.state))
+
+    @property
+    def db_options(self):
+        """
+        Connection pool options of the database clients in this context's lane.
+
+        :rtype: dict
+        """
+        options = dict(self.pool_options)
+        options.update(self.lane.pool_options)
+        return options
+
+    @property
+    def dashboard_db_options(self):
+        """
+        Connection pool options of the dashboard userdb clients in this context's lane.
+
+        Unless set explicitly, interactive clients get a server selection
+        timeout of the deadline. There is no socket timeout, which would also
+        cut short the scans and writes made with the same client: reads of
+        users by id are limited by their maxTimeMS instead.
+
+        :rtype: dict
+        """
+        options = self.db_options
+        if self._client_deadline_ms and self.lane.name == INTERACTIVE:
+            options.setdefault('serverSelectionTimeoutMS', self._client_deadline_ms)
+        return options
+
+    @property
+    def dashboard_userdb(self):
+        """
+        The Dashboard private userdb, with a client shared by all contexts in this process.
+
+        In a sharded context, this is the database at MONGO_URI, where e.g.
+        checkpoints are kept. The users are read from the shards.
+
+        :rtype: DashboardUserDB
+        """
+        args = (self.dashboard_db_name,) if self.dashboard_db_name else ()
+        return db.get_userdb(self.dashboard_uri, DashboardUserDB, args=args, options=self.dashboard_db_options)
+
+    @property
+    def central_userdb(self):
+        """
+        The central eduid user database, only opened when needed (e.g. in delta mode).
+
+        :rtype: UserDB
+        """
+        if self._central_userdb is not None:
+            return self._central_userdb
+        return db.get_userdb(self._db_uri, UserDB, args=(self._central_db_name, self._central_collection),
+                             options=self.db_options)
+
+    @central_userdb.setter
+    def central_userdb(self, userdb):
+        self._central_userdb = userdb
 
 
 def plugin_init(am_conf):
@@ -77,52 +409,1055 @@ def plugin_init(am_conf):
     Whatever is returned by this function will get passed to attribute_fetcher() as
     the `context' argument.
 
+    Optional settings in am_conf:
+
+      DASHBOARD_AMP_PROJECTION_READS: Only read the fields needed to build the
+        update dict from the dashboard userdb (default False).
+      DASHBOARD_AMP_CENTRAL_DB_NAME: Database of the central userdb, used in
+        delta mode (default 'eduid_am').
+      DASHBOARD_AMP_CENTRAL_COLLECTION: Collection of the central userdb
+        (default 'attributes').
+      DASHBOARD_AMP_FINGERPRINT_COLLECTION: Collection in the dashboard
+        database where attribute_fetcher_cached() keeps the fingerprints,
+        shared by all workers (default 'dashboard_amp_fingerprints'). Set it
+        to None to keep them in memory in every worker process instead, which
+        is only safe with a single worker.
+      DASHBOARD_AMP_FINGERPRINT_CACHE_SIZE: Number of user fingerprints kept in
+        memory without a fingerprint collection (default 10000).
+      DASHBOARD_AMP_MAX_POOL_SIZE, DASHBOARD_AMP_MIN_POOL_SIZE,
+      DASHBOARD_AMP_MAX_IDLE_TIME_MS, DASHBOARD_AMP_CONNECT_TIMEOUT_MS,
+      DASHBOARD_AMP_SOCKET_TIMEOUT_MS, DASHBOARD_AMP_SERVER_SELECTION_TIMEOUT_MS,
+      DASHBOARD_AMP_WAIT_QUEUE_TIMEOUT_MS: Connection pool settings.
+      DASHBOARD_AMP_INTERACTIVE_CONCURRENCY: Maximum number of concurrent
+        reads in the interactive lane, used by attribute_fetcher() (default
+        no limit).
+      DASHBOARD_AMP_BULK_CONCURRENCY: Maximum number of concurrent reads in
+        the bulk lane, used by attribute_fetcher_many(), attribute_fetcher_bulk()
+        and the resync (default 2).
+      DASHBOARD_AMP_READ_PREFERENCE: Read users from secondaries, e.g.
+        'secondaryPreferred' (default: read from the primary). Only reads
+        whose caller says how fresh the user must be go to a secondary, and
+        a user that is not found, or older than that, is read again from the
+        primary, see attribute_fetcher().
+      DASHBOARD_AMP_MAX_STALENESS_SECONDS: Only read from secondaries lagging
+        at most this many seconds (minimum 90).
+      DASHBOARD_AMP_DEADLINE_MS: Milliseconds a read of users by id may take,
+        as a server side maxTimeMS. Reads that time out raise
+        AttributeFetcherTimeout (default no limit). Unless set explicitly, the
+        server selection timeout of the interactive dashboard userdb clients
+        is set to the deadline, which also limits how long scans, e.g. in
+        attribute_fetcher_since(), and writes wait for a server. Once started,
+        scans and writes are not limited.
+      DASHBOARD_AMP_BREAKER_THRESHOLD: Consecutive connection failures after
+        which reads fail at once with CircuitOpen, 0 to disable (default 5).
+      DASHBOARD_AMP_BREAKER_RESET_TIMEOUT: Seconds before a trial read is let
+        through after the circuit opened (default 5).
+      DASHBOARD_AMP_SHARD_URIS: List of connection strings of dashboard
+        userdb shards. Users are read from the shard the router picks, and
+        batch and full reads fan out to all shards (default: read users
+        from MONGO_URI).
+      DASHBOARD_AMP_SHARD_ROUTER: 'hash' (default) to route users by a hash
+        of their id, or 'range' to route by ObjectId ranges.
+      DASHBOARD_AMP_SHARD_BOUNDARIES: For the range router, the lowest
+        ObjectId of every shard but the first, in increasing order.
+      DASHBOARD_AMP_BULK_MAX_POOL_SIZE etc.: Connection pool settings of the
+        bulk lane, which always has clients of its own (default
+        maxPoolSize 4, other settings as for the interactive lane).
+      DASHBOARD_AMP_COALESCE_WINDOW: Seconds attribute_fetcher_coalesced() waits
+        for more requests for the same user before fetching it (default 0).
+      DASHBOARD_AMP_RAW_FAST_PATH: Convert known document shapes directly,
+        without creating a DashboardUser (default False).
+      DASHBOARD_AMP_NEGATIVE_CACHE_TTL: Seconds to remember that a user id is
+        missing from the dashboard userdb, 0 to disable (default 10).
+      DASHBOARD_AMP_NEGATIVE_CACHE_SIZE: Maximum number of missing user ids to
+        remember (default 10000).
+      DASHBOARD_AMP_STATSD_HOST, DASHBOARD_AMP_STATSD_PORT,
+      DASHBOARD_AMP_STATSD_PREFIX: Also send the metrics to this statsd server
+        (default port 8125, prefix 'eduid_dashboard_amp').
+      DASHBOARD_AMP_DOCUMENT_BYTES_SAMPLE_RATE: Fraction of the documents
+        whose encoded size is reported as document_bytes (default 0.01).
+        In projection mode, this is the size of the projected document.
+      DASHBOARD_AMP_LOG_SAMPLE_RATE: Fraction of the debug events in the fetch
+        path to log when debug logging is enabled (default 1.0).
+      DASHBOARD_AMP_PROFILE_DIR: Profile a sample of the attribute_fetcher()
+        calls and write the profiles to this directory, see
+        eduid_dashboard_amp.profiling.
+      DASHBOARD_AMP_PROFILE_RATE: Fraction of the calls to profile (default 0.01).
+      DASHBOARD_AMP_PROFILE_MODE: 'cprofile' (default) or 'tracemalloc'.
+      DASHBOARD_AMP_PROFILE_INTERVAL: Seconds between writing profiles
+        (default 3600).
+      DASHBOARD_AMP_PROFILE_KEEP: Number of profile files to keep (default 48).
+
+    The metrics are always kept in the context's in-process registry,
+    context.metrics.registry, which can be rendered for Prometheus with
+    its prometheus_text() method. More sinks can be added with
+    context.metrics.add_sink().
+
+    The database clients are shared by all contexts with the same MONGO_URI
+    and pool settings in a process, and are created lazily after a fork.
+
     :am_conf: Attribute Manager configuration data.
 
     :type am_conf: dict
 
     :rtype: DashboardAMPContext
     """
-    return DashboardAMPContext(am_conf['MONGO_URI'])
+    start = clock()
+    sinks = []
+    if am_conf.get('DASHBOARD_AMP_STATSD_HOST'):
+        sinks.append(StatsdSink(am_conf['DASHBOARD_AMP_STATSD_HOST'],
+                                am_conf.get('DASHBOARD_AMP_STATSD_PORT', 8125),
+                                am_conf.get('DASHBOARD_AMP_STATSD_PREFIX', 'eduid_dashboard_amp')))
+    profiler = None
+    if am_conf.get('DASHBOARD_AMP_PROFILE_DIR'):
+        profiler = Profiler(am_conf['DASHBOARD_AMP_PROFILE_DIR'],
+                            sample_rate=am_conf.get('DASHBOARD_AMP_PROFILE_RATE', 0.01),
+                            mode=am_conf.get('DASHBOARD_AMP_PROFILE_MODE', 'cprofile'),
+                            interval=am_conf.get('DASHBOARD_AMP_PROFILE_INTERVAL', 3600),
+                            keep=am_conf.get('DASHBOARD_AMP_PROFILE_KEEP', 48))
+    bulk_pool_options = dict(BULK_POOL_OPTIONS)
+    bulk_pool_options.update(db.pool_options(am_conf, lane=BULK))
+    lanes = {
+        INTERACTIVE: Lane(INTERACTIVE, concurrency=am_conf.get('DASHBOARD_AMP_INTERACTIVE_CONCURRENCY')),
+        BULK: Lane(BULK, concurrency=am_conf.get('DASHBOARD_AMP_BULK_CONCURRENCY', BULK_CONCURRENCY),
+                   pool_options=bulk_pool_options),
+    }
+    read_pref = None
+    if am_conf.get('DASHBOARD_AMP_READ_PREFERENCE', 'primary') != 'primary':
+        read_pref = db.read_preference(am_conf['DASHBOARD_AMP_READ_PREFERENCE'],
+                                       am_conf.get('DASHBOARD_AMP_MAX_STALENESS_SECONDS'))
+    shard_uris = am_conf.get('DASHBOARD_AMP_SHARD_URIS') or []
+    router = make_router(am_conf, len(shard_uris)) if shard_uris else None
+    deadline_ms = am_conf.get('DASHBOARD_AMP_DEADLINE_MS')
+    pool_options = db.pool_options(am_conf)
+    context = DashboardAMPContext(am_conf['MONGO_URI'],
+                                  projection_reads=am_conf.get('DASHBOARD_AMP_PROJECTION_READS', False),
+                                  central_db_name=am_conf.get('DASHBOARD_AMP_CENTRAL_DB_NAME', CENTRAL_DB_NAME),
+                                  central_collection=am_conf.get('DASHBOARD_AMP_CENTRAL_COLLECTION',
+                                                                 CENTRAL_COLLECTION),
+                                  fingerprint_cache_size=am_conf.get('DASHBOARD_AMP_FINGERPRINT_CACHE_SIZE',
+                                                                     FINGERPRINT_CACHE_SIZE),
+                                  fingerprint_collection=am_conf.get('DASHBOARD_AMP_FINGERPRINT_COLLECTION',
+                                                                     FINGERPRINT_COLLECTION),
+                                  pool_options=pool_options,
+                                  filter_plan=compile_filter_plan(),
+                                  coalesce_window=am_conf.get('DASHBOARD_AMP_COALESCE_WINDOW', 0.0),
+                                  raw_fast_path=am_conf.get('DASHBOARD_AMP_RAW_FAST_PATH', False),
+                                  negative_cache_ttl=am_conf.get('DASHBOARD_AMP_NEGATIVE_CACHE_TTL',
+                                                                 NEGATIVE_CACHE_TTL),
+                                  negative_cache_size=am_conf.get('DASHBOARD_AMP_NEGATIVE_CACHE_SIZE',
+                                                                  NEGATIVE_CACHE_SIZE),
+                                  metrics=Metrics(sinks),
+                                  log_sample_rate=am_conf.get('DASHBOARD_AMP_LOG_SAMPLE_RATE', 1.0),
+                                  document_bytes_sample_rate=am_conf.get('DASHBOARD_AMP_DOCUMENT_BYTES_SAMPLE_RATE',
+                                                                         DOCUMENT_BYTES_SAMPLE_RATE),
+                                  profiler=profiler,
+                                  lanes=lanes,
+                                  read_preference=read_pref,
+                                  shard_uris=shard_uris,
+                                  router=router,
+                                  deadline_ms=deadline_ms,
+                                  breaker_threshold=am_conf.get('DASHBOARD_AMP_BREAKER_THRESHOLD', BREAKER_THRESHOLD),
+                                  breaker_reset_timeout=am_conf.get('DASHBOARD_AMP_BREAKER_RESET_TIMEOUT',
+                                                                    BREAKER_RESET_TIMEOUT),
+                                  )
+    context.metrics.incr('plugin_init_total')
+    context.metrics.observe('plugin_init_seconds', clock() - start)
+    return context
 
 
-def attribute_fetcher(context, user_id):
+def ensure_indexes(context):
+    """
+    Create the DASHBOARD_INDEXES that are missing in the dashboard userdb.
+
+    This is an administrative step, see eduid_dashboard_amp.indexes, and is
+    not done by plugin_init(). Failing to create an index is logged, but not
+    fatal, since the plugin works without them (only slower).
+
+    :param context: Plugin context, see plugin_init above.
+
+    :type context: DashboardAMPContext
+
+    :return: True if all indexes exist
+    :rtype: bool
+    """
+    collection = context.dashboard_userdb._coll
+    try:
+        existing = collection.index_information()
+        for name, params in DASHBOARD_INDEXES.items():
+            if name in existing:
+                if existing[name]['key'] != params['key']:
+                    logger.warning('Index {!r} on {!s} has key {!r}, expected {!r}'.format(
+                        name, collection.full_name, existing[name]['key'], params['key']))
+                continue
+            logger.info('Creating index {!r} on {!s}'.format(name, collection.full_name))
+            collection.create_index(params['key'], name=name, background=True)
+    except pymongo.errors.PyMongoError as exc:
+        logger.error('Could not verify the indexes on {!s}: {!s}'.format(collection.full_name, exc))
+        return False
+    return True
+
+
+def attribute_fetcher(context, user_id, min_modified_ts=None, causal_token=None, deadline_ms=None):
     """
     Read a user from the Dashboard private userdb and return an update
     dict to let the Attribute Manager update the use in the central
     eduid user database.
 
+    When the context reads from secondaries, the user is only read from one
+    if the caller passes either the modified_ts the user was saved with, or a
+    causal consistency token from the session it was saved in (see
+    eduid_dashboard_amp.db.causal_token). Without either, nothing says how
+    stale a secondary may be, so the user is read from the primary. A user
+    read from a secondary that is missing or older than min_modified_ts is
+    read again from the primary.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+    :param min_modified_ts: The user must have been modified at or after this time
+    :param causal_token: The read must see the writes of this token's session
+    :param deadline_ms: Milliseconds the read may take, instead of the context's deadline
+
+    :type context: DashboardAMPContext
+    :type user_id: ObjectId
+    :type min_modified_ts: datetime | None
+    :type causal_token: dict | None
+    :type deadline_ms: int | None
+
+    :return: update dict
+    :rtype: dict
+
+    :raises AttributeFetcherTimeout: if the read did not finish before the deadline
+    :raises CircuitOpen: if the dashboard userdb is down, see eduid_dashboard_amp.breaker
+    """
+    if deadline_ms is not None:
+        context = context.with_deadline(deadline_ms)
+    if context.profiler is not None:
+        return context.profiler.call(_fetch_one, context, user_id, min_modified_ts, causal_token)
+    return _fetch_one(context, user_id, min_modified_ts, causal_token)
+
+
+def attribute_fetcher_bulk(context, user_id):
+    """
+    Version of attribute_fetcher() for bulk work, e.g. resyncs.
+
+    The user is read in the bulk lane, so that bulk work does not take
+    connections or concurrency from interactive syncs.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+
+    :type context: DashboardAMPContext
+    :type user_id: ObjectId
+
+    :return: update dict
+    :rtype: dict
+    """
+    return attribute_fetcher(context.for_lane(BULK), user_id)
+
+
+def _fetch_one(context, user_id, min_modified_ts=None, causal_token=None):
+    start = clock()
+    for _user_id, attributes in _fetch_batch(context, [user_id], True, min_modified_ts, causal_token):
+        context.metrics.observe('attribute_fetcher_seconds', clock() - start)
+        return attributes
+
+
+def attribute_fetcher_coalesced(context, user_id):
+    """
+    Coalescing version of attribute_fetcher().
+
+    Concurrent requests for the same user, arriving within the context's
+    coalesce window, share one fetch and get the same update dict.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+
+    :type context: DashboardAMPContext
+    :type user_id: ObjectId
+
+    :return: update dict
+    :rtype: dict
+    """
+    return context.coalescer.call(str(user_id), attribute_fetcher, context, user_id)
+
+
+def attribute_fetcher_delta(context, user_id):
+    """
+    Delta mode version of attribute_fetcher().
+
+    The update dict is compared with the user's current document in the
+    central eduid user database, and only the attributes that would actually
+    change are returned. If nothing has changed, an empty dict is returned and
+    the caller should not issue any update at all.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+
+    :type context: DashboardAMPContext
+    :type user_id: ObjectId
+
+    :return: update dict, possibly empty
+    :rtype: dict
+    """
+    attributes = attribute_fetcher(context, user_id)
+    if not isinstance(user_id, bson.ObjectId):
+        user_id = bson.ObjectId(user_id)
+    central_doc = context.central_userdb._coll.find_one({'_id': user_id}, PROJECTION_ATTRS)
+    delta = attributes_delta(attributes, central_doc)
+    context.log.debug('delta', user_id=user_id, changed=delta, attributes=attributes)
+    return delta
+
+
+def attributes_delta(attributes, central_doc):
+    """
+    Remove the operations in an update dict that would not change central_doc.
+
+    :param attributes: update dict, as returned by attribute_fetcher()
+    :param central_doc: the user's document in the central userdb, or None
+
+    :type attributes: dict
+    :type central_doc: dict | None
+
+    :return: update dict with only the changed attributes, possibly empty
+    :rtype: dict
+    """
+    if central_doc is None:
+        return attributes
+
+    delta = {}
+    attributes_set = dict((attr, value) for attr, value in attributes.get('$set', {}).items()
+                          if attr not in central_doc or central_doc[attr] != value)
+    if attributes_set:
+        delta['$set'] = attributes_set
+    attributes_unset = dict((attr, value) for attr, value in attributes.get('$unset', {}).items()
+                            if attr in central_doc)
+    if attributes_unset:
+        delta['$unset'] = attributes_unset
+    return delta
+
+
+def attribute_fetcher_arrays(context, user_id):
+    """
+    Array diff mode version of attribute_fetcher().
+
+    The array attributes are compared with the user's current document in the
+    central eduid user database, element by element, and updated with
+    $pull, positional $set and $push operations instead of being set in full,
+    see eduid_dashboard_amp.arrays. Apply the result with apply_array_update().
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+
+    :type context: DashboardAMPContext
+    :type user_id: ObjectId
+
+    :rtype: ArrayUpdate
+    """
+    attributes = attribute_fetcher(context, user_id)
+    if not isinstance(user_id, bson.ObjectId):
+        user_id = bson.ObjectId(user_id)
+    central_doc = context.central_userdb._coll.find_one({'_id': user_id}, PROJECTION_ATTRS)
+    operations = array_operations(user_id, attributes, central_doc)
+    context.metrics.observe('array_operations', len(operations))
+    context.log.debug('arrays', user_id=user_id, operations=len(operations), attributes=attributes)
+    return ArrayUpdate(user_id, operations, attributes)
+
+
+def apply_array_update(collection, update):
+    """
+    Write an ArrayUpdate to the central userdb with an ordered bulk write.
+
+    If an operation finds an array other than the one it was computed from,
+    because the user was changed in the meantime, the full update dict is
+    applied instead.
+
+    :param collection: The central userdb collection
+    :param update: as returned by attribute_fetcher_arrays()
+
+    :type collection: pymongo.collection.Collection
+    :type update: ArrayUpdate
+
+    :return: False if the full update dict had to be applied
+    :rtype: bool
+    """
+    if not update.operations:
+        return True
+    result = collection.bulk_write(update.operations, ordered=True)
+    if result.matched_count + result.upserted_count == len(update.operations):
+        return True
+    logger.info('User {!s} changed in {!s} during the array update, setting the arrays in full'.format(
+        update.user_id, collection.full_name))
+    collection.bulk_write([update_operation(update.user_id, update.attributes)])
+    return False
+
+
+def attribute_fetcher_cached(context, user_id):
+    """
+    Fingerprinting version of attribute_fetcher().
+
+    A hash of the whitelisted fields of the user's dashboard document is kept
+    for every user id that an update dict was returned for. If the fields
+    hash to the same value on the next call, the conversion is skipped and an
+    empty dict is returned to say that nothing has changed since the last sync.
+
+    A caller that fails to apply a returned update dict should call
+    forget_fingerprint(), or the next call would wrongly report no change.
+
+    The fingerprints must be shared by all workers, which they are when kept
+    in the fingerprint collection (the default). With fingerprints kept in
+    memory in every worker, a user whose document goes back to a state that
+    one worker synced, after another worker synced a later state, would
+    wrongly be reported as unchanged by the first worker.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+
+    :type context: DashboardAMPContext
+    :type user_id: ObjectId
+
+    :return: update dict, or an empty dict if nothing has changed
+    :rtype: dict
+    """
+    if not isinstance(user_id, bson.ObjectId):
+        user_id = bson.ObjectId(user_id)
+    if context.shard_uris and context.shard is None:
+        context = context.for_shard(context.router.shard(user_id))
+    doc = _guarded_read(context, [user_id]).get(user_id)
+    if doc is None:
+        raise UserDoesNotExist('No user with _id {!r} in {!s}'.format(user_id, context.dashboard_userdb))
+
+    unknown = doc.get(UNKNOWN_ATTRS_FIELD)
+    if unknown is None:
+        unknown = set(doc.keys()) - KNOWN_ATTRS
+    if unknown:
+        raise UserHasUnknownData('User {!s} has unknown data: {!r}'.format(user_id, unknown))
+
+    fingerprint = document_fingerprint(doc)
+    if context.fingerprints.get(user_id) == fingerprint:
+        context.log.debug('unchanged', user_id=user_id)
+        return {}
+
+    attributes = _document_to_attributes(context, doc)
+    context.fingerprints.set(user_id, fingerprint)
+    return attributes
+
+
+def forget_fingerprint(context, user_id):
+    """
+    Make the next attribute_fetcher_cached() call for user_id return a full update.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+
+    :type context: DashboardAMPContext
+    :type user_id: ObjectId
+    """
+    if not isinstance(user_id, bson.ObjectId):
+        user_id = bson.ObjectId(user_id)
+    context.fingerprints.delete(user_id)
+
+
+def document_fingerprint(doc):
+    """
+    Stable hash of the fields of a dashboard document that affect the update dict.
+
+    :param doc: Dashboard userdb document
+
+    :type doc: dict
+
+    :rtype: str
+    """
+    fields = dict((attr, value) for attr, value in doc.items() if attr in FINGERPRINT_ATTRS)
+    return hashlib.sha256(json_util.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def attribute_fetcher_many(context, user_ids, batch_size=BATCH_SIZE, raise_on_error=True, lane=BULK,
+                           min_modified_ts=None, causal_token=None):
+    """
+    Batch version of attribute_fetcher().
+
+    The users are loaded from the Dashboard private userdb with one $in query
+    per batch of `batch_size' user ids, instead of one query per user. The
+    update dicts are yielded in the same order as the user ids were given.
+
+    A user id that can't be found results in UserDoesNotExist, a user with
+    unknown data in UserHasUnknownData and other users that eduid_userdb
+    rejects (e.g. revoked users) in other eduid_userdb exceptions, just like
+    for attribute_fetcher().
+    With raise_on_error=False, the exception is yielded in place of the update
+    dict instead of being raised, so that one bad user does not stop the batch.
+
+    The users are read in the bulk lane, unless another lane is given.
+    min_modified_ts and causal_token apply to all the users, see attribute_fetcher().
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_ids: Unique identifiers
+    :param batch_size: Maximum number of user ids per database query
+    :param raise_on_error: Raise exceptions instead of yielding them
+    :param lane: Lane to do the reads in, see eduid_dashboard_amp.lanes
+    :param min_modified_ts: The users must have been modified at or after this time
+    :param causal_token: The reads must see the writes of this token's session
+
+    :type context: DashboardAMPContext
+    :type user_ids: iterable of ObjectId
+    :type batch_size: int
+    :type raise_on_error: bool
+    :type lane: str
+    :type min_modified_ts: datetime | None
+    :type causal_token: dict | None
+
+    :return: (user_id, update dict) tuples
+    :rtype: generator
+    """
+    context = context.for_lane(lane)
+    batch = []
+    for user_id in user_ids:
+        batch.append(user_id)
+        if len(batch) >= batch_size:
+            for result in _fetch_batch(context, batch, raise_on_error, min_modified_ts, causal_token):
+                yield result
+            batch = []
+    if batch:
+        for result in _fetch_batch(context, batch, raise_on_error, min_modified_ts, causal_token):
+            yield result
+
+
+def attribute_fetcher_since(context, since_ts, raise_on_error=True):
+    """
+    Get update dicts for all users modified since a timestamp.
+
+    Iterate over the returned object to get (user_id, update dict) tuples, in
+    modified_ts order. Its `watermark' attribute is the modified_ts of the
+    last user returned so far, to use as since_ts for the next call. Users
+    modified at exactly since_ts are returned again, since more users might
+    have been saved with that timestamp after the previous call.
+
+    The scan uses the modified_ts index, see ensure_indexes().
+
+    Errors are handled like in attribute_fetcher_many().
+
+    :param context: Plugin context, see plugin_init above.
+    :param since_ts: Timestamp, or None for all users with a modified_ts
+    :param raise_on_error: Raise exceptions instead of yielding them
+
+    :type context: DashboardAMPContext
+    :type since_ts: datetime | None
+    :type raise_on_error: bool
+
+    :rtype: ChangedSince
+    """
+    return ChangedSince(context, since_ts, raise_on_error)
+
+
+class ChangedSince(object):
+    """
+    Iterator over the update dicts of users modified since a timestamp, see attribute_fetcher_since().
+    """
+
+    def __init__(self, context, since_ts, raise_on_error=True):
+        self.context = context
+        self.since_ts = since_ts
+        self.watermark = since_ts
+        self.raise_on_error = raise_on_error
+
+    def __repr__(self):
+        return '<{} since={!s} watermark={!s}>'.format(self.__class__.__name__, self.since_ts, self.watermark)
+
+    def __iter__(self):
+        if self.since_ts is None:
+            spec = {'modified_ts': {'$exists': True}}
+        else:
+            spec = {'modified_ts': {'$gte': self.since_ts}}
+        sort = [('modified_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+        for doc in _find_documents(self.context, spec, sort=sort):
+            modified_ts = doc['modified_ts']
+            try:
+                result = _document_to_attributes(self.context, doc)
+            except EduIDUserDBError as exc:
+                if self.raise_on_error:
+                    raise
+                result = exc
+            self.watermark = modified_ts
+            yield doc['_id'], result
+
+
+def update_operation(user_id, attributes):
+    """
+    Bulk write operation applying an update dict to a user in the central userdb.
+
+    :param user_id: Unique identifier
+    :param attributes: update dict, as returned by attribute_fetcher()
+
+    :type user_id: ObjectId
+    :type attributes: dict
+
+    :rtype: pymongo.UpdateOne
+    """
+    if not isinstance(user_id, bson.ObjectId):
+        user_id = bson.ObjectId(user_id)
+    return pymongo.UpdateOne({'_id': user_id}, attributes, upsert=True)
+
+
+def attribute_fetcher_operation(context, user_id):
+    """
+    Bulk write version of attribute_fetcher().
+
     :param context: Plugin context, see plugin_init above.
     :param user_id: Unique identifier
 
     :type context: DashboardAMPContext
     :type user_id: ObjectId
 
+    :return: operation to pass to bulk_write() on the central userdb
+    :rtype: pymongo.UpdateOne
+    """
+    return update_operation(user_id, attribute_fetcher(context, user_id))
+
+
+def attribute_fetcher_operations(context, user_ids, batch_size=BATCH_SIZE):
+    """
+    Bulk write version of attribute_fetcher_many().
+
+    Users that can't be synced get the exception instead of an operation,
+    like attribute_fetcher_many() with raise_on_error=False. Pass the result
+    to apply_operations() to write it all to the central userdb.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_ids: Unique identifiers
+    :param batch_size: Maximum number of user ids per database query
+
+    :type context: DashboardAMPContext
+    :type user_ids: iterable of ObjectId
+    :type batch_size: int
+
+    :return: (user_id, UpdateOne or exception) tuples
+    :rtype: generator
+    """
+    for user_id, result in attribute_fetcher_many(context, user_ids, batch_size, raise_on_error=False):
+        if isinstance(result, Exception):
+            yield user_id, result
+        else:
+            yield user_id, update_operation(user_id, result)
+
+
+def apply_operations(collection, operations, batch_size=BATCH_SIZE):
+    """
+    Write operations to the central userdb with unordered bulk writes.
+
+    A failing write does not stop the others, and is reported for the user
+    it belongs to, as are the exceptions from attribute_fetcher_operations().
+
+    :param collection: The central userdb collection
+    :param operations: (user_id, UpdateOne or exception) tuples
+    :param batch_size: Maximum number of operations per bulk write
+
+    :type collection: pymongo.collection.Collection
+    :type operations: iterable of tuple
+    :type batch_size: int
+
+    :rtype: BulkResult
+    """
+    result = BulkResult([], {})
+    batch = []
+    for user_id, operation in operations:
+        if isinstance(operation, Exception):
+            result.failed[user_id] = operation
+            continue
+        batch.append((user_id, operation))
+        if len(batch) >= batch_size:
+            _bulk_write(collection, batch, result)
+            batch = []
+    if batch:
+        _bulk_write(collection, batch, result)
+    return result
+
+
+def _bulk_write(collection, batch, result):
+    failed = {}
+    try:
+        collection.bulk_write([operation for _user_id, operation in batch], ordered=False)
+    except pymongo.errors.BulkWriteError as exc:
+        for error in exc.details.get('writeErrors', []):
+            failed[error['index']] = pymongo.errors.WriteError(error.get('errmsg'), error.get('code'), error)
+    for index, (user_id, _operation) in enumerate(batch):
+        if index in failed:
+            result.failed[user_id] = failed[index]
+        else:
+            result.synced.append(user_id)
+
+
+def _is_missing(context, user_id):
+    """
+    Check if a user id was recently found to be missing from the dashboard userdb.
+    """
+    return bool(context.missing_users.ttl) and context.missing_users.get(str(user_id), False)
+
+
+def _set_missing(context, user_id):
+    if context.missing_users.ttl:
+        context.missing_users.set(str(user_id), True)
+
+
+def _fetch_batch(context, user_ids, raise_on_error, min_modified_ts=None, causal_token=None):
+    """
+    Load one batch of users with a single query and yield their update dicts.
+    """
+    if context.shard_uris and context.shard is None:
+        for result in _fetch_sharded(context, user_ids, raise_on_error, min_modified_ts, causal_token):
+            yield result
+        return
+
+    object_ids = {}
+    cached_missing = set()
+    # A caller asking for a fresh user may just have created it
+    fresh = min_modified_ts is not None or causal_token is not None
+    for user_id in user_ids:
+        if not fresh and _is_missing(context, user_id):
+            cached_missing.add(user_id)
+            continue
+        try:
+            object_ids[user_id] = user_id if isinstance(user_id, bson.ObjectId) else bson.ObjectId(user_id)
+        except (bson.errors.InvalidId, TypeError):
+            pass
+
+    userdb = context.dashboard_userdb
+    docs = {}
+    if object_ids:
+        docs = _guarded_read(context, set(object_ids.values()), min_modified_ts, causal_token)
+
+    for user_id in user_ids:
+        try:
+            if user_id in cached_missing:
+                raise UserDoesNotExist('No user with _id {!r} in {!s} (cached)'.format(user_id, userdb))
+            doc = docs.get(object_ids.get(user_id))
+            if doc is None:
+                _set_missing(context, user_id)
+                raise UserDoesNotExist('No user with _id {!r} in {!s}'.format(user_id, userdb))
+            result = _document_to_attributes(context, doc)
+        except EduIDUserDBError as exc:
+            # e.g. a missing user, unknown data or a revoked user
+            context.metrics.incr('errors_total', type=exc.__class__.__name__)
+            if raise_on_error:
+                raise
+            result = exc
+        yield user_id, result
+
+
+def _fetch_sharded(context, user_ids, raise_on_error, min_modified_ts=None, causal_token=None):
+    """
+    Load one batch of users with one query per shard, and yield their update dicts in order.
+    """
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(context.router.shard(user_id), []).append(user_id)
+    results = {}
+    for index, shard_user_ids in sorted(by_shard.items()):
+        for user_id, result in _fetch_batch(context.for_shard(index), shard_user_ids, False,
+                                            min_modified_ts, causal_token):
+            results[user_id] = result
+    for user_id in user_ids:
+        result = results[user_id]
+        if raise_on_error and isinstance(result, Exception):
+            raise result
+        yield user_id, result
+
+
+def _guarded_read(context, object_ids, min_modified_ts=None, causal_token=None):
+    """
+    _read_documents() behind the circuit breaker and the lane, within the deadline.
+
+    :raises CircuitOpen: if the circuit breaker is open
+    :raises AttributeFetcherTimeout: if the read did not finish before the deadline
+
+    :return: {_id: document}
+    :rtype: dict
+    """
+    userdb = context.dashboard_userdb
+    context.log.debug('fetch', users=len(object_ids), userdb=userdb)
+    try:
+        with context.breaker.guard(), context.lane.slot(), \
+                context.metrics.timer('fetch_seconds', lane=context.lane.name):
+            return _read_documents(context, object_ids, min_modified_ts, causal_token)
+    except CircuitOpen:
+        context.metrics.incr('errors_total', type=CircuitOpen.__name__)
+        raise
+    except TIMEOUT_ERRORS as exc:
+        context.metrics.incr('errors_total', type=AttributeFetcherTimeout.__name__)
+        raise AttributeFetcherTimeout('Reading {} users from {!s} timed out ({!s}): {!s}'.format(
+            len(object_ids), userdb, exc.__class__.__name__, exc))
+    except pymongo.errors.PyMongoError as exc:
+        context.metrics.incr('errors_total', type=exc.__class__.__name__)
+        raise
+
+
+def _read_documents(context, object_ids, min_modified_ts=None, causal_token=None):
+    """
+    Read users by _id, from a secondary if the context says so, falling back to the primary for stale users.
+
+    Only reads with a min_modified_ts or causal_token to check the secondary's
+    data against go to a secondary, the others are made on the primary.
+
+    :return: {_id: document}
+    :rtype: dict
+    """
+    spec = {'_id': {'$in': list(object_ids)}}
+    deadline_ms = context.deadline_ms
+    if context.read_preference is None or (min_modified_ts is None and causal_token is None):
+        return dict((doc['_id'], doc) for doc in _find_documents(context, spec, max_time_ms=deadline_ms))
+
+    if causal_token is None:
+        docs = dict((doc['_id'], doc) for doc in _find_documents(context, spec, secondary=True,
+                                                                 max_time_ms=deadline_ms))
+    else:
+        client = context.dashboard_userdb._coll.database.client
+        with client.start_session(causal_consistency=True) as session:
+            # Standalone servers have no cluster time
+            if causal_token.get('cluster_time') is not None:
+                session.advance_cluster_time(causal_token['cluster_time'])
+            if causal_token.get('operation_time') is not None:
+                session.advance_operation_time(causal_token['operation_time'])
+            docs = dict((doc['_id'], doc) for doc in _find_documents(context, spec, secondary=True,
+                                                                     session=session, max_time_ms=deadline_ms))
+
+    stale = [_id for _id in object_ids if _id not in docs or
+             (min_modified_ts is not None and
+              (docs[_id].get('modified_ts') is None or docs[_id]['modified_ts'] < min_modified_ts))]
+    if stale:
+        context.metrics.incr('primary_fallbacks_total', len(stale))
+        context.log.debug('primary_fallback', users=len(stale))
+        for doc in _find_documents(context, {'_id': {'$in': stale}}, max_time_ms=deadline_ms):
+            docs[doc['_id']] = doc
+    return docs
+
+
+def _find_documents(context, spec, sort=None, limit=None, secondary=False, session=None, max_time_ms=None):
+    """
+    Find documents in the Dashboard private userdb.
+
+    In projection mode, only PROJECTION_ATTRS are transferred from the database.
+    The names of any top level keys not in KNOWN_ATTRS are returned in the
+    UNKNOWN_ATTRS_FIELD of each document, so that _document_to_user() can still
+    reject users with unknown data.
+
+    :param context: Plugin context, see plugin_init above.
+    :param spec: Query filter
+    :param sort: Sort order, as (key, direction) tuples
+    :param limit: Maximum number of documents to return
+    :param secondary: Read with the context's read preference instead of from the primary
+    :param session: Session to read in, e.g. for causal consistency
+    :param max_time_ms: Server side time limit for the whole read, e.g. the context's deadline
+
+    :type context: DashboardAMPContext
+    :type spec: dict
+    :type sort: list | None
+    :type limit: int | None
+    :type secondary: bool
+    :type session: pymongo.client_session.ClientSession | None
+    :type max_time_ms: int | None
+
+    :rtype: iterable of dict
+    """
+    if context.shard_uris and context.shard is None:
+        return _find_sharded(context, spec, sort, limit, secondary, session, max_time_ms)
+    collection = context.dashboard_userdb._coll
+    if secondary and context.read_preference is not None:
+        collection = collection.with_options(read_preference=context.read_preference)
+    if context.projection_reads:
+        if max_time_ms:
+            return collection.aggregate(_projection_pipeline(spec, sort, limit), session=session,
+                                        maxTimeMS=max_time_ms)
+        return collection.aggregate(_projection_pipeline(spec, sort, limit), session=session)
+    cursor = collection.find(spec, session=session)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def _find_sharded(context, spec, sort=None, limit=None, secondary=False, session=None, max_time_ms=None):
+    """
+    Find documents in all shards, merging the results in sort order.
+    """
+    results = [_find_documents(shard, spec, sort, limit, secondary, session, max_time_ms)
+               for shard in context.shards]
+    if not sort:
+        docs = (doc for result in results for doc in result)
+    else:
+        if any(direction != pymongo.ASCENDING for _key, direction in sort):
+            raise ValueError('Only ascending sort orders are supported for sharded reads')
+
+        def _decorate(index, result):
+            for number, doc in enumerate(result):
+                yield tuple(doc.get(key) for key, _direction in sort), index, number, doc
+
+        docs = (doc for _sort_key, _index, _number, doc in
+                heapq.merge(*[_decorate(index, result) for index, result in enumerate(results)]))
+    if limit:
+        return islice(docs, limit)
+    return docs
+
+
+def _projection_pipeline(spec, sort=None, limit=None):
+    """
+    Aggregation pipeline for reading PROJECTION_ATTRS and UNKNOWN_ATTRS_FIELD.
+
+    :param spec: Query filter
+    :param sort: Sort order, as (key, direction) tuples
+    :param limit: Maximum number of documents to return
+
+    :type spec: dict
+    :type sort: list | None
+    :type limit: int | None
+
+    :rtype: list
+    """
+    projection = dict((attr, 1) for attr in PROJECTION_ATTRS)
+    projection[UNKNOWN_ATTRS_FIELD] = {
+        '$setDifference': [
+            {'$map': {'input': {'$objectToArray': '$$ROOT'}, 'as': 'kv', 'in': '$$kv.k'}},
+            sorted(KNOWN_ATTRS),
+        ]
+    }
+    pipeline = [{'$match': spec}]
+    if sort:
+        pipeline.append({'$sort': SON(sort)})
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline.append({'$project': projection})
+    return pipeline
+
+
+def _document_to_attributes(context, doc):
+    """
+    Build the update dict for the central userdb from a dashboard userdb document.
+
+    With the raw fast path enabled, documents of known shapes are converted
+    directly by eduid_dashboard_amp.raw, and all others through DashboardUser.
+
+    :param context: Plugin context, see plugin_init above.
+    :param doc: Document returned by _find_documents()
+
+    :type context: DashboardAMPContext
+    :type doc: dict
+
     :return: update dict
     :rtype: dict
     """
+    if random.random() < context.document_bytes_sample_rate:
+        # Encoding the document again costs about as much as decoding it, so only a sample is measured
+        context.metrics.observe('document_bytes', len(bson.BSON.encode(doc)),
+                                fields='projected' if context.projection_reads else 'all')
+    if context.raw_fast_path:
+        unknown = doc.get(UNKNOWN_ATTRS_FIELD)
+        if unknown is None:
+            unknown = set(doc.keys()) - KNOWN_ATTRS
+        if not unknown:
+            try:
+                with context.metrics.timer('convert_seconds', path='raw'):
+                    user_dict = raw.document_to_dict(doc)
+                return _filter_attributes(context, user_dict)
+            except raw.UnsupportedDocument as exc:
+                context.metrics.incr('raw_fallbacks_total')
+                context.log.debug('raw_fallback', user_id=doc.get('_id'), reason=exc)
+    with context.metrics.timer('convert_seconds', path='object'):
+        user_dict = _document_to_user(doc).to_dict(old_userdb_format=False)
+    return _filter_attributes(context, user_dict)
+
+
+def _document_to_user(doc):
+    """
+    Create a DashboardUser from a document returned by _find_documents().
 
-    attributes = {}
-    logger.debug('Trying to get user with _id: {} from {}.'.format(user_id, context.dashboard_userdb))
-    user = context.dashboard_userdb.get_user_by_id(user_id)
-    logger.debug('User: {} found.'.format(user))
+    :param doc: Dashboard userdb document
 
-    user_dict = user.to_dict(old_userdb_format=False)
+    :type doc: dict
 
+    :rtype: DashboardUser
+    """
+    unknown = doc.pop(UNKNOWN_ATTRS_FIELD, None)
+    if unknown:
+        raise UserHasUnknownData('User {!s} has unknown data: {!r}'.format(doc.get('_id'), unknown))
+    return DashboardUser(data=doc)
+
+
+def _filter_attributes(context, user_dict):
+    """
+    Build the update dict for the central userdb from a user dict in the new userdb format.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_dict: User data
+
+    :type context: DashboardAMPContext
+    :type user_dict: dict
+
+    :return: update dict
+    :rtype: dict
+    """
+    with context.metrics.timer('filter_seconds'):
+        attributes = apply_filter_plan(context.filter_plan, user_dict)
+    context.metrics.observe('attributes_set', len(attributes['$set']))
+    context.metrics.observe('attributes_unset', len(attributes.get('$unset', {})))
+
+    context.log.debug('attributes', set=attributes['$set'], unset=attributes.get('$unset', {}))
+
+    return attributes
+
+
+def compile_filter_plan(set_attrs=WHITELIST_SET_ATTRS, unset_attrs=WHITELIST_UNSET_ATTRS, transforms=None):
+    """
+    Compile the attribute white lists into a filter plan.
+
+    The plan has one AttributeRule for every attribute that may be set, in
+    the order of set_attrs, saying if the attribute is to be unset when the
+    user has no value for it and which transform (if any) to apply to values.
+
+    :param set_attrs: Attributes that may be set in the central userdb
+    :param unset_attrs: Attributes that may be unset in the central userdb
+    :param transforms: Function to apply to non-empty values, per attribute
+                       (default VALUE_TRANSFORMS)
+
+    :type set_attrs: tuple
+    :type unset_attrs: tuple
+    :type transforms: dict | None
+
+    :rtype: tuple of AttributeRule
+    """
+    unset_attrs = frozenset(unset_attrs)
+    if transforms is None:
+        transforms = VALUE_TRANSFORMS
+    return tuple(AttributeRule(attr, attr in unset_attrs, transforms.get(attr)) for attr in set_attrs)
+
+
+def apply_filter_plan(plan, user_dict):
+    """
+    Build an update dict from a user dict in the new userdb format.
+
+    :param plan: Filter plan, see compile_filter_plan()
+    :param user_dict: User data
+
+    :type plan: tuple of AttributeRule
+    :type user_dict: dict
+
+    :return: update dict
+    :rtype: dict
+    """
     # white list of valid attributes for security reasons
     attributes_set = {}
     attributes_unset = {}
-    for attr in WHITELIST_SET_ATTRS:
-        value = value_filter(attr, user_dict.get(attr, None))
+    for attr, unset, transform in plan:
+        value = user_dict.get(attr)
+        if value and transform is not None:
+            value = transform(value)
         if value:
             attributes_set[attr] = value
-        elif attr in WHITELIST_UNSET_ATTRS:
+        elif unset:
             attributes_unset[attr] = value
 
-    logger.debug('Will set attributes: {}'.format(attributes_set))
-    logger.debug('Will remove attributes: {}'.format(attributes_unset))
-
-    attributes['$set'] = attributes_set
+    attributes = {'$set': attributes_set}
     if attributes_unset:
         attributes['$unset'] = attributes_unset
 
@@ -0,0 +1,129 @@
+"""
+asyncio version of the attribute fetcher.
+
+This module requires Python 3.5+ and the motor MongoDB driver, install with
+
+    pip install eduid-dashboard-amp[async]
+
+The update dicts are built by the same code as in the synchronous plugin, only
+the database access is done with motor so that many lookups can be in flight
+in one event loop.
+"""
+import os
+
+import bson
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+from eduid_userdb.exceptions import UserDoesNotExist
+from celery.utils.log import get_task_logger
+
+from eduid_dashboard_amp import db, plugin_init
+from eduid_dashboard_amp import TIMEOUT_ERRORS, AttributeFetcherTimeout, CircuitOpen
+from eduid_dashboard_amp import _document_to_attributes, _projection_pipeline
+
+logger = get_task_logger(__name__)
+
+
+class AsyncDashboardAMPContext(object):
+    """
+    Private data for the asyncio version of this AM plugin.
+
+    The settings are shared with the synchronous context, see plugin_init().
+    """
+
+    def __init__(self, context):
+        """
+        :param context: Synchronous plugin context with the settings to use
+
+        :type context: eduid_dashboard_amp.DashboardAMPContext
+        """
+        if context.shard_uris and context.shard is None:
+            raise ValueError('The asyncio plugin does not support sharding, use context.for_shard()')
+        self.context = context
+        collection = context.dashboard_userdb._coll
+        self._db_name = collection.database.name
+        self._collection_name = collection.name
+        self._client = None
+        self._pid = None
+
+    @property
+    def dashboard_collection(self):
+        """
+        The Dashboard private userdb collection, with a client created on first use in this process.
+
+        :rtype: motor.motor_asyncio.AsyncIOMotorCollection
+        """
+        if self._client is None or self._pid != os.getpid():
+            db_uri = db.uri_with_options(self.context.dashboard_uri, self.context.dashboard_db_options)
+            self._client = AsyncIOMotorClient(db_uri, tz_aware=True)
+            self._pid = os.getpid()
+        return self._client[self._db_name][self._collection_name]
+
+
+def plugin_init_async(am_conf):
+    """
+    Create a private context for the asyncio version of this plugin.
+
+    :am_conf: Attribute Manager configuration data, see plugin_init().
+
+    :type am_conf: dict
+
+    :rtype: AsyncDashboardAMPContext
+    """
+    return AsyncDashboardAMPContext(plugin_init(am_conf))
+
+
+async def attribute_fetcher_async(context, user_id):
+    """
+    Read a user from the Dashboard private userdb and return an update
+    dict to let the Attribute Manager update the use in the central
+    eduid user database.
+
+    Returns the same update dict as attribute_fetcher(). The read is made
+    behind the same circuit breaker and within the same deadline, but not in
+    a lane: the lanes block the thread while waiting, which would block the
+    event loop, so motor's own connection pool limits the concurrency.
+
+    :param context: Plugin context, see plugin_init_async above.
+    :param user_id: Unique identifier
+
+    :type context: AsyncDashboardAMPContext
+    :type user_id: ObjectId
+
+    :raises CircuitOpen: if the circuit breaker is open
+    :raises AttributeFetcherTimeout: if the read did not finish before the deadline
+
+    :return: update dict
+    :rtype: dict
+    """
+    if not isinstance(user_id, bson.ObjectId):
+        user_id = bson.ObjectId(user_id)
+    spec = {'_id': user_id}
+    collection = context.dashboard_collection
+
+    sync_context = context.context
+    deadline_ms = sync_context.deadline_ms
+
+    sync_context.log.debug('fetch', users=1, collection=collection.full_name)
+    try:
+        with sync_context.breaker.guard():
+            if sync_context.projection_reads:
+                options = {'maxTimeMS': deadline_ms} if deadline_ms else {}
+                docs = await collection.aggregate(_projection_pipeline(spec), **options).to_list(length=1)
+                doc = docs[0] if docs else None
+            else:
+                doc = await collection.find_one(spec, max_time_ms=deadline_ms)
+    except CircuitOpen:
+        sync_context.metrics.incr('errors_total', type=CircuitOpen.__name__)
+        raise
+    except TIMEOUT_ERRORS as exc:
+        sync_context.metrics.incr('errors_total', type=AttributeFetcherTimeout.__name__)
+        raise AttributeFetcherTimeout('Reading user {!r} from {!s} timed out ({!s}): {!s}'.format(
+            user_id, collection.full_name, exc.__class__.__name__, exc))
+    except pymongo.errors.PyMongoError as exc:
+        sync_context.metrics.incr('errors_total', type=exc.__class__.__name__)
+        raise
+    if doc is None:
+        raise UserDoesNotExist('No user with _id {!r} in {!s}'.format(user_id, collection.full_name))
+
+    return _document_to_attributes(sync_context, doc)
@@ -0,0 +1,176 @@
+"""
+Element level updates of the array attributes in the central userdb.
+
+attribute_fetcher() sets every array attribute in full, so a user with many
+credentials rewrites all of them on every sync. Here the new value of an
+array is compared with the one in the central user document, matching the
+elements by their identity (the value of ARRAY_IDENTITY_KEYS[attr], or the
+element itself for arrays of strings), and only the difference is written:
+
+  $pull             - the elements that were removed
+  positional $set   - the elements that changed, using arrayFilters
+  $push             - the elements that were added
+
+MongoDB does not allow these on the same array in one update, so they are
+separate operations that must be applied in order. Every operation is
+guarded by the size and identities of the array it expects to find, so an
+array changed by someone else in the meantime makes the operation match
+nothing, and the caller should then fall back to setting the arrays in full.
+
+An array is set in full anyway when its identities are missing or not
+unique, when no element is kept, or when the diff would not keep the order
+of the new array.
+"""
+import pymongo
+
+# Identity of the elements of the array attributes, None for arrays of strings.
+# The update dicts only have new format arrays, old format ones are never set.
+ARRAY_IDENTITY_KEYS = {
+    'passwords': 'credential_id',
+    'mailAliases': 'email',
+    'phone': 'number',
+    'nins': 'number',
+    'eduPersonEntitlement': None,
+}
+
+
+class _NotDiffable(Exception):
+    pass
+
+
+def array_operations(user_id, attributes, central_doc, identity_keys=None):
+    """
+    Bulk write operations applying an update dict to central_doc, changing arrays element by element.
+
+    The first operation sets and unsets everything but the arrays that can
+    be diffed. It is left out if empty, and is the only operation (an upsert
+    of the whole update dict) if the user is not in the central userdb yet.
+
+    :param user_id: Unique identifier
+    :param attributes: update dict, as returned by attribute_fetcher()
+    :param central_doc: the user's document in the central userdb, or None
+    :param identity_keys: {attr: identity key}, defaults to ARRAY_IDENTITY_KEYS
+
+    :type user_id: ObjectId
+    :type attributes: dict
+    :type central_doc: dict | None
+    :type identity_keys: dict | None
+
+    :return: operations to pass to an ordered bulk_write() on the central userdb, possibly empty
+    :rtype: list of pymongo.UpdateOne
+    """
+    if central_doc is None:
+        return [pymongo.UpdateOne({'_id': user_id}, attributes, upsert=True)]
+    if identity_keys is None:
+        identity_keys = ARRAY_IDENTITY_KEYS
+
+    attributes_set = {}
+    array_ops = []
+    for attr, value in attributes.get('$set', {}).items():
+        steps = None
+        if attr in identity_keys:
+            steps = array_diff(attr, central_doc.get(attr), value, identity_keys[attr])
+        if steps is None:
+            attributes_set[attr] = value
+            continue
+        for guard, update, array_filters in steps:
+            spec = {'_id': user_id}
+            spec.update(guard)
+            array_ops.append(pymongo.UpdateOne(spec, update, array_filters=array_filters))
+
+    update = {}
+    if attributes_set:
+        update['$set'] = attributes_set
+    if attributes.get('$unset'):
+        update['$unset'] = attributes['$unset']
+    if update:
+        return [pymongo.UpdateOne({'_id': user_id}, update)] + array_ops
+    return array_ops
+
+
+def array_diff(attr, old, new, key=None):
+    """
+    Compute the element level updates turning the array old into new.
+
+    :param attr: Attribute name
+    :param old: Current value in the central userdb, or None if not set
+    :param new: New value
+    :param key: Identity key of the elements, None if the elements are their own identity
+
+    :type attr: str
+    :type old: list | None
+    :type new: list
+    :type key: str | None
+
+    :return: (guard spec, update, array filters) tuples to apply in order,
+             or None if the array should be set in full
+    :rtype: list | None
+    """
+    if not isinstance(old, list) or not isinstance(new, list) or not old:
+        return None
+    try:
+        old_ids = _identities(old, key)
+        new_ids = _identities(new, key)
+    except _NotDiffable:
+        return None
+
+    old_by_id = dict(zip(old_ids, old))
+    new_by_id = dict(zip(new_ids, new))
+    kept = [this for this in old_ids if this in new_by_id]
+    removed = [this for this in old_ids if this not in new_by_id]
+    added = [this for this in new_ids if this not in old_by_id]
+    if not kept or kept + added != new_ids:
+        return None
+
+    changed = [this for this in kept if old_by_id[this] != new_by_id[this]]
+
+    steps = []
+    if removed:
+        if key is None:
+            pull = {attr: {'$in': removed}}
+        else:
+            pull = {attr: {key: {'$in': removed}}}
+        steps.append((_guard(attr, key, old_ids), {'$pull': pull}, None))
+    if changed:
+        update = {}
+        array_filters = []
+        for index, this in enumerate(changed):
+            update['{}.$[e{}]'.format(attr, index)] = new_by_id[this]
+            array_filters.append({'e{}.{}'.format(index, key): this})
+        steps.append((_guard(attr, key, kept), {'$set': update}, array_filters))
+    if added:
+        push = {attr: {'$each': [new_by_id[this] for this in added]}}
+        steps.append((_guard(attr, key, kept), {'$push': push}, None))
+    return steps
+
+
+def _identities(elements, key):
+    """
+    The identities of the elements of an array, in order.
+
+    :raises _NotDiffable: if an identity is missing, not hashable or not unique
+    """
+    if key is None:
+        ids = elements
+    else:
+        if not all(isinstance(this, dict) and key in this for this in elements):
+            raise _NotDiffable()
+        ids = [this[key] for this in elements]
+    try:
+        if len(set(ids)) != len(ids):
+            raise _NotDiffable()
+    except TypeError:
+        raise _NotDiffable()
+    return ids
+
+
+def _guard(attr, key, ids):
+    """
+    Query matching a document where the array attr has exactly the identities ids.
+
+    ids are unique, so if the array has as many elements and all of them are
+    in it, there can be no others.
+    """
+    if key is None:
+        return {attr: {'$size': len(ids), '$all': ids}}
+    return {attr: {'$size': len(ids)}, '{}.{}'.format(attr, key): {'$all': ids}}
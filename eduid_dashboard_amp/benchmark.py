@@ -0,0 +1,305 @@
+"""
+Benchmarks for the attribute fetcher.
+
+Synthetic dashboard users of controlled shapes (old or new userdb format,
+number of passwords/mailAliases/phone/nins entries, terminated or not) are
+written to a dashboard userdb, and the time spent in each phase of
+attribute_fetcher() is measured:
+
+  fetch   - reading the document from the database
+  convert - DashboardUser(data=doc).to_dict(old_userdb_format=False)
+  raw     - the same conversion with the raw document fast path
+  filter  - applying the white list filter plan
+  total   - attribute_fetcher() from start to end
+  batch   - attribute_fetcher_many() on batches of users, per user; each
+            batch is timed separately and the percentiles are over the batches
+  log_eager - debug logging of the update dict the way it used to be done,
+              formatting the message before calling the logger
+  log_lazy  - the same with the level guarded EventLogger of the context
+
+The logging phases are measured at the configured log level, i.e. with
+debug logging disabled unless the logging is configured otherwise.
+
+The results are written as JSON, to compare between releases. Run with
+
+    python -m eduid_dashboard_amp.benchmark --output results.json
+
+against a temporary mongod (default), an existing MongoDB server
+(--mongo-uri) or an in-memory mongomock database (--in-memory, requires
+mongomock). The users are written to the BENCHMARK_DB_NAME database, never to
+the dashboard userdb, and removed again afterwards.
+"""
+import argparse
+import copy
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+
+import bson
+import pkg_resources
+from eduid_userdb.dashboard import DashboardUser
+from eduid_userdb.util import UTC
+
+from eduid_dashboard_amp import apply_filter_plan, attribute_fetcher, attribute_fetcher_many, ensure_indexes
+from eduid_dashboard_amp import plugin_init
+from eduid_dashboard_amp import raw
+
+DEFAULT_SIZES = (1, 10, 100, 1000)
+DEFAULT_USERS = 100
+DEFAULT_BATCH_USERS = 10
+
+# Database the benchmark users are written to, instead of the dashboard userdb
+BENCHMARK_DB_NAME = 'eduid_dashboard_amp_bench'
+
+SALT = '$NDNv1H1$9c810d852430b62a9a7c6159d5d64c41c3831846f81b6799b54e1e8922f11545$32$32$'
+
+
+def make_user_doc(number, size, old_format=False, terminated=False):
+    """
+    Generate a synthetic dashboard userdb document.
+
+    :param number: Sequence number, to make the user unique
+    :param size: Number of passwords, mailAliases, phone numbers and nins
+    :param old_format: Use the old userdb format (mail, mobile, sn, norEduPersonNIN)
+    :param terminated: Make the user terminated
+
+    :type number: int
+    :type size: int
+    :type old_format: bool
+    :type terminated: bool
+
+    :rtype: dict
+    """
+    now = datetime.now(tz=UTC())
+    emails = ['user{}-{}@example.com'.format(number, i) for i in range(size)]
+    numbers = ['+4670{:07d}'.format(i) for i in range(size)]
+    nins = ['19{:010d}'.format(number * size + i) for i in range(size)]
+    doc = {
+        '_id': bson.ObjectId(),
+        'eduPersonPrincipalName': 'bench-{}'.format(number),
+        'givenName': 'Bench',
+        'displayName': 'Bench User {}'.format(number),
+        'preferredLanguage': 'sv',
+    }
+    if old_format:
+        doc.update({
+            'sn': 'User',
+            'mail': emails[0],
+            'mailAliases': [{'email': email, 'verified': True, 'added_timestamp': now} for email in emails],
+            'mobile': [{'mobile': phone, 'verified': True, 'primary': i == 0} for i, phone in enumerate(numbers)],
+            'norEduPersonNIN': nins,
+            'passwords': [{'id': bson.ObjectId(), 'salt': SALT} for _ in range(size)],
+        })
+    else:
+        doc.update({
+            'surname': 'User',
+            'mailAliases': [{'email': email, 'verified': True, 'primary': i == 0, 'created_ts': now}
+                            for i, email in enumerate(emails)],
+            'phone': [{'number': phone, 'verified': True, 'primary': i == 0} for i, phone in enumerate(numbers)],
+            'nins': [{'number': nin, 'verified': True, 'primary': i == 0} for i, nin in enumerate(nins)],
+            'passwords': [{'credential_id': str(bson.ObjectId()), 'salt': SALT, 'created_by': 'bench'}
+                          for _ in range(size)],
+        })
+    if terminated:
+        doc['terminated'] = now
+    return doc
+
+
+def shapes(sizes=DEFAULT_SIZES):
+    """
+    All combinations of format, size and terminated to benchmark.
+
+    :rtype: list of dict
+    """
+    return [{'old_format': old_format, 'size': size, 'terminated': terminated}
+            for old_format in (False, True)
+            for size in sizes
+            for terminated in (False, True)]
+
+
+def summarize(timings):
+    """
+    Latency percentiles (in milliseconds) and throughput for a list of timings in seconds.
+
+    :type timings: list of float
+
+    :rtype: dict
+    """
+    timings = sorted(timings)
+    count = len(timings)
+    total = sum(timings)
+
+    def _percentile(p):
+        return timings[min(count - 1, int(p * count))] * 1000
+
+    return {
+        'count': count,
+        'mean_ms': total / count * 1000,
+        'min_ms': timings[0] * 1000,
+        'p50_ms': _percentile(0.50),
+        'p95_ms': _percentile(0.95),
+        'p99_ms': _percentile(0.99),
+        'max_ms': timings[-1] * 1000,
+        'per_second': count / total if total else None,
+    }
+
+
+def _timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def _log_eager(context, attributes):
+    context.log.logger.debug('Will set attributes: {}'.format(attributes['$set']))
+    context.log.logger.debug('Will remove attributes: {}'.format(attributes.get('$unset', {})))
+
+
+def _log_lazy(context, attributes):
+    context.log.debug('attributes', set=attributes['$set'], unset=attributes.get('$unset', {}))
+
+
+def benchmark_context(context):
+    """
+    A view of a plugin context that reads users from the BENCHMARK_DB_NAME database.
+
+    :param context: Plugin context, see plugin_init.
+
+    :type context: eduid_dashboard_amp.DashboardAMPContext
+
+    :rtype: eduid_dashboard_amp.DashboardAMPContext
+    """
+    bench = copy.copy(context)
+    bench.dashboard_db_name = BENCHMARK_DB_NAME
+    bench.shard_uris = []
+    bench.router = None
+    bench.shard = None
+    return bench
+
+
+def benchmark_shape(context, shape, users=DEFAULT_USERS, batch_users=DEFAULT_BATCH_USERS):
+    """
+    Benchmark the phases of attribute_fetcher() for one shape of users.
+
+    :param context: Plugin context, see plugin_init.
+    :param shape: Arguments for make_user_doc()
+    :param users: Number of users to generate
+    :param batch_users: Number of users per attribute_fetcher_many() call in the batch phase
+
+    :type context: eduid_dashboard_amp.DashboardAMPContext
+    :type shape: dict
+    :type users: int
+    :type batch_users: int
+
+    :return: Summary per phase
+    :rtype: dict
+    """
+    context = benchmark_context(context)
+    collection = context.dashboard_userdb._coll
+    if collection.database.name != BENCHMARK_DB_NAME:
+        raise ValueError('Refusing to benchmark in {!s}, not the benchmark database'.format(collection.full_name))
+    collection.delete_many({})
+    docs = [make_user_doc(number, **shape) for number in range(users)]
+    collection.insert_many(docs)
+    user_ids = [doc['_id'] for doc in docs]
+
+    phases = dict((phase, []) for phase in ('fetch', 'convert', 'raw', 'filter', 'log_eager', 'log_lazy', 'total'))
+    for user_id in user_ids:
+        elapsed, doc = _timed(collection.find_one, {'_id': user_id})
+        phases['fetch'].append(elapsed)
+        elapsed, user_dict = _timed(lambda data: DashboardUser(data=data).to_dict(old_userdb_format=False), doc)
+        phases['convert'].append(elapsed)
+        elapsed, _ = _timed(raw.document_to_dict, doc)
+        phases['raw'].append(elapsed)
+        elapsed, attributes = _timed(apply_filter_plan, context.filter_plan, user_dict)
+        phases['filter'].append(elapsed)
+        elapsed, _ = _timed(_log_eager, context, attributes)
+        phases['log_eager'].append(elapsed)
+        elapsed, _ = _timed(_log_lazy, context, attributes)
+        phases['log_lazy'].append(elapsed)
+        elapsed, _ = _timed(attribute_fetcher, context, user_id)
+        phases['total'].append(elapsed)
+
+    phases['batch'] = []
+    for start in range(0, len(user_ids), batch_users):
+        batch = user_ids[start:start + batch_users]
+        elapsed, _ = _timed(lambda ids: list(attribute_fetcher_many(context, ids)), batch)
+        phases['batch'].append(elapsed / len(batch))
+
+    result = dict((phase, summarize(timings)) for phase, timings in phases.items())
+    result['doc_bytes'] = len(bson.BSON.encode(docs[0]))
+    collection.delete_many({})
+    return result
+
+
+def run_benchmarks(context, sizes=DEFAULT_SIZES, users=DEFAULT_USERS, batch_users=DEFAULT_BATCH_USERS):
+    """
+    Benchmark all shapes of users.
+
+    :param context: Plugin context, see plugin_init. The users are written to
+                    the BENCHMARK_DB_NAME database on its MONGO_URI.
+    :param sizes: Numbers of passwords/mailAliases/phone/nins to benchmark
+    :param users: Number of users per shape
+    :param batch_users: Number of users per attribute_fetcher_many() call in the batch phase
+
+    :type context: eduid_dashboard_amp.DashboardAMPContext
+    :type sizes: iterable of int
+    :type users: int
+    :type batch_users: int
+
+    :return: Machine readable results
+    :rtype: dict
+    """
+    ensure_indexes(benchmark_context(context))
+    results = []
+    for shape in shapes(sizes):
+        results.append({'shape': shape, 'phases': benchmark_shape(context, shape, users, batch_users)})
+    return {
+        'version': pkg_resources.get_distribution('eduid-dashboard-amp').version,
+        'python': platform.python_version(),
+        'timestamp': datetime.now(tz=UTC()).isoformat(),
+        'users_per_shape': users,
+        'users_per_batch': batch_users,
+        'results': results,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the eduID Dashboard AM plugin')
+    parser.add_argument('--mongo-uri', help='MongoDB to use (default: start a temporary mongod)')
+    parser.add_argument('--in-memory', action='store_true', help='Use an in-memory mongomock database')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated numbers of entries per list attribute')
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS, help='Users per shape')
+    parser.add_argument('--batch-users', type=int, default=DEFAULT_BATCH_USERS,
+                        help='Users per attribute_fetcher_many() call in the batch phase')
+    parser.add_argument('--output', help='File to write the JSON results to (default: stdout)')
+    args = parser.parse_args(args)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    def _run(mongo_uri):
+        context = plugin_init({'MONGO_URI': mongo_uri})
+        return run_benchmarks(context, sizes, args.users, args.batch_users)
+
+    if args.in_memory:
+        import mongomock
+        with mongomock.patch(servers=(('localhost', 27017),)):
+            results = _run('mongodb://localhost:27017/')
+    elif args.mongo_uri:
+        results = _run(args.mongo_uri)
+    else:
+        from eduid_userdb.testing import MongoTemporaryInstance
+        tmp_db = MongoTemporaryInstance.get_instance()
+        results = _run(tmp_db.get_uri(''))
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Circuit breaker for the Dashboard private userdb.
+
+After `threshold' consecutive connection failures the circuit opens, and
+reads fail at once with CircuitOpen instead of waiting for timeouts. After
+`reset_timeout' seconds the circuit is half open, and one trial read at a
+time is let through. A successful trial closes the circuit, a failed one
+opens it again.
+
+Waiting too long for a connection from the client's own pool says nothing
+about the database, so it neither counts as a failure nor as a success.
+pymongo >= 4.2 raises WaitQueueTimeoutError for it, older versions a plain
+ConnectionFailure mentioning the pool's wait_queue_timeout.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import pymongo.errors
+from pymongo.errors import ConnectionFailure
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+_WAIT_QUEUE_TIMEOUT = getattr(pymongo.errors, 'WaitQueueTimeoutError', None)
+
+
+def is_pool_wait_timeout(exc):
+    """
+    Whether an exception means that no connection became free in the client's own pool in time.
+
+    :type exc: Exception
+    :rtype: bool
+    """
+    if _WAIT_QUEUE_TIMEOUT is not None and isinstance(exc, _WAIT_QUEUE_TIMEOUT):
+        return True
+    return type(exc) is ConnectionFailure and 'wait_queue_timeout' in str(exc)
+
+
+class CircuitOpen(Exception):
+    """
+    The dashboard userdb is considered down, the read was not attempted.
+
+    The read can be retried (preferably with a backoff).
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast while a database is down, see the module docstring.
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=5.0, on_change=None, timer=time.time):
+        """
+        :param name: Name of the circuit, e.g. for metrics
+        :param threshold: Consecutive connection failures that open the circuit, 0 for never
+        :param reset_timeout: Seconds before trying again after the circuit opened
+        :param on_change: Function called with the breaker when the state changes
+        :param timer: Function returning the current time in seconds
+
+        :type name: str
+        :type threshold: int
+        :type reset_timeout: float
+        :type on_change: callable | None
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._state = CLOSED
+        self._opened = None
+        self._probing = False
+        self._on_change = on_change
+        self._timer = timer
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} {} state={} failures={}>'.format(self.__class__.__name__, self.name, self.state, self.failures)
+
+    @property
+    def state(self):
+        """
+        :return: CLOSED, OPEN or HALF_OPEN
+        :rtype: str
+        """
+        if self._state == OPEN and self._timer() - self._opened >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    @contextmanager
+    def guard(self):
+        """
+        Make a read in the with block, unless the circuit is open.
+
+        :raises CircuitOpen: if the circuit is open, or half open with a trial read in progress
+        """
+        probe = self._before()
+        outcome = None
+        try:
+            yield
+        except ConnectionFailure as exc:
+            outcome = 'unknown' if is_pool_wait_timeout(exc) else 'failed'
+            raise
+        finally:
+            # Any other outcome means that the database answered, so it is up
+            if outcome == 'failed':
+                self._failure(probe)
+            elif outcome == 'unknown':
+                self._unknown(probe)
+            else:
+                self._success(probe)
+
+    def _before(self):
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                self._set_state(HALF_OPEN)
+                return True
+        raise CircuitOpen('Circuit {} is {}, not reading from the database'.format(self.name, state))
+
+    def _success(self, probe):
+        with self._lock:
+            self.failures = 0
+            if probe:
+                self._probing = False
+            if self._state != CLOSED and (probe or not self._probing):
+                self._set_state(CLOSED)
+
+    def _unknown(self, probe):
+        with self._lock:
+            if probe:
+                # Let another trial read through
+                self._probing = False
+
+    def _failure(self, probe):
+        with self._lock:
+            self.failures += 1
+            if probe:
+                self._probing = False
+            if probe or (self._state == CLOSED and self.threshold and self.failures >= self.threshold):
+                self._opened = self._timer()
+                self._set_state(OPEN)
+
+    def _set_state(self, state):
+        changed = state != self._state
+        self._state = state
+        if changed and self._on_change is not None:
+            self._on_change(self)
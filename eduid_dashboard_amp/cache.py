@@ -0,0 +1,109 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Small thread safe LRU cache with an optional time to live for the entries.
+
+    Used by the plugin context to remember things about users between calls,
+    without growing beyond `maxsize' entries in long running AM workers.
+    """
+
+    def __init__(self, maxsize, ttl=None, timer=time.time):
+        """
+        :param maxsize: Maximum number of entries
+        :param ttl: Seconds an entry is valid, or None for no expiry
+        :param timer: Function returning the current time in seconds
+
+        :type maxsize: int
+        :type ttl: float | None
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<{} size={}/{} ttl={} hits={} misses={}>'.format(
+            self.__class__.__name__, len(self._data), self.maxsize, self.ttl, self.hits, self.misses)
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key, or default if it is missing or expired.
+        """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self._timer():
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Store value for key, evicting the least recently used entry if the cache is full.
+        """
+        if self.maxsize <= 0:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = self._timer() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (expires, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class MongoFingerprintStore(object):
+    """
+    Fingerprint store in a MongoDB side collection, shared by all AM workers.
+
+    Has the same get/set/delete interface as LRUCache. The collection is looked
+    up on every call, so that a database client is never used across a fork.
+    """
+
+    def __init__(self, get_collection):
+        """
+        :param get_collection: Function returning the collection to store fingerprints in
+
+        :type get_collection: callable
+        """
+        self._get_collection = get_collection
+
+    def __repr__(self):
+        return '<{} collection={}>'.format(self.__class__.__name__, self._get_collection().full_name)
+
+    def get(self, key, default=None):
+        doc = self._get_collection().find_one({'_id': key})
+        if doc is None:
+            return default
+        return doc.get('fingerprint', default)
+
+    def set(self, key, value):
+        self._get_collection().replace_one({'_id': key}, {'_id': key, 'fingerprint': value}, upsert=True)
+
+    def delete(self, key):
+        self._get_collection().delete_one({'_id': key})
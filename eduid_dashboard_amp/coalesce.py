@@ -0,0 +1,93 @@
+import copy
+import time
+import threading
+
+
+class _Call(object):
+    """
+    One call shared by all callers that were coalesced into it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.callers = 1
+
+
+class Coalescer(object):
+    """
+    Collapse calls with the same key into one.
+
+    The first caller for a key waits `window' seconds before making the call.
+    Callers with the same key arriving before the call is made join it, and
+    all of them get the same result (or exception). Callers arriving after
+    the call has started begin a new group, so a caller never gets a result
+    read before it asked for it.
+
+    This works between threads (or greenlets) in one process, not between the
+    processes of a prefork worker pool.
+    """
+
+    def __init__(self, window=0.0):
+        """
+        :param window: Seconds to wait for more callers before making a call
+
+        :type window: float
+        """
+        self.window = window
+        self.calls = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} window={} calls={} coalesced={}>'.format(
+            self.__class__.__name__, self.window, self.calls, self.coalesced)
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), or join a pending call with the same key.
+
+        :param key: Calls with equal keys are coalesced
+        :param func: Function to call
+
+        :type key: hashable
+        :type func: callable
+
+        :return: The result of the call, a copy of it for joining callers
+        """
+        with self._lock:
+            call = self._pending.get(key)
+            if call is None:
+                call = _Call()
+                self._pending[key] = call
+                leader = True
+            else:
+                call.callers += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return copy.deepcopy(call.result)
+
+        if self.window:
+            time.sleep(self.window)
+        with self._lock:
+            # Callers arriving from now on must not get the result of this call
+            del self._pending[key]
+            self.calls += 1
+        try:
+            result = func(*args, **kwargs)
+            if call.callers > 1:
+                # A copy that the leader's caller can't change, for the joining callers to copy
+                call.result = copy.deepcopy(result)
+            return result
+        except Exception as exc:
+            call.exception = exc
+            raise
+        finally:
+            call.done.set()
@@ -0,0 +1,151 @@
+"""
+Process wide registry of database clients.
+
+pymongo clients are not fork safe, so a client created in a Celery master
+process must not be used by the prefork children. The registry remembers the
+pid that created its clients, and starts over with new clients the first time
+it is used in a new process. Contexts using the same URI and options share
+one client, and thus one connection pool.
+"""
+import os
+import threading
+
+from pymongo import read_preferences
+from eduid_userdb.dashboard import DashboardUserDB
+
+# am_conf key -> MongoDB connection string option
+POOL_OPTIONS = (
+    ('DASHBOARD_AMP_MAX_POOL_SIZE', 'maxPoolSize'),
+    ('DASHBOARD_AMP_MIN_POOL_SIZE', 'minPoolSize'),
+    ('DASHBOARD_AMP_MAX_IDLE_TIME_MS', 'maxIdleTimeMS'),
+    ('DASHBOARD_AMP_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+    ('DASHBOARD_AMP_SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+    ('DASHBOARD_AMP_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+    ('DASHBOARD_AMP_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+)
+
+# Read preference names accepted by read_preference()
+READ_PREFERENCES = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest,
+}
+
+_lock = threading.Lock()
+_pid = None
+_userdbs = {}
+
+
+def pool_options(am_conf, lane=None):
+    """
+    Get the connection pool settings from the Attribute Manager configuration.
+
+    :param am_conf: Attribute Manager configuration data.
+    :param lane: Get the settings of a lane, e.g. DASHBOARD_AMP_BULK_MAX_POOL_SIZE for 'bulk'
+
+    :type am_conf: dict
+    :type lane: str | None
+
+    :return: MongoDB connection string options
+    :rtype: dict
+    """
+    if lane is not None:
+        prefix = 'DASHBOARD_AMP_{}_'.format(lane.upper())
+        keys = [(key.replace('DASHBOARD_AMP_', prefix, 1), option) for key, option in POOL_OPTIONS]
+    else:
+        keys = POOL_OPTIONS
+    return dict((option, am_conf[key]) for key, option in keys if am_conf.get(key) is not None)
+
+
+def uri_with_options(db_uri, options):
+    """
+    Add options to the query string of a MongoDB connection string.
+
+    :type db_uri: str | unicode
+    :type options: dict
+
+    :rtype: str | unicode
+    """
+    if not options:
+        return db_uri
+    query = '&'.join('{}={}'.format(option, value) for option, value in sorted(options.items()))
+    if '?' in db_uri:
+        return '{}&{}'.format(db_uri, query)
+    if '/' in db_uri.split('://', 1)[-1]:
+        return '{}?{}'.format(db_uri, query)
+    return '{}/?{}'.format(db_uri, query)
+
+
+def read_preference(name, max_staleness=None):
+    """
+    Create a pymongo read preference from its name.
+
+    :param name: Read preference name, see READ_PREFERENCES
+    :param max_staleness: Maximum replication lag in seconds of secondaries to read from
+
+    :type name: str
+    :type max_staleness: int | None
+
+    :rtype: pymongo.read_preferences.ServerMode
+    """
+    if name not in READ_PREFERENCES:
+        raise ValueError('Unknown read preference {!r}, use one of {!r}'.format(name, sorted(READ_PREFERENCES)))
+    if name == 'primary':
+        return read_preferences.Primary()
+    return READ_PREFERENCES[name](max_staleness=max_staleness if max_staleness is not None else -1)
+
+
+def causal_token(session):
+    """
+    Causal consistency token for the writes made in a pymongo session.
+
+    A dashboard that saves a user in a causally consistent session can pass
+    this token to attribute_fetcher(), to make sure that the read sees the
+    write even when it is done on a secondary.
+
+    :type session: pymongo.client_session.ClientSession
+
+    :rtype: dict
+    """
+    return {'operation_time': session.operation_time, 'cluster_time': session.cluster_time}
+
+
+def get_userdb(db_uri, userdb_class=DashboardUserDB, args=(), options=None):
+    """
+    Get the userdb instance for this process, creating it if necessary.
+
+    :param db_uri: MongoDB connection string
+    :param userdb_class: eduid_userdb database class to instantiate
+    :param args: Extra arguments to userdb_class after the URI
+    :param options: Connection pool options, see pool_options()
+
+    :type db_uri: str | unicode
+    :type userdb_class: type
+    :type args: tuple
+    :type options: dict | None
+
+    :rtype: eduid_userdb.db.BaseDB
+    """
+    global _pid
+    key = (userdb_class, db_uri, tuple(args), tuple(sorted((options or {}).items())))
+    pid = os.getpid()
+    with _lock:
+        if _pid != pid:
+            # Clients inherited from the parent process must not be used in this one
+            _userdbs.clear()
+            _pid = pid
+        userdb = _userdbs.get(key)
+        if userdb is None:
+            userdb = userdb_class(uri_with_options(db_uri, options), *args)
+            _userdbs[key] = userdb
+        return userdb
+
+
+def reset():
+    """
+    Forget all clients, e.g. for tests that need new database connections.
+    """
+    with _lock:
+        _userdbs.clear()
@@ -0,0 +1,38 @@
+"""
+Create the indexes the plugin needs in the Dashboard private userdb.
+
+Run this once when deploying, and after upgrades adding indexes, rather than
+from every worker: plugin_init() does not touch the indexes, so starting a
+worker does not wait for a database that is down.
+"""
+import argparse
+import sys
+
+from eduid_dashboard_amp import ensure_indexes, plugin_init
+
+
+def main(args=None):
+    """
+    Create the missing indexes in the dashboard userdb and all its shards.
+
+    :return: Exit status, 1 if an index could not be verified
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description='Create the indexes of the eduID Dashboard userdb')
+    parser.add_argument('--mongo-uri', required=True, help='MongoDB connection string')
+    parser.add_argument('--shard-uri', action='append', dest='shard_uris', default=[],
+                        help='Connection string of a dashboard userdb shard, repeat for every shard')
+    args = parser.parse_args(args)
+
+    am_conf = {'MONGO_URI': args.mongo_uri}
+    if args.shard_uris:
+        am_conf['DASHBOARD_AMP_SHARD_URIS'] = args.shard_uris
+    context = plugin_init(am_conf)
+    ok = True
+    for shard in context.shards:
+        ok = ensure_indexes(shard) and ok
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+Separate lanes for interactive and bulk sync work.
+
+Interactive syncs (a user just changed something in the dashboard) and bulk
+syncs (resyncs, batch fetches) run in different lanes. Every lane has its
+own limit on the number of concurrent database reads in the process, and its
+own database clients and thus connection pools, so bulk work can never use up
+the connections or concurrency that interactive syncs need.
+"""
+import threading
+from contextlib import contextmanager
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# Default settings of the bulk lane
+BULK_CONCURRENCY = 2
+BULK_POOL_OPTIONS = {
+    'maxPoolSize': 4,
+    # Also makes the bulk lane clients differ from the interactive ones, and shows in the server logs
+    'appName': 'eduid_dashboard_amp_bulk',
+}
+
+
+class Lane(object):
+    """
+    Concurrency limit and connection pool settings for one kind of work.
+    """
+
+    def __init__(self, name, concurrency=None, pool_options=None):
+        """
+        :param name: Lane name
+        :param concurrency: Maximum number of concurrent reads, None for no limit
+        :param pool_options: Connection pool options, overriding the context's
+
+        :type name: str
+        :type concurrency: int | None
+        :type pool_options: dict | None
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.pool_options = pool_options or {}
+        self._semaphore = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+    def __repr__(self):
+        return '<{} {} concurrency={}>'.format(self.__class__.__name__, self.name, self.concurrency)
+
+    @contextmanager
+    def slot(self):
+        """
+        Wait for a free slot in the lane, and hold it in the with block.
+        """
+        if self._semaphore is None:
+            yield
+            return
+        self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
@@ -0,0 +1,97 @@
+"""
+Structured debug logging for the fetch path.
+
+Debug messages in the fetch path are written through an EventLogger, which
+checks the log level (and the sample rate) before doing anything else, so
+that disabled debug logging costs one method call. The message is an event
+name followed by key=value fields, and is only formatted when a handler
+actually emits the record. Values of sensitive keys, like password salts and
+NINs, are redacted from the fields, both in the message and in the `fields'
+attribute of the record that structured handlers read.
+"""
+import logging
+import random
+
+# Keys whose values are never written to the log, at any depth
+SENSITIVE_KEYS = frozenset((
+    'salt',
+    'nins',
+    'norEduPersonNIN',
+    'letter_proofing_data',
+))
+
+REDACTED = '<redacted>'
+
+
+def redact(value):
+    """
+    Copy of value with the values of all SENSITIVE_KEYS replaced.
+
+    :param value: Data to log
+
+    :rtype: same as value
+    """
+    if isinstance(value, dict):
+        return dict((key, REDACTED if key in SENSITIVE_KEYS else redact(this)) for key, this in value.items())
+    if isinstance(value, (list, tuple)):
+        return [redact(this) for this in value]
+    return value
+
+
+class LogEvent(object):
+    """
+    Log message that is formatted when it is written.
+    """
+
+    def __init__(self, event, fields):
+        """
+        :param event: Event name
+        :param fields: Data about the event, already redacted
+
+        :type event: str
+        :type fields: dict
+        """
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.event] + ['{}={!r}'.format(key, value) for key, value in sorted(self.fields.items())])
+
+
+class EventLogger(object):
+    """
+    Level guarded, optionally sampled, structured logging of events.
+    """
+
+    def __init__(self, logger, sample_rate=1.0, rand=random.random):
+        """
+        :param logger: Logger to write to
+        :param sample_rate: Fraction of the enabled debug events to log
+        :param rand: Function returning a random float in [0, 1)
+
+        :type logger: logging.Logger
+        :type sample_rate: float
+        """
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self._rand = rand
+
+    def __repr__(self):
+        return '<{} {} sample_rate={}>'.format(self.__class__.__name__, self.logger.name, self.sample_rate)
+
+    def debug(self, event, **fields):
+        """
+        Log a debug event, if debug logging is enabled and the event is sampled.
+
+        Pass objects as field values rather than strings made from them, they
+        are only converted to strings if the event is written.
+
+        :param event: Event name
+        :param fields: Data about the event
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.sample_rate < 1.0 and self._rand() >= self.sample_rate:
+            return
+        fields = redact(fields)
+        self.logger.debug(LogEvent(event, fields), extra={'event': event, 'fields': fields})
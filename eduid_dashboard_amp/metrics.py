@@ -0,0 +1,296 @@
+"""
+Metrics for the attribute fetcher.
+
+The plugin reports counters, gauges and observations (latencies, sizes and
+other distributions) to a Metrics object in its context. Metrics keeps them
+in an in-process MetricsRegistry, that can be rendered in the Prometheus text
+format, and passes them on to any other sinks added to it, e.g. a
+StatsdSink. A sink is any object with the methods
+
+    incr(name, value, labels)
+    gauge(name, value, labels)
+    observe(name, value, labels)
+
+where labels is a tuple of (label, value) tuples.
+"""
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Monotonic clock where available (Python 3)
+clock = getattr(time, 'perf_counter', time.time)
+
+# Histogram bucket upper bounds, chosen by the suffix of the metric name
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (512, 1024, 2048, 4096, 8192, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 15, 20, 50)
+
+
+def buckets_for(name):
+    """
+    Histogram buckets for a metric, by the suffix of its name.
+
+    :type name: str
+
+    :rtype: tuple
+    """
+    if name.endswith('_seconds'):
+        return LATENCY_BUCKETS
+    if name.endswith('_bytes'):
+        return SIZE_BUCKETS
+    return COUNT_BUCKETS
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class MetricsRegistry(object):
+    """
+    In-process sink, keeping the totals of all metrics reported to it.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} counters={} histograms={}>'.format(
+            self.__class__.__name__, len(self._counters), len(self._histograms))
+
+    def incr(self, name, value=1, labels=()):
+        with self._lock:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, labels=()):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            key = (name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets_for(name))
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """
+        Current value of a counter.
+
+        :rtype: int | float
+        """
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauge_value(self, name, **labels):
+        """
+        Current value of a gauge, or None if it has not been set.
+
+        :rtype: int | float | None
+        """
+        return self._gauges.get((name, tuple(sorted(labels.items()))))
+
+    def histogram(self, name, **labels):
+        """
+        Number and sum of the observations of a metric.
+
+        :rtype: (int, int | float)
+        """
+        histogram = self._histograms.get((name, tuple(sorted(labels.items()))))
+        if histogram is None:
+            return 0, 0
+        return histogram.count, histogram.sum
+
+    def snapshot(self):
+        """
+        All metrics, e.g. to log or serialize as JSON.
+
+        :return: {'counters': {key: value}, 'gauges': {key: value},
+                  'histograms': {key: {'count': n, 'sum': s}}}
+                 where key is the name followed by any labels, as in statsd
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'counters': dict((_flat_name(name, labels), value)
+                                 for (name, labels), value in self._counters.items()),
+                'gauges': dict((_flat_name(name, labels), value) for (name, labels), value in self._gauges.items()),
+                'histograms': dict((_flat_name(name, labels), {'count': histogram.count, 'sum': histogram.sum})
+                                   for (name, labels), histogram in self._histograms.items()),
+            }
+
+    def prometheus_text(self, prefix='eduid_dashboard_amp'):
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        :param prefix: Prefix for the metric names
+
+        :type prefix: str
+
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(set(name for name, _labels in self._counters)):
+                lines.append('# TYPE {}_{} counter'.format(prefix, name))
+                for (this, labels), value in sorted(self._counters.items()):
+                    if this == name:
+                        lines.append('{}_{}{} {}'.format(prefix, name, _prometheus_labels(labels), value))
+            for name in sorted(set(name for name, _labels in self._gauges)):
+                lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+                for (this, labels), value in sorted(self._gauges.items()):
+                    if this == name:
+                        lines.append('{}_{}{} {}'.format(prefix, name, _prometheus_labels(labels), value))
+            for name in sorted(set(name for name, _labels in self._histograms)):
+                lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+                for (this, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if this != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append('{}_{}_bucket{} {}'.format(
+                            prefix, name, _prometheus_labels(labels + (('le', repr(float(bound))),)), cumulative))
+                    lines.append('{}_{}_bucket{} {}'.format(
+                        prefix, name, _prometheus_labels(labels + (('le', '+Inf'),)), histogram.count))
+                    lines.append('{}_{}_sum{} {}'.format(prefix, name, _prometheus_labels(labels), histogram.sum))
+                    lines.append('{}_{}_count{} {}'.format(prefix, name, _prometheus_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(object):
+    """
+    Send metrics to statsd over UDP.
+
+    Counters and gauges are sent as statsd counters and gauges, observations
+    of metrics ending in _seconds as timers in milliseconds and other
+    observations as histograms. Label values are appended to the metric name. Sending is best effort, errors are only
+    logged.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='eduid_dashboard_amp'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __repr__(self):
+        return '<{} {}:{} prefix={}>'.format(self.__class__.__name__, self.address[0], self.address[1], self.prefix)
+
+    def incr(self, name, value=1, labels=()):
+        self._send(name, labels, value, 'c')
+
+    def gauge(self, name, value, labels=()):
+        self._send(name, labels, value, 'g')
+
+    def observe(self, name, value, labels=()):
+        if name.endswith('_seconds'):
+            self._send(name, labels, value * 1000, 'ms')
+        else:
+            self._send(name, labels, value, 'h')
+
+    def _send(self, name, labels, value, kind):
+        line = '{}.{}:{}|{}'.format(self.prefix, _flat_name(name, labels), value, kind)
+        try:
+            self._socket.sendto(line.encode('ascii'), self.address)
+        except (socket.error, UnicodeError) as exc:
+            logger.debug('Could not send metric {!r} to statsd: {!s}'.format(line, exc))
+
+
+class Metrics(object):
+    """
+    Report metrics to the in-process registry and any other sinks.
+    """
+
+    def __init__(self, sinks=()):
+        """
+        :param sinks: Sinks to report to, in addition to the registry
+
+        :type sinks: iterable
+        """
+        self.registry = MetricsRegistry()
+        self.sinks = [self.registry] + list(sinks)
+
+    def __repr__(self):
+        return '<{} sinks={!r}>'.format(self.__class__.__name__, self.sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def incr(self, name, value=1, **labels):
+        """
+        Increment a counter.
+
+        :param name: Metric name
+        :param value: Increment
+        :param labels: Labels of the counter, e.g. type='UserDoesNotExist'
+        """
+        labels = tuple(sorted(labels.items()))
+        for sink in self.sinks:
+            sink.incr(name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        """
+        Set a gauge.
+
+        :param name: Metric name
+        :param value: Current value
+        :param labels: Labels of the gauge
+        """
+        labels = tuple(sorted(labels.items()))
+        for sink in self.sinks:
+            sink.gauge(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Record an observation of a distribution, e.g. a latency in seconds.
+
+        :param name: Metric name, ending in _seconds for latencies and _bytes for sizes
+        :param value: Observed value
+        :param labels: Labels of the metric
+        """
+        labels = tuple(sorted(labels.items()))
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the number of seconds spent in a with block.
+        """
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(name, clock() - start, **labels)
+
+
+def _flat_name(name, labels):
+    return '.'.join([name] + [str(value) for _label, value in labels])
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for label, value in labels) + '}'
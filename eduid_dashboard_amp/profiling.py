@@ -0,0 +1,183 @@
+"""
+Sampling profiler for attribute_fetcher calls in live workers.
+
+A fraction of the calls are run under cProfile, or tracemalloc (Python 3.4+)
+to see where memory is allocated. The profiles are aggregated in memory and
+written to a local directory at the end of every rotation interval, one file
+per worker process and interval:
+
+  cprofile    - attribute_fetcher-<time>-<pid>.prof, load with pstats or
+                e.g. snakeviz
+  tracemalloc - attribute_fetcher-<time>-<pid>.tracemalloc.txt, the source
+                lines that allocated the most memory
+
+Only the newest files are kept. Profiling is enabled with
+DASHBOARD_AMP_PROFILE_DIR, see plugin_init().
+"""
+import cProfile
+import glob
+import os
+import pstats
+import random
+import threading
+import time
+from datetime import datetime
+
+from celery.utils.log import get_task_logger
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+logger = get_task_logger(__name__)
+
+MODES = ('cprofile', 'tracemalloc')
+
+# Number of source lines written per tracemalloc profile
+TRACEMALLOC_TOP = 50
+
+
+class Profiler(object):
+    """
+    Profile a sampled fraction of calls, see the module docstring.
+
+    At most one call at a time is profiled in a process, sampled calls made
+    while another one is being profiled run without profiling.
+    """
+
+    def __init__(self, directory, sample_rate=0.01, mode='cprofile', interval=3600, keep=48,
+                 rand=random.random, timer=time.time):
+        """
+        :param directory: Where to write the profiles
+        :param sample_rate: Fraction of the calls to profile
+        :param mode: 'cprofile' or 'tracemalloc'
+        :param interval: Seconds between writing the aggregated profile
+        :param keep: Number of profile files to keep in directory
+        :param rand: Function returning a random float in [0, 1)
+        :param timer: Function returning the current time in seconds
+
+        :type directory: str
+        :type sample_rate: float
+        :type mode: str
+        :type interval: float
+        :type keep: int
+        """
+        if mode not in MODES:
+            raise ValueError('Unknown profiler mode {!r}, use one of {!r}'.format(mode, MODES))
+        if mode == 'tracemalloc' and tracemalloc is None:
+            raise ValueError('The tracemalloc profiler mode requires Python 3.4+')
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.interval = interval
+        self.keep = keep
+        self.profiled = 0
+        self._rand = rand
+        self._timer = timer
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        self._stats = None
+        self._allocations = {}
+        self._started = timer()
+
+    def __repr__(self):
+        return '<{} {} mode={} sample_rate={} profiled={}>'.format(
+            self.__class__.__name__, self.directory, self.mode, self.sample_rate, self.profiled)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), profiling it if it is sampled.
+
+        :return: The result of the call
+        """
+        if self._rand() >= self.sample_rate or not self._busy.acquire(False):
+            return func(*args, **kwargs)
+        try:
+            if self.mode == 'cprofile':
+                return self._call_cprofile(func, *args, **kwargs)
+            return self._call_tracemalloc(func, *args, **kwargs)
+        finally:
+            self._busy.release()
+            if self._timer() - self._started >= self.interval:
+                self.flush()
+
+    def _call_cprofile(self, func, *args, **kwargs):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.profiled += 1
+
+    def _call_tracemalloc(self, func, *args, **kwargs):
+        if tracemalloc.is_tracing():
+            # Someone else is using tracemalloc, don't interfere
+            return func(*args, **kwargs)
+        tracemalloc.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            with self._lock:
+                for stat in snapshot.statistics('lineno'):
+                    key = str(stat.traceback)
+                    size, count = self._allocations.get(key, (0, 0))
+                    self._allocations[key] = (size + stat.size, count + stat.count)
+                self.profiled += 1
+
+    def flush(self):
+        """
+        Write the aggregated profile of the current interval, and start a new interval.
+
+        :return: Name of the written file, or None if nothing was profiled
+        :rtype: str | None
+        """
+        with self._lock:
+            stats, allocations = self._stats, self._allocations
+            self._stats, self._allocations = None, {}
+            started, self._started = self._started, self._timer()
+        if stats is None and not allocations:
+            return None
+
+        prefix = os.path.join(self.directory, 'attribute_fetcher-{}-{}'.format(
+            datetime.utcfromtimestamp(started).strftime('%Y%m%dT%H%M%S'), os.getpid()))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            if stats is not None:
+                filename = prefix + '.prof'
+                stats.dump_stats(filename)
+            else:
+                filename = prefix + '.tracemalloc.txt'
+                top = sorted(allocations.items(), key=lambda item: item[1][0], reverse=True)[:TRACEMALLOC_TOP]
+                with open(filename, 'w') as fd:
+                    for line, (size, count) in top:
+                        fd.write('{}: size={} B, count={}\n'.format(line, size, count))
+            self._rotate()
+        except (IOError, OSError) as exc:
+            logger.error('Could not write profile to {!s}: {!s}'.format(self.directory, exc))
+            return None
+        logger.info('Wrote profile {!s}'.format(filename))
+        return filename
+
+    def _rotate(self):
+        """
+        Remove all but the newest `keep' profile files.
+        """
+        files = glob.glob(os.path.join(self.directory, 'attribute_fetcher-*'))
+        for filename in sorted(files, key=os.path.getmtime, reverse=True)[self.keep:]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # Removed by another worker
+                pass
@@ -0,0 +1,190 @@
+"""
+Fast path building the update dict straight from a raw dashboard document.
+
+The normal path creates a DashboardUser from the document, only to convert
+it straight back to a dict in the new userdb format. This module does the
+conversion of the white listed attributes directly on the document, for the
+document shapes it knows about. Anything it does not recognise raises
+UnsupportedDocument, and the caller falls back to the normal path, which
+also does all the validation of unusual data.
+"""
+from datetime import datetime
+
+from eduid_userdb.util import UTC
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Attributes that need no conversion from the old userdb format
+COPY_ATTRS = (
+    'givenName',
+    'displayName',
+    'preferredLanguage',
+    'eduPersonEntitlement',
+    'letter_proofing_data',
+)
+
+# Keys of list elements that are the same in the old and new userdb format
+ELEMENT_KEYS = frozenset(('verified', 'primary', 'created_by', 'created_ts', 'verified_by', 'verified_ts'))
+
+
+class UnsupportedDocument(Exception):
+    """
+    The document has data that the fast path does not know how to convert.
+    """
+    pass
+
+
+def document_to_dict(doc):
+    """
+    Convert the white listed attributes of a dashboard userdb document to the new userdb format.
+
+    The caller must have checked the document for unknown top level keys.
+
+    :param doc: Dashboard userdb document
+
+    :type doc: dict
+
+    :return: the attributes user.to_dict(old_userdb_format=False) would return
+    :rtype: dict
+
+    :raises UnsupportedDocument: if the normal path has to be used
+    """
+    if '_id' not in doc or not doc.get('eduPersonPrincipalName') or 'revoked_ts' in doc:
+        raise UnsupportedDocument('Missing or revoked user')
+
+    res = dict((attr, doc[attr]) for attr in COPY_ATTRS if attr in doc)
+    res['surname'] = _surname(doc)
+    res['mailAliases'] = _mail_addresses(doc)
+    phone = _phone_numbers(doc)
+    if phone:
+        res['phone'] = phone
+    res['nins'] = _nins(doc)
+    res['passwords'] = _passwords(doc)
+    res['terminated'] = _terminated(doc)
+    return res
+
+
+def _surname(doc):
+    if 'sn' in doc and 'surname' in doc:
+        raise UnsupportedDocument('Both sn and surname')
+    return doc.get('surname', doc.get('sn', ''))
+
+
+def _elements(doc, attr, key, old_key=None):
+    """
+    Convert a list of elements, renaming old_key to key and added_timestamp to created_ts.
+    """
+    elements = doc.get(attr)
+    if not isinstance(elements, list):
+        raise UnsupportedDocument('{} is not a list'.format(attr))
+    allowed = ELEMENT_KEYS | set((key, old_key or key, 'added_timestamp'))
+    res = []
+    for element in elements:
+        if not isinstance(element, dict) or not allowed.issuperset(element) or 'verified' not in element:
+            raise UnsupportedDocument('Unknown {} element'.format(attr))
+        this = dict((k, v) for k, v in element.items() if k in ELEMENT_KEYS)
+        if old_key is not None and old_key in element:
+            if key in element:
+                raise UnsupportedDocument('Both {} and {} in {} element'.format(key, old_key, attr))
+            this[key] = element[old_key]
+        elif key in element:
+            this[key] = element[key]
+        else:
+            raise UnsupportedDocument('No {} in {} element'.format(key, attr))
+        if 'added_timestamp' in element:
+            if 'created_ts' in element:
+                raise UnsupportedDocument('Both created_ts and added_timestamp in {} element'.format(attr))
+            this['created_ts'] = element['added_timestamp']
+        res.append(this)
+    return res
+
+
+def _check_primary(elements, attr):
+    """
+    Make sure there is exactly one primary element, and that it is verified.
+    """
+    if not elements:
+        return
+    primary = [this for this in elements if this.get('primary')]
+    if len(primary) != 1 or primary[0]['verified'] is not True or \
+            any(not isinstance(this.get('primary'), bool) for this in elements):
+        raise UnsupportedDocument('Unexpected primary {}'.format(attr))
+
+
+def _mail_addresses(doc):
+    if 'mailAliases' not in doc:
+        raise UnsupportedDocument('No mailAliases')
+    res = _elements(doc, 'mailAliases', 'email')
+    if 'mail' in doc:
+        # Old format, the primary address is in `mail'
+        if any('primary' in this for this in res) or doc['mail'] not in [this['email'] for this in res]:
+            raise UnsupportedDocument('Unexpected mail')
+        for this in res:
+            this['primary'] = this['email'] == doc['mail']
+    _check_primary(res, 'mailAliases')
+    return res
+
+
+def _phone_numbers(doc):
+    if 'mobile' in doc and 'phone' in doc:
+        raise UnsupportedDocument('Both mobile and phone')
+    if 'mobile' in doc:
+        res = _elements(doc, 'mobile', 'number', old_key='mobile')
+    elif 'phone' in doc:
+        res = _elements(doc, 'phone', 'number')
+    else:
+        return []
+    _check_primary(res, 'phone')
+    return res
+
+
+def _nins(doc):
+    if 'norEduPersonNIN' in doc and 'nins' in doc:
+        raise UnsupportedDocument('Both norEduPersonNIN and nins')
+    if 'norEduPersonNIN' in doc:
+        nins = doc['norEduPersonNIN']
+        if not isinstance(nins, list) or not all(isinstance(nin, string_types) for nin in nins):
+            raise UnsupportedDocument('Unknown norEduPersonNIN')
+        return [{'number': nin, 'verified': True, 'primary': i == 0} for i, nin in enumerate(nins)]
+    if 'nins' not in doc:
+        return []
+    res = _elements(doc, 'nins', 'number')
+    _check_primary(res, 'nins')
+    return res
+
+
+def _passwords(doc):
+    passwords = doc.get('passwords')
+    if not isinstance(passwords, list) or not passwords:
+        raise UnsupportedDocument('No passwords')
+    res = []
+    for password in passwords:
+        if not isinstance(password, dict) or \
+                not set(('id', 'credential_id', 'salt', 'source', 'created_by', 'created_ts')).issuperset(password):
+            raise UnsupportedDocument('Unknown password')
+        if ('id' in password) == ('credential_id' in password) or ('source' in password and 'created_by' in password):
+            raise UnsupportedDocument('Unexpected password')
+        this = {
+            'credential_id': str(password.get('id', password.get('credential_id'))),
+            'salt': password.get('salt'),
+        }
+        if 'source' in password or 'created_by' in password:
+            this['created_by'] = password.get('source', password.get('created_by'))
+        if 'created_ts' in password:
+            this['created_ts'] = password['created_ts']
+        res.append(this)
+    return res
+
+
+def _terminated(doc):
+    terminated = doc.get('terminated', False)
+    if terminated is True:
+        return datetime.now(tz=UTC())
+    if terminated is False or terminated is None:
+        return False
+    if isinstance(terminated, datetime):
+        return terminated
+    raise UnsupportedDocument('Unknown terminated')
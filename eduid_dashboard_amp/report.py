@@ -0,0 +1,109 @@
+"""
+Dry run report of what a full resync would change in the central userdb.
+
+Every user in the Dashboard private userdb is run through the attribute
+fetcher logic and compared with the user's document in the central userdb,
+and the number of users and attributes that would change are counted.
+Nothing is written to any database.
+
+The users are streamed from the database and compared in batches, and only
+counters are kept, so memory use does not grow with the number of users.
+"""
+import argparse
+import json
+import sys
+import time
+from collections import defaultdict
+from itertools import islice
+
+from eduid_userdb.exceptions import EduIDUserDBError
+from celery.utils.log import get_task_logger
+
+from eduid_dashboard_amp import BATCH_SIZE, PROJECTION_ATTRS, attributes_delta, plugin_init
+from eduid_dashboard_amp import _document_to_attributes, _find_documents
+from eduid_dashboard_amp.lanes import BULK
+
+logger = get_task_logger(__name__)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def dry_run_report(context, batch_size=BATCH_SIZE, report_interval=60.0):
+    """
+    Count the changes a full resync would make to the central userdb.
+
+    :param context: Plugin context, see plugin_init.
+    :param batch_size: Number of users compared per central userdb query
+    :param report_interval: Seconds between progress log messages
+
+    :type context: eduid_dashboard_amp.DashboardAMPContext
+    :type batch_size: int
+    :type report_interval: float
+
+    :return: Counters, see the code
+    :rtype: dict
+    """
+    context = context.for_lane(BULK)
+    report = {
+        'users': 0,
+        'unchanged_users': 0,
+        'changed_users': 0,
+        'new_users': 0,
+        'errors': defaultdict(int),
+        'set': defaultdict(int),
+        'unset': defaultdict(int),
+    }
+    central = context.central_userdb._coll
+    started = last_report = time.time()
+    # Nothing is written, so reading from a secondary is fine if the context allows it
+    for docs in _batches(_find_documents(context, {}, secondary=True), batch_size):
+        central_docs = dict((doc['_id'], doc) for doc in
+                            central.find({'_id': {'$in': [doc['_id'] for doc in docs]}}, PROJECTION_ATTRS))
+        for doc in docs:
+            report['users'] += 1
+            try:
+                attributes = _document_to_attributes(context, doc)
+            except EduIDUserDBError as exc:
+                # e.g. unknown data, or a revoked user
+                report['errors'][exc.__class__.__name__] += 1
+                continue
+            central_doc = central_docs.get(doc['_id'])
+            if central_doc is None:
+                report['new_users'] += 1
+                continue
+            delta = attributes_delta(attributes, central_doc)
+            if not delta:
+                report['unchanged_users'] += 1
+                continue
+            report['changed_users'] += 1
+            for attr in delta.get('$set', {}):
+                report['set'][attr] += 1
+            for attr in delta.get('$unset', {}):
+                report['unset'][attr] += 1
+
+        if time.time() - last_report >= report_interval:
+            last_report = time.time()
+            logger.info('Dry run: {} users compared, {:.1f} users/s'.format(
+                report['users'], report['users'] / (last_report - started)))
+
+    for key in ('errors', 'set', 'unset'):
+        report[key] = dict(report[key])
+    return report
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Report what a full resync of the eduID Dashboard userdb '
+                                                 'would change in the central userdb, without writing anything')
+    parser.add_argument('--mongo-uri', required=True, help='MongoDB connection string')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Users per central userdb query')
+    args = parser.parse_args(args)
+
+    context = plugin_init({'MONGO_URI': args.mongo_uri})
+    json.dump(dry_run_report(context, batch_size=args.batch_size), sys.stdout, indent=2, sort_keys=True)
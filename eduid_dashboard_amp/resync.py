@@ -0,0 +1,219 @@
+"""
+Resync all users in the Dashboard private userdb to the central userdb.
+
+The users are split into ranges of ObjectId, and the ranges are synced in
+parallel by a pool of worker processes, each with its own plugin context.
+The progress of every range is checkpointed in the dashboard database, so an
+interrupted resync continues where it stopped when started again with the
+same run name. The ranges are only resumed once all of them have been saved,
+which is marked by a "<run name>:planned" document.
+
+Users that eduid_userdb rejects, e.g. revoked users, are counted as failed
+and skipped.
+"""
+import argparse
+import multiprocessing
+import time
+
+import bson
+import pymongo
+from celery.utils.log import get_task_logger
+
+from eduid_dashboard_amp import BATCH_SIZE, plugin_init
+from eduid_dashboard_amp import _find_documents
+from eduid_dashboard_amp.lanes import BULK
+from eduid_dashboard_amp.sync import push_updates
+
+logger = get_task_logger(__name__)
+
+# Collection in the dashboard database where the resync saves its progress
+CHECKPOINT_COLLECTION = 'amp_resync_checkpoints'
+
+# Number of ranges per worker process, to even out ranges with more users
+RANGES_PER_PROCESS = 4
+
+# The plugin context of a worker process
+_worker_context = None
+
+
+def object_id_ranges(collection, count):
+    """
+    Split the documents in collection into ranges of _id, by creation time.
+
+    :param collection: Collection with ObjectId _id, or a list of collections (shards)
+    :param count: Number of ranges
+
+    :type collection: pymongo.collection.Collection | list
+    :type count: int
+
+    :return: (lower, upper) tuples, lower inclusive and upper exclusive. None means unbounded.
+    :rtype: list
+    """
+    collections = collection if isinstance(collection, (list, tuple)) else [collection]
+    firsts = [this.find_one({}, {'_id': 1}, sort=[('_id', pymongo.ASCENDING)]) for this in collections]
+    lasts = [this.find_one({}, {'_id': 1}, sort=[('_id', pymongo.DESCENDING)]) for this in collections]
+    firsts = [doc for doc in firsts if doc is not None]
+    if not firsts:
+        return []
+    first = min(firsts, key=lambda doc: doc['_id'])
+    last = max([doc for doc in lasts if doc is not None], key=lambda doc: doc['_id'])
+    start = first['_id'].generation_time
+    step = (last['_id'].generation_time - start) / count
+    boundaries = [bson.ObjectId.from_datetime(start + step * i) for i in range(1, count)]
+    boundaries = sorted(set(boundary for boundary in boundaries if boundary > first['_id']))
+    lowers = [None] + boundaries
+    uppers = boundaries + [None]
+    return list(zip(lowers, uppers))
+
+
+def _checkpoints(context):
+    return context.dashboard_userdb._coll.database[CHECKPOINT_COLLECTION]
+
+
+def resync_range(context, checkpoint_id, batch_size=BATCH_SIZE):
+    """
+    Resync all users in one range, starting after the last checkpointed user.
+
+    :param context: Plugin context, see plugin_init.
+    :param checkpoint_id: _id of the range's checkpoint document
+    :param batch_size: Number of users per read and bulk write
+
+    :type context: eduid_dashboard_amp.DashboardAMPContext
+    :type checkpoint_id: str
+    :type batch_size: int
+
+    :return: The final checkpoint document
+    :rtype: dict
+    """
+    context = context.for_lane(BULK)
+    checkpoints = _checkpoints(context)
+    checkpoint = checkpoints.find_one({'_id': checkpoint_id})
+    started = time.time()
+    synced_before = checkpoint.get('synced', 0)
+    while not checkpoint.get('done'):
+        spec = {}
+        lower = checkpoint.get('last_id') or checkpoint['lower']
+        if lower is not None:
+            spec['$gt' if checkpoint.get('last_id') else '$gte'] = lower
+        if checkpoint['upper'] is not None:
+            spec['$lt'] = checkpoint['upper']
+        with context.lane.slot():
+            docs = list(_find_documents(context, {'_id': spec} if spec else {},
+                                        sort=[('_id', pymongo.ASCENDING)], limit=batch_size))
+            synced, failed = push_updates(context, docs) if docs else (0, 0)
+        update = {'$set': {'done': len(docs) < batch_size}, '$inc': {'synced': synced, 'failed': failed}}
+        if docs:
+            update['$set']['last_id'] = docs[-1]['_id']
+        checkpoint = checkpoints.find_one_and_update({'_id': checkpoint_id}, update,
+                                                     return_document=pymongo.ReturnDocument.AFTER)
+        elapsed = time.time() - started
+        logger.info('Resync {}: {} users synced, {} failed, {:.1f} users/s'.format(
+            checkpoint_id, checkpoint['synced'], checkpoint['failed'],
+            (checkpoint['synced'] - synced_before) / elapsed if elapsed else 0))
+    return checkpoint
+
+
+def _init_worker(am_conf):
+    global _worker_context
+    _worker_context = plugin_init(am_conf)
+
+
+def _resync_range_worker(args):
+    checkpoint_id, batch_size = args
+    return resync_range(_worker_context, checkpoint_id, batch_size)
+
+
+def full_resync(am_conf, run_name='full_resync', processes=None, batch_size=BATCH_SIZE, report_interval=10.0):
+    """
+    Resync every user in the Dashboard private userdb to the central userdb.
+
+    Starting a resync with the run name of an interrupted one resumes it.
+    Use a new run name to resync everything again.
+
+    :param am_conf: Attribute Manager configuration data, see plugin_init.
+    :param run_name: Name of this resync, used for the checkpoints
+    :param processes: Number of worker processes (default: number of CPUs)
+    :param batch_size: Number of users per read and bulk write
+    :param report_interval: Seconds between progress reports
+
+    :type am_conf: dict
+    :type run_name: str
+    :type processes: int | None
+    :type batch_size: int
+    :type report_interval: float
+
+    :return: Number of users synced and failed
+    :rtype: (int, int)
+    """
+    processes = processes or multiprocessing.cpu_count()
+    context = plugin_init(am_conf).for_lane(BULK)
+    checkpoints = _checkpoints(context)
+
+    planned_id = '{}:planned'.format(run_name)
+    if checkpoints.find_one({'_id': planned_id}) is not None:
+        logger.info('Resuming resync {!r}'.format(run_name))
+    else:
+        # Nothing has been synced before the plan is complete, so an incomplete plan is thrown away
+        checkpoints.delete_many({'run': run_name})
+        collections = [shard.dashboard_userdb._coll for shard in context.shards]
+        planned = [{
+            '_id': '{}:{:04d}'.format(run_name, index),
+            'run': run_name,
+            'lower': lower,
+            'upper': upper,
+            'last_id': None,
+            'done': False,
+            'synced': 0,
+            'failed': 0,
+        } for index, (lower, upper) in enumerate(object_id_ranges(collections, processes * RANGES_PER_PROCESS))]
+        if planned:
+            checkpoints.insert_many(planned)
+        checkpoints.insert_one({'_id': planned_id, 'ranges': len(planned)})
+    ranges = list(checkpoints.find({'run': run_name}, sort=[('_id', pymongo.ASCENDING)]))
+
+    todo = [(checkpoint['_id'], batch_size) for checkpoint in ranges if not checkpoint['done']]
+    logger.info('Resync {!r}: {} of {} ranges to sync with {} processes'.format(
+        run_name, len(todo), len(ranges), processes))
+
+    def _totals():
+        totals = list(checkpoints.aggregate([
+            {'$match': {'run': run_name}},
+            {'$group': {'_id': None, 'synced': {'$sum': '$synced'}, 'failed': {'$sum': '$failed'}}},
+        ]))
+        if not totals:
+            return 0, 0
+        return totals[0]['synced'], totals[0]['failed']
+
+    started = time.time()
+    synced_before, _ = _totals()
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(am_conf,))
+    try:
+        result = pool.map_async(_resync_range_worker, todo, chunksize=1)
+        while not result.ready():
+            result.wait(report_interval)
+            synced, failed = _totals()
+            logger.info('Resync {!r}: {} users synced, {} failed, {:.1f} users/s'.format(
+                run_name, synced, failed, (synced - synced_before) / (time.time() - started)))
+        result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    synced, failed = _totals()
+    logger.info('Resync {!r} done: {} users synced, {} failed in {:.1f} s'.format(
+        run_name, synced, failed, time.time() - started))
+    return synced, failed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Resync all eduID Dashboard users to the central userdb')
+    parser.add_argument('--mongo-uri', required=True, help='MongoDB connection string')
+    parser.add_argument('--run-name', default='full_resync', help='Name of the resync, reuse to resume')
+    parser.add_argument('--processes', type=int, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Users per read and bulk write')
+    args = parser.parse_args(args)
+
+    synced, failed = full_resync({'MONGO_URI': args.mongo_uri}, run_name=args.run_name,
+                                 processes=args.processes, batch_size=args.batch_size)
+    print('{} users synced, {} failed'.format(synced, failed))
+    return 1 if failed else 0
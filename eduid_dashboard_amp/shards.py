@@ -0,0 +1,103 @@
+"""
+Routing of users to dashboard userdb shards.
+
+When the Dashboard private userdb is split over several databases (e.g.
+replica sets), a router decides deterministically which one a user is in.
+Every shard must hold the same database and collection as MONGO_URI.
+
+  HashRouter  - by a hash of the user id, spreading users evenly
+  RangeRouter - by ObjectId ranges, i.e. by the time the user was created
+"""
+import bisect
+import hashlib
+
+import bson
+
+ROUTERS = ('hash', 'range')
+
+
+class HashRouter(object):
+    """
+    Route users by a hash of the user id.
+    """
+
+    def __init__(self, count):
+        """
+        :param count: Number of shards
+
+        :type count: int
+        """
+        self.count = count
+
+    def __repr__(self):
+        return '<{} count={}>'.format(self.__class__.__name__, self.count)
+
+    def shard(self, user_id):
+        """
+        :param user_id: Unique identifier
+
+        :type user_id: ObjectId | str
+
+        :return: Index of the user's shard
+        :rtype: int
+        """
+        return int(hashlib.md5(str(user_id).encode('ascii', 'replace')).hexdigest(), 16) % self.count
+
+
+class RangeRouter(object):
+    """
+    Route users by ranges of ObjectId.
+    """
+
+    def __init__(self, boundaries):
+        """
+        :param boundaries: Lowest user id of every shard but the first, in increasing order
+
+        :type boundaries: list of ObjectId | str
+        """
+        self.boundaries = [bson.ObjectId(boundary) for boundary in boundaries]
+        if self.boundaries != sorted(self.boundaries):
+            raise ValueError('Shard boundaries must be in increasing order')
+        self.count = len(self.boundaries) + 1
+
+    def __repr__(self):
+        return '<{} count={}>'.format(self.__class__.__name__, self.count)
+
+    def shard(self, user_id):
+        """
+        :param user_id: Unique identifier
+
+        :type user_id: ObjectId | str
+
+        :return: Index of the user's shard
+        :rtype: int
+        """
+        try:
+            user_id = bson.ObjectId(user_id)
+        except (bson.errors.InvalidId, TypeError):
+            # Not found in any shard, so look in the first
+            return 0
+        return bisect.bisect_right(self.boundaries, user_id)
+
+
+def make_router(am_conf, count):
+    """
+    Create the router configured in the Attribute Manager configuration.
+
+    :param am_conf: Attribute Manager configuration data, see plugin_init().
+    :param count: Number of shards
+
+    :type am_conf: dict
+    :type count: int
+
+    :rtype: HashRouter | RangeRouter
+    """
+    name = am_conf.get('DASHBOARD_AMP_SHARD_ROUTER', 'hash')
+    if name == 'hash':
+        return HashRouter(count)
+    if name == 'range':
+        router = RangeRouter(am_conf.get('DASHBOARD_AMP_SHARD_BOUNDARIES', []))
+        if router.count != count:
+            raise ValueError('{} shard boundaries given for {} shards'.format(len(router.boundaries), count))
+        return router
+    raise ValueError('Unknown shard router {!r}, use one of {!r}'.format(name, ROUTERS))
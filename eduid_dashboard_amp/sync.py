@@ -0,0 +1,263 @@
+"""
+Long running sync engine for the Dashboard private userdb.
+
+Instead of one Celery task per changed user, the engine follows the changes
+in the dashboard userdb collection and pushes the resulting updates to the
+central userdb in batches. Changes are read from a change stream when the
+database supports it (replica set, MongoDB 3.6+), and otherwise by polling
+for documents with a newer `modified_ts'. Progress is checkpointed after
+every batch, so a restarted engine continues where it stopped.
+
+Change streams need pymongo 3.8+ (ChangeStream.try_next).
+"""
+import argparse
+import time
+import threading
+from collections import OrderedDict
+
+import pymongo
+from pymongo.errors import OperationFailure
+from eduid_userdb.exceptions import EduIDUserDBError
+from celery.utils.log import get_task_logger
+
+from eduid_dashboard_amp import BATCH_SIZE, apply_operations, plugin_init, update_operation
+from eduid_dashboard_amp import _document_to_attributes, _find_documents
+
+logger = get_task_logger(__name__)
+
+# Collection in the dashboard database where the engine saves its progress
+CHECKPOINT_COLLECTION = 'amp_sync_checkpoints'
+
+# Error codes for "change streams not supported by this server/topology"
+CHANGE_STREAM_UNSUPPORTED = (
+    40324,  # Unrecognized pipeline stage name: '$changeStream'
+    40573,  # The $changeStream stage is only supported on replica sets
+)
+
+
+class SyncEngine(object):
+    """
+    Follow changes in the Dashboard private userdb and apply them to the central userdb.
+    """
+
+    def __init__(self, context, name='eduid_dashboard', batch_size=BATCH_SIZE, max_wait=1.0,
+                 poll_interval=5.0, checkpoint_collection=CHECKPOINT_COLLECTION):
+        """
+        :param context: Plugin context, see plugin_init.
+        :param name: Name of the checkpoint, one per engine
+        :param batch_size: Maximum number of users per bulk write
+        :param max_wait: Maximum number of seconds a change waits to be written
+        :param poll_interval: Seconds between polls when change streams are not supported
+        :param checkpoint_collection: Collection to save the checkpoint in
+
+        :type context: eduid_dashboard_amp.DashboardAMPContext
+        :type name: str
+        :type batch_size: int
+        :type max_wait: float
+        :type poll_interval: float
+        :type checkpoint_collection: str
+        """
+        if context.shard_uris and context.shard is None:
+            raise ValueError('Run one engine per shard, with context.for_shard()')
+        self.context = context
+        self.name = name
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._checkpoint_collection = checkpoint_collection
+        self.synced = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return '<{} name={!r} synced={} failed={}>'.format(
+            self.__class__.__name__, self.name, self.synced, self.failed)
+
+    @property
+    def checkpoints(self):
+        """
+        :rtype: pymongo.collection.Collection
+        """
+        return self.context.dashboard_userdb._coll.database[self._checkpoint_collection]
+
+    def load_checkpoint(self):
+        """
+        :return: The saved checkpoint, or an empty dict
+        :rtype: dict
+        """
+        return self.checkpoints.find_one({'_id': self.name}) or {}
+
+    def save_checkpoint(self, **kwargs):
+        """
+        Save the current position, e.g. resume_token or modified_ts.
+        """
+        self.checkpoints.update_one({'_id': self.name}, {'$set': kwargs}, upsert=True)
+
+    def run(self, stop=None):
+        """
+        Sync changes until stop is set.
+
+        :param stop: Event to stop the engine
+
+        :type stop: threading.Event | None
+        """
+        if stop is None:
+            stop = threading.Event()
+        try:
+            self.watch(stop)
+        except OperationFailure as exc:
+            if exc.code not in CHANGE_STREAM_UNSUPPORTED:
+                raise
+            logger.info('Change streams not supported ({!s}), polling modified_ts instead'.format(exc))
+            self.poll(stop)
+
+    def watch(self, stop):
+        """
+        Sync changes read from a change stream on the dashboard userdb collection.
+
+        :type stop: threading.Event
+        """
+        checkpoint = self.load_checkpoint()
+        collection = self.context.dashboard_userdb._coll
+        kwargs = {
+            'full_document': 'updateLookup',
+            'max_await_time_ms': int(self.max_wait * 1000),
+        }
+        if checkpoint.get('resume_token'):
+            kwargs['resume_after'] = checkpoint['resume_token']
+
+        with collection.watch([{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}],
+                              **kwargs) as stream:
+            logger.info('{!r} watching {!s}'.format(self, collection.full_name))
+            docs = OrderedDict()
+            resume_token = None
+            started = None
+            while not stop.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    resume_token = change['_id']
+                    if change.get('fullDocument') is not None:
+                        # only the latest version of a user in a batch needs to be synced
+                        docs.pop(change['documentKey']['_id'], None)
+                        docs[change['documentKey']['_id']] = change['fullDocument']
+                    if started is None:
+                        started = time.time()
+                    if len(docs) < self.batch_size and time.time() - started < self.max_wait:
+                        continue
+                if resume_token is not None:
+                    self.push(docs.values())
+                    self.save_checkpoint(resume_token=resume_token)
+                    docs = OrderedDict()
+                    resume_token = None
+                    started = None
+
+    def poll(self, stop):
+        """
+        Sync users with a modified_ts newer than the checkpoint, at regular intervals.
+
+        :type stop: threading.Event
+        """
+        while not stop.is_set():
+            if self.poll_once() < self.batch_size:
+                # Caught up, wait for more changes
+                stop.wait(self.poll_interval)
+
+    def poll_once(self):
+        """
+        Sync the next batch of users ordered by modified_ts and save the checkpoint.
+
+        The checkpoint holds the highest modified_ts synced, and the ids of the
+        users synced with exactly that modified_ts. More users might be saved
+        with the same timestamp after this poll, so the next poll starts at
+        that timestamp and skips only the users already synced.
+
+        :return: Number of users synced
+        :rtype: int
+        """
+        checkpoint = self.load_checkpoint()
+        watermark = checkpoint.get('modified_ts')
+        seen = set(checkpoint.get('seen_ids', []))
+        if watermark is None:
+            spec = {'modified_ts': {'$exists': True}}
+        else:
+            spec = {'$or': [
+                {'modified_ts': {'$gt': watermark}},
+                {'modified_ts': watermark, '_id': {'$nin': list(seen)}},
+            ]}
+        docs = list(_find_documents(self.context, spec,
+                                    sort=[('modified_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+                                    limit=self.batch_size))
+        if not docs:
+            return 0
+
+        self.push(docs)
+        if docs[-1]['modified_ts'] != watermark:
+            watermark = docs[-1]['modified_ts']
+            seen = set()
+        seen.update(doc['_id'] for doc in docs if doc['modified_ts'] == watermark)
+        self.save_checkpoint(modified_ts=watermark, seen_ids=list(seen))
+        return len(docs)
+
+    def push(self, docs):
+        """
+        Apply the updates for some dashboard userdb documents to the central userdb.
+
+        :param docs: Dashboard userdb documents
+
+        :type docs: iterable of dict
+        """
+        synced, failed = push_updates(self.context, docs)
+        self.synced += synced
+        self.failed += failed
+        logger.debug('{!r} pushed {} users'.format(self, synced + failed))
+
+
+def push_updates(context, docs):
+    """
+    Apply the updates for some dashboard userdb documents to the central userdb,
+    with unordered bulk writes.
+
+    Users that eduid_userdb rejects are logged and counted as failed.
+
+    :param context: Plugin context, see plugin_init.
+    :param docs: Dashboard userdb documents
+
+    :type context: eduid_dashboard_amp.DashboardAMPContext
+    :type docs: iterable of dict
+
+    :return: Number of users synced and failed
+    :rtype: (int, int)
+    """
+    operations = []
+    for doc in docs:
+        try:
+            operations.append((doc['_id'], update_operation(doc['_id'], _document_to_attributes(context, doc))))
+        except EduIDUserDBError as exc:
+            # e.g. unknown data, or a revoked user
+            operations.append((doc['_id'], exc))
+    result = apply_operations(context.central_userdb._coll, operations)
+    for user_id, exc in result.failed.items():
+        logger.error('Failed syncing user {!s}: {!s}'.format(user_id, exc))
+    return len(result.synced), len(result.failed)
+
+
+def main(args=None):
+    """
+    Run a sync engine until interrupted.
+    """
+    parser = argparse.ArgumentParser(description='Sync the eduID Dashboard userdb to the central userdb')
+    parser.add_argument('--mongo-uri', required=True, help='MongoDB connection string')
+    parser.add_argument('--name', default='eduid_dashboard', help='Checkpoint name')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Users per bulk write')
+    parser.add_argument('--max-wait', type=float, default=1.0, help='Seconds a change may wait')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds between polls')
+    args = parser.parse_args(args)
+
+    context = plugin_init({'MONGO_URI': args.mongo_uri})
+    engine = SyncEngine(context, name=args.name, batch_size=args.batch_size, max_wait=args.max_wait,
+                        poll_interval=args.poll_interval)
+    stop = threading.Event()
+    try:
+        engine.run(stop)
+    except KeyboardInterrupt:
+        stop.set()
+    logger.info('{!r} stopped'.format(engine))
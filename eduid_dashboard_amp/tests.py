@@ -1,17 +1,120 @@
 import bson
+import pymongo
+from datetime import timedelta
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
 from freezegun import freeze_time
 from datetime import datetime, date
 
-from eduid_userdb.exceptions import UserDoesNotExist, UserHasUnknownData
+from eduid_userdb.exceptions import EduIDUserDBError, UserDoesNotExist, UserHasUnknownData
 from eduid_userdb.testing import MongoTestCase
 from eduid_userdb.dashboard import DashboardUser
-from eduid_dashboard_amp import attribute_fetcher, plugin_init
+from eduid_dashboard_amp import attribute_fetcher, attribute_fetcher_cached, attribute_fetcher_delta
+from eduid_dashboard_amp import attribute_fetcher_bulk, attribute_fetcher_many, attribute_fetcher_since
+from eduid_dashboard_amp import ensure_indexes, forget_fingerprint, plugin_init
+from eduid_dashboard_amp import AttributeRule, WHITELIST_SET_ATTRS, apply_filter_plan, compile_filter_plan
+from eduid_dashboard_amp import apply_operations, attribute_fetcher_operation, attribute_fetcher_operations
+from eduid_dashboard_amp import AttributeFetcherTimeout, CircuitOpen
+from eduid_dashboard_amp import apply_array_update, attribute_fetcher_arrays
+from eduid_dashboard_amp import db
+from eduid_dashboard_amp import _find_documents
+from eduid_dashboard_amp import raw
+from eduid_dashboard_amp.arrays import array_diff, array_operations
+from eduid_dashboard_amp.benchmark import make_user_doc, run_benchmarks, shapes
+from eduid_dashboard_amp.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from eduid_dashboard_amp.cache import LRUCache
+from eduid_dashboard_amp.coalesce import Coalescer
+from eduid_dashboard_amp.lanes import BULK, INTERACTIVE, Lane
+from eduid_dashboard_amp.log import EventLogger, redact
+from eduid_dashboard_amp.metrics import Metrics, MetricsRegistry
+from eduid_dashboard_amp.profiling import Profiler, tracemalloc
+from eduid_dashboard_amp.report import dry_run_report
+from eduid_dashboard_amp.resync import CHECKPOINT_COLLECTION, full_resync, object_id_ranges
+from eduid_dashboard_amp.shards import HashRouter, RangeRouter
+from eduid_dashboard_amp.sync import SyncEngine
 from eduid_am.celery import celery, get_attribute_manager
 
+try:
+    from eduid_dashboard_amp.aio import attribute_fetcher_async, plugin_init_async
+except (ImportError, SyntaxError):
+    # Python 2, or motor not installed
+    attribute_fetcher_async = plugin_init_async = None
+
 
 TEST_DB_NAME = 'eduid_dashboard_test'
 
 
+def save_test_users(userdb, count, extra=None):
+    """
+    Save test users number 1 to count in the dashboard userdb.
+
+    :param userdb: Dashboard userdb
+    :param count: Number of users
+    :param extra: Function returning more data for the user with a given number
+
+    :type userdb: eduid_userdb.dashboard.DashboardUserDB
+    :type count: int
+    :type extra: callable | None
+
+    :rtype: list of DashboardUser
+    """
+    users = []
+    for i in range(1, count + 1):
+        _data = {
+            'eduPersonPrincipalName': 'test-test{}'.format(i),
+            'displayName': 'John {}'.format(i),
+            'passwords': [{
+                'id': bson.ObjectId('{}'.format(i) * 24),
+                'salt': '456',
+            }],
+        }
+        if extra is not None:
+            _data.update(extra(i))
+        user = DashboardUser(data=_data)
+        userdb.save(user)
+        users.append(user)
+    return users
+
+
+def single_user_data(**extra):
+    """
+    Data of the test user used by the tests needing only one user.
+
+    :param extra: More attributes of the user
+
+    :rtype: dict
+    """
+    _data = {
+        'eduPersonPrincipalName': 'test-test',
+        'passwords': [{
+            'id': bson.ObjectId('112345678901234567890123'),
+            'salt': '456',
+        }],
+    }
+    _data.update(extra)
+    return _data
+
+
+def save_test_user(userdb, **extra):
+    """
+    Save the single_user_data() test user in the dashboard userdb.
+
+    :param userdb: Dashboard userdb
+    :param extra: More attributes of the user
+
+    :type userdb: eduid_userdb.dashboard.DashboardUserDB
+
+    :rtype: DashboardUser
+    """
+    user = DashboardUser(data=single_user_data(**extra))
+    userdb.save(user)
+    return user
+
+
 class AttributeFetcherOldToNewUsersTests(MongoTestCase):
 
     def setUp(self):
@@ -1035,3 +1138,1442 @@ class AttributeFetcherNewToNewUsersTests(MongoTestCase):
                 }
             }
         )
+
+
+def object_and_raw_attributes(context, doc):
+    """
+    Build the update dict for a dashboard document through DashboardUser and through the raw fast path.
+
+    The raw result is None if the fast path does not support the document.
+    """
+    expected = apply_filter_plan(context.filter_plan,
+                                 DashboardUser(data=dict(doc)).to_dict(old_userdb_format=False))
+    try:
+        actual = apply_filter_plan(context.filter_plan, raw.document_to_dict(doc))
+    except raw.UnsupportedDocument:
+        actual = None
+    return expected, actual
+
+
+class AttributeFetcherManyTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherManyTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+
+        users = save_test_users(self.plugin_context.dashboard_userdb, 5, lambda i: {
+            'mailAliases': [{
+                'email': 'john{}@example.com'.format(i),
+                'verified': True,
+                'primary': True
+            }],
+        })
+        self.user_ids = [user.user_id for user in users]
+
+        self.maxDiff = None
+
+    def test_same_as_attribute_fetcher(self):
+        fetched = list(attribute_fetcher_many(self.plugin_context, self.user_ids, batch_size=2))
+        self.assertEqual([user_id for user_id, _ in fetched], self.user_ids)
+        for user_id, attributes in fetched:
+            self.assertDictEqual(attributes, attribute_fetcher(self.plugin_context, user_id))
+
+    def test_invalid_user(self):
+        user_ids = self.user_ids[:2] + [bson.ObjectId('0' * 24)]
+        with self.assertRaises(UserDoesNotExist):
+            list(attribute_fetcher_many(self.plugin_context, user_ids))
+
+    def test_malicious_attributes(self):
+        _data = {
+            'eduPersonPrincipalName': 'test-test',
+            'malicious': 'hacker',
+        }
+        user_id = self.plugin_context.dashboard_userdb._coll.insert(_data)
+
+        with self.assertRaises(UserHasUnknownData):
+            list(attribute_fetcher_many(self.plugin_context, [user_id]))
+
+    def test_errors_not_raised(self):
+        missing = bson.ObjectId('0' * 24)
+        fetched = dict(attribute_fetcher_many(self.plugin_context, [missing] + self.user_ids,
+                                              raise_on_error=False))
+        self.assertIsInstance(fetched[missing], UserDoesNotExist)
+        for user_id in self.user_ids:
+            self.assertIn('$set', fetched[user_id])
+
+    def test_revoked_user_not_raised(self):
+        self.plugin_context.dashboard_userdb._coll.update_one({'_id': self.user_ids[0]},
+                                                             {'$set': {'revoked_ts': datetime.utcnow()}})
+        fetched = dict(attribute_fetcher_many(self.plugin_context, self.user_ids, raise_on_error=False))
+        self.assertIsInstance(fetched[self.user_ids[0]], EduIDUserDBError)
+        for user_id in self.user_ids[1:]:
+            self.assertIn('$set', fetched[user_id])
+
+
+class AttributeFetcherOldToNewProjectionTests(AttributeFetcherOldToNewUsersTests):
+    """
+    Run the old to new tests again, reading only the projected fields.
+    """
+
+    def setUp(self):
+        super(AttributeFetcherOldToNewProjectionTests, self).setUp()
+        self.plugin_context.projection_reads = True
+
+
+class AttributeFetcherNewToNewProjectionTests(AttributeFetcherNewToNewUsersTests):
+    """
+    Run the new to new tests again, reading only the projected fields.
+    """
+
+    def setUp(self):
+        super(AttributeFetcherNewToNewProjectionTests, self).setUp()
+        self.plugin_context.projection_reads = True
+
+
+class AttributeFetcherDeltaTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherDeltaTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.plugin_context.central_userdb = self.amdb
+
+        self.user = save_test_user(self.plugin_context.dashboard_userdb, displayName='John', mailAliases=[{
+            'email': 'john@example.com',
+            'verified': True,
+            'primary': True
+        }])
+        self.maxDiff = None
+
+    def _apply(self, attributes):
+        self.amdb._coll.update({'_id': self.user.user_id}, attributes, upsert=True)
+
+    def test_new_user(self):
+        self.assertDictEqual(
+            attribute_fetcher_delta(self.plugin_context, self.user.user_id),
+            attribute_fetcher(self.plugin_context, self.user.user_id),
+        )
+
+    def test_no_change(self):
+        self._apply(attribute_fetcher(self.plugin_context, self.user.user_id))
+        self.assertDictEqual(attribute_fetcher_delta(self.plugin_context, self.user.user_id), {})
+
+    def test_changed_attribute(self):
+        self._apply(attribute_fetcher(self.plugin_context, self.user.user_id))
+        self.user.display_name = 'John2'
+        self.plugin_context.dashboard_userdb.save(self.user)
+        self.assertDictEqual(
+            attribute_fetcher_delta(self.plugin_context, self.user.user_id),
+            {'$set': {'displayName': 'John2'}},
+        )
+
+    def test_unset_attribute(self):
+        attributes = attribute_fetcher(self.plugin_context, self.user.user_id)
+        attributes['$set']['mobile'] = [{'mobile': '+46700011336', 'verified': True}]
+        self._apply(attributes)
+        self.assertDictEqual(
+            attribute_fetcher_delta(self.plugin_context, self.user.user_id),
+            {'$unset': {'mobile': None}},
+        )
+
+
+class ArrayDiffTests(unittest.TestCase):
+
+    def setUp(self):
+        self.old = [{'credential_id': 'a', 'salt': '1'}, {'credential_id': 'b', 'salt': '2'},
+                    {'credential_id': 'c', 'salt': '3'}]
+
+    def test_diff(self):
+        new = [self.old[0], {'credential_id': 'c', 'salt': '9'}, {'credential_id': 'd', 'salt': '4'}]
+        steps = array_diff('passwords', self.old, new, 'credential_id')
+        self.assertEqual([update for _guard, update, _filters in steps], [
+            {'$pull': {'passwords': {'credential_id': {'$in': ['b']}}}},
+            {'$set': {'passwords.$[e0]': new[1]}},
+            {'$push': {'passwords': {'$each': [new[2]]}}},
+        ])
+        self.assertEqual(steps[0][0], {'passwords': {'$size': 3}, 'passwords.credential_id': {'$all': ['a', 'b', 'c']}})
+        self.assertEqual(steps[1][2], [{'e0.credential_id': 'c'}])
+
+    def test_unchanged(self):
+        self.assertEqual(array_diff('passwords', self.old, list(self.old), 'credential_id'), [])
+
+    def test_strings(self):
+        steps = array_diff('eduPersonEntitlement', ['x', 'y'], ['y', 'z'])
+        self.assertEqual([update for _guard, update, _filters in steps], [
+            {'$pull': {'eduPersonEntitlement': {'$in': ['x']}}},
+            {'$push': {'eduPersonEntitlement': {'$each': ['z']}}},
+        ])
+
+    def test_set_in_full(self):
+        # nothing kept, new order, duplicate and missing identities
+        self.assertIsNone(array_diff('eduPersonEntitlement', ['x'], ['y']))
+        self.assertIsNone(array_diff('eduPersonEntitlement', ['x', 'y'], ['y', 'x']))
+        self.assertIsNone(array_diff('eduPersonEntitlement', ['x', 'x'], ['x']))
+        self.assertIsNone(array_diff('passwords', self.old, [{'salt': '1'}], 'credential_id'))
+        self.assertIsNone(array_diff('passwords', None, self.old, 'credential_id'))
+
+    def test_operations(self):
+        new = self.old[:2]
+        attributes = {'$set': {'displayName': 'John', 'passwords': new}, '$unset': {'mobile': None}}
+        operations = array_operations('user', attributes, {'passwords': self.old})
+        self.assertEqual([operation._doc for operation in operations], [
+            {'$set': {'displayName': 'John'}, '$unset': {'mobile': None}},
+            {'$pull': {'passwords': {'credential_id': {'$in': ['c']}}}},
+        ])
+        self.assertEqual(array_operations('user', attributes, None)[0]._doc, attributes)
+
+
+class AttributeFetcherArraysTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherArraysTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.plugin_context.central_userdb = self.amdb
+        self.central = self.amdb._coll
+
+        _data = {
+            'eduPersonPrincipalName': 'test-test',
+            'displayName': 'John',
+            'passwords': [{
+                'id': bson.ObjectId('{}'.format(i) * 24),
+                'salt': '456',
+            } for i in range(1, 4)],
+        }
+        self.user = DashboardUser(data=_data)
+        self.plugin_context.dashboard_userdb.save(self.user)
+        self.central.update({'_id': self.user.user_id},
+                            attribute_fetcher(self.plugin_context, self.user.user_id), upsert=True)
+
+    def _remove_password(self):
+        doc = self.plugin_context.dashboard_userdb._coll.find_one({'_id': self.user.user_id})
+        doc['passwords'] = doc['passwords'][1:]
+        self.plugin_context.dashboard_userdb._coll.save(doc)
+
+    def _central_passwords(self):
+        return self.central.find_one({'_id': self.user.user_id})['passwords']
+
+    def test_same_as_attribute_fetcher(self):
+        self._remove_password()
+        update = attribute_fetcher_arrays(self.plugin_context, self.user.user_id)
+        self.assertEqual(update.operations[-1]._doc,
+                         {'$pull': {'passwords': {'credential_id': {'$in': ['1' * 24]}}}})
+        self.assertTrue(apply_array_update(self.central, update))
+        attributes = attribute_fetcher(self.plugin_context, self.user.user_id)
+        self.assertEqual(self._central_passwords(), attributes['$set']['passwords'])
+
+    def test_changed_meanwhile(self):
+        self._remove_password()
+        update = attribute_fetcher_arrays(self.plugin_context, self.user.user_id)
+        self.central.update({'_id': self.user.user_id}, {'$push': {'passwords': {'credential_id': 'x'}}})
+        self.assertFalse(apply_array_update(self.central, update))
+        self.assertEqual(self._central_passwords(), update.attributes['$set']['passwords'])
+
+
+class AttributeFetcherCachedTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherCachedTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+
+        self.user = save_test_user(self.plugin_context.dashboard_userdb, displayName='John', mailAliases=[{
+            'email': 'john@example.com',
+            'verified': True,
+            'primary': True
+        }])
+        self.maxDiff = None
+
+    def test_unchanged_user(self):
+        self.assertDictEqual(
+            attribute_fetcher_cached(self.plugin_context, self.user.user_id),
+            attribute_fetcher(self.plugin_context, self.user.user_id),
+        )
+        self.assertDictEqual(attribute_fetcher_cached(self.plugin_context, self.user.user_id), {})
+
+    def test_changed_user(self):
+        attribute_fetcher_cached(self.plugin_context, self.user.user_id)
+        self.user.display_name = 'John2'
+        self.plugin_context.dashboard_userdb.save(self.user)
+        attributes = attribute_fetcher_cached(self.plugin_context, self.user.user_id)
+        self.assertEqual(attributes['$set']['displayName'], 'John2')
+
+    def test_forget_fingerprint(self):
+        attribute_fetcher_cached(self.plugin_context, self.user.user_id)
+        forget_fingerprint(self.plugin_context, self.user.user_id)
+        self.assertDictEqual(
+            attribute_fetcher_cached(self.plugin_context, self.user.user_id),
+            attribute_fetcher(self.plugin_context, self.user.user_id),
+        )
+
+    def test_invalid_user(self):
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher_cached(self.plugin_context, bson.ObjectId('0' * 24))
+
+    def test_reverted_user_other_worker(self):
+        other_context = plugin_init(celery.conf)
+        collection = self.plugin_context.dashboard_userdb._coll
+        first = collection.find_one({'_id': self.user.user_id})
+        attribute_fetcher_cached(self.plugin_context, self.user.user_id)
+
+        second = dict(first, passwords=first['passwords'] + [{'id': bson.ObjectId('2' * 24), 'salt': '789'}])
+        collection.save(second)
+        self.assertEqual(len(attribute_fetcher_cached(other_context, self.user.user_id)['$set']['passwords']), 2)
+
+        collection.save(first)
+        attributes = attribute_fetcher_cached(self.plugin_context, self.user.user_id)
+        self.assertEqual(len(attributes['$set']['passwords']), 1)
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = LRUCache(2, ttl=10, timer=lambda: self.now)
+
+    def test_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.now += 11
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_counters(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+
+class SharedClientTests(MongoTestCase):
+
+    def setUp(self):
+        super(SharedClientTests, self).setUp(celery, get_attribute_manager)
+
+    def test_contexts_share_userdb(self):
+        context1 = plugin_init(celery.conf)
+        context2 = plugin_init(celery.conf)
+        self.assertIs(context1.dashboard_userdb, context2.dashboard_userdb)
+
+    def test_new_userdb_after_fork(self):
+        context = plugin_init(celery.conf)
+        userdb = context.dashboard_userdb
+        db._pid = None  # what a forked child would see
+        self.assertIsNot(context.dashboard_userdb, userdb)
+
+    def test_pool_options(self):
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_MAX_POOL_SIZE'] = 5
+        context = plugin_init(am_conf)
+        self.assertEqual(context.pool_options, {'maxPoolSize': 5})
+        self.assertIsNot(context.dashboard_userdb, plugin_init(celery.conf).dashboard_userdb)
+
+
+class UriWithOptionsTests(unittest.TestCase):
+
+    def test_uri_with_options(self):
+        options = {'maxPoolSize': 5, 'socketTimeoutMS': 100}
+        self.assertEqual(db.uri_with_options('mongodb://localhost', options),
+                         'mongodb://localhost/?maxPoolSize=5&socketTimeoutMS=100')
+        self.assertEqual(db.uri_with_options('mongodb://localhost/', options),
+                         'mongodb://localhost/?maxPoolSize=5&socketTimeoutMS=100')
+        self.assertEqual(db.uri_with_options('mongodb://localhost/?w=1', options),
+                         'mongodb://localhost/?w=1&maxPoolSize=5&socketTimeoutMS=100')
+        self.assertEqual(db.uri_with_options('mongodb://localhost', {}), 'mongodb://localhost')
+
+
+@unittest.skipIf(attribute_fetcher_async is None, 'asyncio or motor not available')
+class AttributeFetcherAsyncTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherAsyncTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.async_context = plugin_init_async(celery.conf)
+        self.maxDiff = None
+
+    def _run(self, coro):
+        import asyncio
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_same_as_attribute_fetcher(self):
+        _data = {
+            'eduPersonPrincipalName': 'test-test',
+            'mail': 'john@example.com',
+            'mailAliases': [{
+                'email': 'john@example.com',
+                'verified': True,
+            }],
+            'mobile': [{
+                'verified': True,
+                'mobile': '+46700011336',
+                'primary': True
+            }],
+            'norEduPersonNIN': [u'123456781235'],
+            'passwords': [{
+                'id': bson.ObjectId('112345678901234567890123'),
+                'salt': '456',
+            }],
+        }
+        user = DashboardUser(data=_data)
+        self.plugin_context.dashboard_userdb.save(user)
+
+        self.assertDictEqual(
+            self._run(attribute_fetcher_async(self.async_context, user.user_id)),
+            attribute_fetcher(self.plugin_context, user.user_id),
+        )
+
+    def test_invalid_user(self):
+        with self.assertRaises(UserDoesNotExist):
+            self._run(attribute_fetcher_async(self.async_context, bson.ObjectId('0' * 24)))
+
+    def test_malicious_attributes(self):
+        _data = {
+            'eduPersonPrincipalName': 'test-test',
+            'malicious': 'hacker',
+        }
+        user_id = self.plugin_context.dashboard_userdb._coll.insert(_data)
+
+        with self.assertRaises(UserHasUnknownData):
+            self._run(attribute_fetcher_async(self.async_context, user_id))
+
+
+class FilterPlanTests(unittest.TestCase):
+
+    def test_compile(self):
+        plan = compile_filter_plan()
+        self.assertEqual(tuple(rule.attr for rule in plan), WHITELIST_SET_ATTRS)
+        rules = dict((rule.attr, rule) for rule in plan)
+        self.assertEqual(rules['displayName'], AttributeRule('displayName', False, None))
+        self.assertEqual(rules['mailAliases'], AttributeRule('mailAliases', True, None))
+
+    def test_apply(self):
+        plan = compile_filter_plan(set_attrs=('displayName', 'givenName', 'mail', 'nins'),
+                                   unset_attrs=('mail', 'nins'),
+                                   transforms={'displayName': lambda value: value.upper()})
+        user_dict = {
+            'displayName': 'John',
+            'givenName': '',
+            'nins': [],
+            'malicious': 'hacker',
+        }
+        self.assertEqual(apply_filter_plan(plan, user_dict), {
+            '$set': {'displayName': 'JOHN'},
+            '$unset': {'mail': None, 'nins': []},
+        })
+
+    def test_nothing_to_unset(self):
+        plan = compile_filter_plan(set_attrs=('displayName',), unset_attrs=())
+        self.assertEqual(apply_filter_plan(plan, {}), {'$set': {}})
+
+
+class SyncEngineTests(MongoTestCase):
+
+    def setUp(self):
+        super(SyncEngineTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.plugin_context.central_userdb = self.amdb
+        self.engine = SyncEngine(self.plugin_context, name='test', batch_size=2)
+
+        self.users = save_test_users(self.plugin_context.dashboard_userdb, 3)
+
+    def _central_doc(self, user):
+        return self.amdb._coll.find_one({'_id': user.user_id})
+
+    def test_poll(self):
+        self.assertEqual(self.engine.poll_once(), 2)
+        self.assertEqual(self.engine.poll_once(), 1)
+        self.assertEqual(self.engine.poll_once(), 0)
+        for user in self.users:
+            self.assertEqual(self._central_doc(user)['displayName'], user.display_name)
+        self.assertEqual(self.engine.synced, 3)
+
+    def test_poll_changed_user(self):
+        while self.engine.poll_once():
+            pass
+        user = self.users[0]
+        user.display_name = 'John Changed'
+        self.plugin_context.dashboard_userdb.save(user)
+        self.assertEqual(self.engine.poll_once(), 1)
+        self.assertEqual(self._central_doc(user)['displayName'], 'John Changed')
+
+    def test_checkpoint(self):
+        self.engine.poll_once()
+        engine = SyncEngine(self.plugin_context, name='test', batch_size=2)
+        self.assertEqual(engine.poll_once(), 1)
+
+    def test_revoked_user(self):
+        self.plugin_context.dashboard_userdb._coll.update_one({'_id': self.users[0].user_id},
+                                                             {'$set': {'revoked_ts': datetime.utcnow()}})
+        while self.engine.poll_once():
+            pass
+        self.assertEqual((self.engine.synced, self.engine.failed), (2, 1))
+        self.assertIsNone(self._central_doc(self.users[0]))
+
+
+class SyncEngineProjectionTests(SyncEngineTests):
+
+    def setUp(self):
+        super(SyncEngineProjectionTests, self).setUp()
+        self.plugin_context.projection_reads = True
+
+
+class CoalescerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.coalescer = Coalescer(window=0.2)
+        self.calls = []
+
+    def _func(self, value):
+        self.calls.append(value)
+        return {'value': value}
+
+    def _call_in_threads(self, keys):
+        results = {}
+
+        def _call(i, key):
+            results[i] = self.coalescer.call(key, self._func, key)
+        threads = [threading.Thread(target=_call, args=(i, key)) for i, key in enumerate(keys)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[i] for i in range(len(keys))]
+
+    def test_coalesce(self):
+        results = self._call_in_threads(['a', 'a', 'a', 'b'])
+        self.assertEqual(results, [{'value': 'a'}] * 3 + [{'value': 'b'}])
+        self.assertEqual(sorted(self.calls), ['a', 'b'])
+        self.assertEqual(self.coalescer.coalesced, 2)
+
+    def test_results_not_shared(self):
+        seen = []
+
+        def _call():
+            result = self.coalescer.call('a', self._func, 'a')
+            seen.append(result['value'])
+            # Changing one caller's result must not affect the others
+            result['value'] = 'changed'
+        threads = [threading.Thread(target=_call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(seen, ['a'] * 3)
+
+    def test_not_coalesced_after_call(self):
+        self.coalescer.window = 0
+        self.coalescer.call('a', self._func, 'a')
+        self.coalescer.call('a', self._func, 'a')
+        self.assertEqual(self.calls, ['a', 'a'])
+
+    def test_exception_shared(self):
+        def _fail(key):
+            self.calls.append(key)
+            raise UserDoesNotExist(key)
+        self.coalescer.window = 0.2
+        errors = []
+
+        def _call():
+            try:
+                self.coalescer.call('a', _fail, 'a')
+            except UserDoesNotExist as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=_call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(self.calls, ['a'])
+
+
+class BenchmarkTests(MongoTestCase):
+
+    def setUp(self):
+        super(BenchmarkTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(self.plugin_context, sizes=(1, 3), users=3, batch_users=2)
+        self.assertEqual(len(results['results']), 8)
+        for result in results['results']:
+            for phase in ('fetch', 'convert', 'raw', 'filter', 'log_eager', 'log_lazy', 'total'):
+                self.assertEqual(result['phases'][phase]['count'], 3)
+            # One timing per batch
+            self.assertEqual(result['phases']['batch']['count'], 2)
+
+    def test_dashboard_userdb_untouched(self):
+        user = DashboardUser(data={
+            'eduPersonPrincipalName': 'test-test',
+            'passwords': [{'id': bson.ObjectId('1' * 24), 'salt': '456'}],
+        })
+        self.plugin_context.dashboard_userdb.save(user)
+        run_benchmarks(self.plugin_context, sizes=(1,), users=2)
+        self.assertEqual(self.plugin_context.dashboard_userdb._coll.find().count(), 1)
+
+
+class FullResyncTests(MongoTestCase):
+
+    def setUp(self):
+        super(FullResyncTests, self).setUp(celery, get_attribute_manager)
+        self.am_conf = dict(celery.conf)
+        self.am_conf['DASHBOARD_AMP_CENTRAL_DB_NAME'] = self.amdb._coll.database.name
+        self.am_conf['DASHBOARD_AMP_CENTRAL_COLLECTION'] = self.amdb._coll.name
+        self.plugin_context = plugin_init(self.am_conf)
+
+        self.users = save_test_users(self.plugin_context.dashboard_userdb, 7, lambda i: {
+            '_id': bson.ObjectId.from_datetime(datetime(2018, i, 1)),
+        })
+
+    def test_object_id_ranges(self):
+        ranges = object_id_ranges(self.plugin_context.dashboard_userdb._coll, 3)
+        self.assertEqual(len(ranges), 3)
+        self.assertIsNone(ranges[0][0])
+        self.assertIsNone(ranges[-1][1])
+        for (_, upper), (lower, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(upper, lower)
+
+    def test_full_resync(self):
+        synced, failed = full_resync(self.am_conf, run_name='test', processes=2, batch_size=2,
+                                     report_interval=0.1)
+        self.assertEqual((synced, failed), (7, 0))
+        for user in self.users:
+            self.assertEqual(self.amdb._coll.find_one({'_id': user.user_id})['displayName'], user.display_name)
+
+    def test_resume(self):
+        full_resync(self.am_conf, run_name='test', processes=2, batch_size=2, report_interval=0.1)
+        # Nothing left to do when resuming a finished resync
+        self.assertEqual(full_resync(self.am_conf, run_name='test', processes=2), (7, 0))
+
+    def test_revoked_user(self):
+        self.plugin_context.dashboard_userdb._coll.update_one({'_id': self.users[3].user_id},
+                                                             {'$set': {'revoked_ts': datetime.utcnow()}})
+        synced, failed = full_resync(self.am_conf, run_name='test', processes=2, batch_size=2,
+                                     report_interval=0.1)
+        self.assertEqual((synced, failed), (6, 1))
+
+    def test_interrupted_planning(self):
+        checkpoints = self.plugin_context.dashboard_userdb._coll.database[CHECKPOINT_COLLECTION]
+        checkpoints.insert_one({'_id': 'test:0000', 'run': 'test', 'lower': None,
+                                'upper': self.users[1].user_id, 'last_id': None, 'done': True,
+                                'synced': 0, 'failed': 0})
+        synced, failed = full_resync(self.am_conf, run_name='test', processes=2, batch_size=2,
+                                     report_interval=0.1)
+        self.assertEqual((synced, failed), (7, 0))
+
+
+class AttributeFetcherRawDifferentialMixin(object):
+    """
+    Run a test class again with the raw fast path, and check that every
+    document it leaves in the dashboard userdb converts to the same update
+    dict through DashboardUser and through the fast path.
+    """
+
+    def setUp(self):
+        super(AttributeFetcherRawDifferentialMixin, self).setUp()
+        self.plugin_context.raw_fast_path = True
+
+    def tearDown(self):
+        for doc in self.plugin_context.dashboard_userdb._coll.find():
+            try:
+                expected, actual = object_and_raw_attributes(self.plugin_context, doc)
+            except UserHasUnknownData:
+                continue
+            if actual is not None:
+                self.assertDictEqual(actual, expected)
+        super(AttributeFetcherRawDifferentialMixin, self).tearDown()
+
+
+class AttributeFetcherOldToNewRawTests(AttributeFetcherRawDifferentialMixin, AttributeFetcherOldToNewUsersTests):
+    pass
+
+
+class AttributeFetcherNewToNewRawTests(AttributeFetcherRawDifferentialMixin, AttributeFetcherNewToNewUsersTests):
+    pass
+
+
+class RawFastPathTests(MongoTestCase):
+
+    def setUp(self):
+        super(RawFastPathTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.maxDiff = None
+
+    def test_synthetic_users(self):
+        for shape in shapes(sizes=(1, 3)):
+            user = DashboardUser(data=make_user_doc(1, **shape))
+            self.plugin_context.dashboard_userdb.save(user)
+            doc = self.plugin_context.dashboard_userdb._coll.find_one({'_id': user.user_id})
+            expected, actual = object_and_raw_attributes(self.plugin_context, doc)
+            self.assertIsNotNone(actual, 'Fast path not used for {!r}'.format(shape))
+            self.assertDictEqual(actual, expected)
+
+    def test_unsupported_document(self):
+        doc = {
+            '_id': bson.ObjectId(),
+            'eduPersonPrincipalName': 'test-test',
+            'mailAliases': [{'email': 'john@example.com', 'verified': True, 'primary': True, 'unknown': 1}],
+            'passwords': [{'id': bson.ObjectId(), 'salt': '456'}],
+        }
+        with self.assertRaises(raw.UnsupportedDocument):
+            raw.document_to_dict(doc)
+
+
+class AttributeFetcherSinceTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherSinceTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+
+        self.users = save_test_users(self.plugin_context.dashboard_userdb, 3)
+
+    def test_index_created(self):
+        collection = self.plugin_context.dashboard_userdb._coll
+        self.assertNotIn('modified_ts-idx', collection.index_information())
+        self.assertTrue(ensure_indexes(self.plugin_context))
+        self.assertIn('modified_ts-idx', collection.index_information())
+        # Already there
+        self.assertTrue(ensure_indexes(self.plugin_context))
+
+    def test_index_database_down(self):
+        context = plugin_init({
+            'MONGO_URI': 'mongodb://127.0.0.1:1/',
+            'DASHBOARD_AMP_SERVER_SELECTION_TIMEOUT_MS': 50,
+        })
+        self.assertFalse(ensure_indexes(context))
+
+    def test_all_users(self):
+        changed = attribute_fetcher_since(self.plugin_context, None)
+        fetched = dict(changed)
+        self.assertEqual(set(fetched.keys()), set(user.user_id for user in self.users))
+        for user in self.users:
+            self.assertDictEqual(fetched[user.user_id], attribute_fetcher(self.plugin_context, user.user_id))
+        self.assertEqual(changed.watermark, max(doc['modified_ts'] for doc in
+                                                self.plugin_context.dashboard_userdb._coll.find()))
+
+    def test_changed_since(self):
+        changed = attribute_fetcher_since(self.plugin_context, None)
+        list(changed)
+        user = self.users[0]
+        user.display_name = 'John Changed'
+        self.plugin_context.dashboard_userdb.save(user)
+
+        fetched = dict(attribute_fetcher_since(self.plugin_context, changed.watermark))
+        self.assertIn(user.user_id, fetched)
+        self.assertEqual(fetched[user.user_id]['$set']['displayName'], 'John Changed')
+        self.assertLessEqual(len(fetched), 2)
+
+
+class AttributeFetcherSinceProjectionTests(AttributeFetcherSinceTests):
+
+    def setUp(self):
+        super(AttributeFetcherSinceProjectionTests, self).setUp()
+        self.plugin_context.projection_reads = True
+
+
+class DryRunReportTests(MongoTestCase):
+
+    def setUp(self):
+        super(DryRunReportTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.plugin_context.central_userdb = self.amdb
+        self.amdb._coll.remove({})
+
+        self.users = save_test_users(self.plugin_context.dashboard_userdb, 3)
+
+        for user in self.users[:2]:
+            attributes = attribute_fetcher(self.plugin_context, user.user_id)
+            self.amdb._coll.update({'_id': user.user_id}, attributes, upsert=True)
+        self.users[1].display_name = 'John Changed'
+        self.plugin_context.dashboard_userdb.save(self.users[1])
+
+    def test_report(self):
+        central_before = list(self.amdb._coll.find())
+        report = dry_run_report(self.plugin_context, batch_size=2)
+        self.assertEqual(report['users'], 3)
+        self.assertEqual(report['unchanged_users'], 1)
+        self.assertEqual(report['changed_users'], 1)
+        self.assertEqual(report['new_users'], 1)
+        self.assertEqual(report['set'], {'displayName': 1})
+        self.assertEqual(report['unset'], {})
+        self.assertEqual(list(self.amdb._coll.find()), central_before)
+
+    def test_revoked_user(self):
+        self.plugin_context.dashboard_userdb._coll.update_one({'_id': self.users[2].user_id},
+                                                             {'$set': {'revoked_ts': datetime.utcnow()}})
+        report = dry_run_report(self.plugin_context, batch_size=2)
+        self.assertEqual(report['users'], 3)
+        self.assertEqual(report['new_users'], 0)
+        self.assertEqual(sum(report['errors'].values()), 1)
+
+
+class NegativeCacheTests(MongoTestCase):
+
+    def setUp(self):
+        super(NegativeCacheTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.user_id = bson.ObjectId()
+        self.doc = single_user_data(_id=self.user_id)
+
+    def test_missing_user_cached(self):
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.plugin_context, self.user_id)
+        self.plugin_context.dashboard_userdb._coll.insert_one(self.doc)
+        # Known missing within the TTL, without looking in the database
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.plugin_context, self.user_id)
+        self.assertEqual(self.plugin_context.missing_users.hits, 1)
+
+    def test_missing_user_expires(self):
+        self.now = 1000
+        self.plugin_context.missing_users = LRUCache(10, ttl=10, timer=lambda: self.now)
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.plugin_context, self.user_id)
+        self.plugin_context.dashboard_userdb._coll.insert_one(self.doc)
+        self.now += 11
+        self.assertIn('$set', attribute_fetcher(self.plugin_context, self.user_id))
+
+    def test_many_missing_user_cached(self):
+        result = dict(attribute_fetcher_many(self.plugin_context, [self.user_id], raise_on_error=False))
+        self.assertIsInstance(result[self.user_id], UserDoesNotExist)
+        result = dict(attribute_fetcher_many(self.plugin_context, [self.user_id], raise_on_error=False))
+        self.assertIsInstance(result[self.user_id], UserDoesNotExist)
+        self.assertEqual(self.plugin_context.missing_users.hits, 1)
+
+    def test_disabled(self):
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_NEGATIVE_CACHE_TTL'] = 0
+        context = plugin_init(am_conf)
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(context, self.user_id)
+        context.dashboard_userdb._coll.insert_one(self.doc)
+        self.assertIn('$set', attribute_fetcher(context, self.user_id))
+        self.assertEqual(len(context.missing_users), 0)
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.registry = self.metrics.registry
+
+    def test_counters(self):
+        self.metrics.incr('errors_total', type='UserDoesNotExist')
+        self.metrics.incr('errors_total', type='UserDoesNotExist')
+        self.metrics.incr('errors_total', type='UserHasUnknownData')
+        self.assertEqual(self.registry.counter('errors_total', type='UserDoesNotExist'), 2)
+        self.assertEqual(self.registry.counter('errors_total', type='UserHasUnknownData'), 1)
+        self.assertEqual(self.registry.counter('errors_total'), 0)
+
+    def test_histograms(self):
+        self.metrics.observe('fetch_seconds', 0.002)
+        self.metrics.observe('fetch_seconds', 0.004)
+        count, total = self.registry.histogram('fetch_seconds')
+        self.assertEqual(count, 2)
+        self.assertAlmostEqual(total, 0.006)
+
+    def test_extra_sink(self):
+        sink = MetricsRegistry()
+        self.metrics.add_sink(sink)
+        self.metrics.observe('document_bytes', 1000)
+        self.assertEqual(sink.histogram('document_bytes'), (1, 1000))
+
+    def test_prometheus_text(self):
+        self.metrics.incr('errors_total', type='UserDoesNotExist')
+        self.metrics.observe('document_bytes', 1000)
+        text = self.registry.prometheus_text()
+        self.assertIn('# TYPE eduid_dashboard_amp_errors_total counter\n', text)
+        self.assertIn('eduid_dashboard_amp_errors_total{type="UserDoesNotExist"} 1\n', text)
+        self.assertIn('eduid_dashboard_amp_document_bytes_bucket{le="512.0"} 0\n', text)
+        self.assertIn('eduid_dashboard_amp_document_bytes_bucket{le="1024.0"} 1\n', text)
+        self.assertIn('eduid_dashboard_amp_document_bytes_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('eduid_dashboard_amp_document_bytes_count 1\n', text)
+
+
+class AttributeFetcherMetricsTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherMetricsTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.registry = self.plugin_context.metrics.registry
+
+        self.user = save_test_user(self.plugin_context.dashboard_userdb, displayName='John')
+
+    def test_plugin_init(self):
+        self.assertEqual(self.registry.counter('plugin_init_total'), 1)
+        self.assertEqual(self.registry.histogram('plugin_init_seconds')[0], 1)
+
+    def test_existing_user(self):
+        self.plugin_context.document_bytes_sample_rate = 1.0
+        attributes = attribute_fetcher(self.plugin_context, self.user.user_id)
+        for name in ('attribute_fetcher_seconds', 'filter_seconds'):
+            self.assertEqual(self.registry.histogram(name)[0], 1, name)
+        self.assertEqual(self.registry.histogram('document_bytes', fields='all')[0], 1)
+        self.assertEqual(self.registry.histogram('fetch_seconds', lane='interactive')[0], 1)
+        self.assertEqual(self.registry.histogram('convert_seconds', path='object')[0], 1)
+        self.assertEqual(self.registry.histogram('attributes_set'), (1, len(attributes['$set'])))
+        self.assertEqual(self.registry.histogram('attributes_unset'), (1, len(attributes['$unset'])))
+
+    def test_errors(self):
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.plugin_context, bson.ObjectId('0' * 24))
+        self.plugin_context.dashboard_userdb._coll.update_one({'_id': self.user.user_id},
+                                                              {'$set': {'foo': 'bar'}})
+        with self.assertRaises(UserHasUnknownData):
+            attribute_fetcher(self.plugin_context, self.user.user_id)
+        self.assertEqual(self.registry.counter('errors_total', type='UserDoesNotExist'), 1)
+        self.assertEqual(self.registry.counter('errors_total', type='UserHasUnknownData'), 1)
+
+
+class EventLoggerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        test = self
+
+        class _Handler(logging.Handler):
+            def emit(self, record):
+                test.records.append(record.getMessage())
+
+        self.logger = logging.getLogger('eduid_dashboard_amp.tests.EventLoggerTests')
+        self.logger.propagate = False
+        self.handler = _Handler()
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_redact(self):
+        data = {
+            'passwords': [{'credential_id': 'abc', 'salt': 'secret'}],
+            'nins': [{'number': '197801011234', 'verified': True}],
+            'displayName': 'John',
+        }
+        self.assertEqual(redact(data), {
+            'passwords': [{'credential_id': 'abc', 'salt': '<redacted>'}],
+            'nins': '<redacted>',
+            'displayName': 'John',
+        })
+        self.assertEqual(data['passwords'][0]['salt'], 'secret')
+
+    def test_debug(self):
+        EventLogger(self.logger).debug('attributes', set={'passwords': [{'salt': 'secret'}]}, user_id=1)
+        self.assertEqual(self.records, ["attributes set={'passwords': [{'salt': '<redacted>'}]} user_id=1"])
+
+    def test_redacted_extra(self):
+        fields = []
+        handler = logging.Handler()
+        handler.emit = lambda record: fields.append(record.fields)
+        self.logger.addHandler(handler)
+        try:
+            EventLogger(self.logger).debug('attributes', set={'passwords': [{'salt': 'secret'}]})
+        finally:
+            self.logger.removeHandler(handler)
+        self.assertEqual(fields, [{'set': {'passwords': [{'salt': '<redacted>'}]}}])
+
+    def test_level_guard(self):
+
+        class _Unprintable(object):
+            def __repr__(self):
+                raise AssertionError('formatted with debug logging disabled')
+
+        self.logger.setLevel(logging.INFO)
+        EventLogger(self.logger).debug('attributes', value=_Unprintable())
+        self.assertEqual(self.records, [])
+
+    def test_sampling(self):
+        values = iter([0.1, 0.6, 0.4, 0.9])
+        log = EventLogger(self.logger, sample_rate=0.5, rand=lambda: next(values))
+        for i in range(4):
+            log.debug('event', number=i)
+        self.assertEqual(self.records, ['event number=0', 'event number=2'])
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = 1000
+        self.samples = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _profiler(self, **kwargs):
+        return Profiler(self.directory, sample_rate=0.5, rand=lambda: self.samples.pop(0),
+                        timer=lambda: self.now, **kwargs)
+
+    def test_sampling(self):
+        profiler = self._profiler()
+        self.samples = [0.1, 0.9, 0.2]
+        for i in range(3):
+            self.assertEqual(profiler.call(sum, [i, 1]), i + 1)
+        self.assertEqual(profiler.profiled, 2)
+
+    def test_rotation(self):
+        profiler = self._profiler(interval=60, keep=2)
+        for i in range(3):
+            self.samples = [0.1]
+            profiler.call(sum, [1, 2])
+            self.now += 60
+            self.samples = [0.1]
+            profiler.call(sum, [1, 2])
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(filename.endswith('.prof') for filename in files))
+
+    def test_flush_nothing_profiled(self):
+        self.assertIsNone(self._profiler().flush())
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc requires Python 3.4+')
+    def test_tracemalloc(self):
+        profiler = self._profiler(mode='tracemalloc')
+        self.samples = [0.1]
+        profiler.call(lambda: [str(i) for i in range(1000)])
+        filename = profiler.flush()
+        self.assertTrue(filename.endswith('.tracemalloc.txt'))
+        with open(filename) as fd:
+            self.assertIn('size=', fd.read())
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            Profiler(self.directory, mode='perf')
+
+
+class AttributeFetcherProfilerTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherProfilerTests, self).setUp(celery, get_attribute_manager)
+        self.directory = tempfile.mkdtemp()
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_PROFILE_DIR'] = self.directory
+        am_conf['DASHBOARD_AMP_PROFILE_RATE'] = 1.0
+        self.plugin_context = plugin_init(am_conf)
+
+    def tearDown(self):
+        super(AttributeFetcherProfilerTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_profile(self):
+        user = save_test_user(self.plugin_context.dashboard_userdb)
+        attributes = attribute_fetcher(self.plugin_context, user.user_id)
+        self.assertIn('passwords', attributes['$set'])
+        self.assertEqual(self.plugin_context.profiler.profiled, 1)
+        filename = self.plugin_context.profiler.flush()
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(filename)])
+
+
+class AttributeFetcherOperationsTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherOperationsTests, self).setUp(celery, get_attribute_manager)
+        self.plugin_context = plugin_init(celery.conf)
+        self.central = self.amdb._coll
+        self.central.remove({})
+
+        self.users = save_test_users(self.plugin_context.dashboard_userdb, 3)
+
+    def test_operation(self):
+        user = self.users[0]
+        operation = attribute_fetcher_operation(self.plugin_context, user.user_id)
+        self.assertIsInstance(operation, pymongo.UpdateOne)
+        self.central.bulk_write([operation])
+        self.assertEqual(self.central.find_one({'_id': user.user_id})['displayName'], 'John 1')
+
+    def test_operations(self):
+        missing = bson.ObjectId('0' * 24)
+        user_ids = [user.user_id for user in self.users] + [missing]
+        operations = list(attribute_fetcher_operations(self.plugin_context, user_ids, batch_size=2))
+        self.assertEqual([user_id for user_id, _operation in operations], user_ids)
+        result = apply_operations(self.central, operations)
+        self.assertEqual(result.synced, user_ids[:3])
+        self.assertEqual(list(result.failed.keys()), [missing])
+        self.assertIsInstance(result.failed[missing], UserDoesNotExist)
+        for user in self.users:
+            self.assertEqual(self.central.find_one({'_id': user.user_id})['displayName'], user.display_name)
+
+    def test_write_errors(self):
+        self.central.create_index('displayName', unique=True)
+        self.central.insert_one({'_id': bson.ObjectId(), 'displayName': 'John 2'})
+        operations = attribute_fetcher_operations(self.plugin_context, [user.user_id for user in self.users])
+        result = apply_operations(self.central, operations)
+        self.assertEqual(result.synced, [self.users[0].user_id, self.users[2].user_id])
+        self.assertIsInstance(result.failed[self.users[1].user_id], pymongo.errors.WriteError)
+
+
+class LaneTests(unittest.TestCase):
+
+    def test_slot(self):
+        lane = Lane(BULK, concurrency=2)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def _work():
+            with lane.slot():
+                with lock:
+                    running.append(1)
+                    peak.append(len(running))
+                threading.Event().wait(0.01)
+                with lock:
+                    running.pop()
+
+        threads = [threading.Thread(target=_work) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(peak), 6)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_pool_options(self):
+        am_conf = {
+            'DASHBOARD_AMP_MAX_POOL_SIZE': 50,
+            'DASHBOARD_AMP_BULK_MAX_POOL_SIZE': 5,
+            'DASHBOARD_AMP_BULK_WAIT_QUEUE_TIMEOUT_MS': 100,
+        }
+        self.assertEqual(db.pool_options(am_conf), {'maxPoolSize': 50})
+        self.assertEqual(db.pool_options(am_conf, lane=BULK), {'maxPoolSize': 5, 'waitQueueTimeoutMS': 100})
+
+
+class AttributeFetcherLaneTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherLaneTests, self).setUp(celery, get_attribute_manager)
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_BULK_CONCURRENCY'] = 1
+        self.plugin_context = plugin_init(am_conf)
+        self.registry = self.plugin_context.metrics.registry
+
+        self.user = save_test_user(self.plugin_context.dashboard_userdb)
+
+    def test_separate_clients(self):
+        bulk_context = self.plugin_context.for_lane(BULK)
+        self.assertIs(bulk_context.for_lane(BULK), bulk_context)
+        self.assertIs(bulk_context.metrics, self.plugin_context.metrics)
+        self.assertIsNot(bulk_context.dashboard_userdb, self.plugin_context.dashboard_userdb)
+        self.assertEqual(self.plugin_context.lane.name, INTERACTIVE)
+        self.assertEqual(bulk_context.lanes[BULK].concurrency, 1)
+
+    def test_lanes(self):
+        attributes = attribute_fetcher(self.plugin_context, self.user.user_id)
+        self.assertEqual(attribute_fetcher_bulk(self.plugin_context, self.user.user_id), attributes)
+        self.assertEqual(dict(attribute_fetcher_many(self.plugin_context, [self.user.user_id])),
+                         {self.user.user_id: attributes})
+        self.assertEqual(self.registry.histogram('fetch_seconds', lane=INTERACTIVE)[0], 1)
+        self.assertEqual(self.registry.histogram('fetch_seconds', lane=BULK)[0], 2)
+
+    def test_interactive_not_blocked_by_bulk(self):
+        with self.plugin_context.lanes[BULK].slot():
+            # The only bulk slot is taken, interactive syncs must still work
+            self.assertIn('$set', attribute_fetcher(self.plugin_context, self.user.user_id))
+
+
+class ReadPreferenceTests(unittest.TestCase):
+
+    def test_read_preference(self):
+        self.assertEqual(db.read_preference('primary').mongos_mode, 'primary')
+        read_pref = db.read_preference('secondaryPreferred', 120)
+        self.assertEqual(read_pref.mongos_mode, 'secondaryPreferred')
+        self.assertEqual(read_pref.max_staleness, 120)
+        with self.assertRaises(ValueError):
+            db.read_preference('secondary_preferred')
+
+
+class AttributeFetcherSecondaryTests(MongoTestCase):
+
+    def setUp(self):
+        super(AttributeFetcherSecondaryTests, self).setUp(celery, get_attribute_manager)
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_READ_PREFERENCE'] = 'secondaryPreferred'
+        self.plugin_context = plugin_init(am_conf)
+        self.registry = self.plugin_context.metrics.registry
+
+        self.user = save_test_user(self.plugin_context.dashboard_userdb)
+        self.modified_ts = self.plugin_context.dashboard_userdb._coll.find_one(
+            {'_id': self.user.user_id})['modified_ts']
+
+    def test_secondary_read(self):
+        self.assertIn('$set', attribute_fetcher(self.plugin_context, self.user.user_id,
+                                                min_modified_ts=self.modified_ts))
+        self.assertEqual(self.registry.counter('primary_fallbacks_total'), 0)
+
+    def test_stale_read(self):
+        min_modified_ts = self.modified_ts + timedelta(seconds=1)
+        self.assertIn('$set', attribute_fetcher(self.plugin_context, self.user.user_id,
+                                                min_modified_ts=min_modified_ts))
+        self.assertEqual(self.registry.counter('primary_fallbacks_total'), 1)
+
+    def test_missing_user(self):
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.plugin_context, bson.ObjectId('0' * 24), min_modified_ts=self.modified_ts)
+        self.assertEqual(self.registry.counter('primary_fallbacks_total'), 1)
+
+    def test_primary_without_freshness(self):
+        # Nothing to check a secondary's data against, so the primary is read at once
+        self.plugin_context.dashboard_userdb._coll.update_one({'_id': self.user.user_id},
+                                                              {'$set': {'displayName': 'John'}})
+        attributes = attribute_fetcher(self.plugin_context, self.user.user_id)
+        self.assertEqual(attributes['$set']['displayName'], 'John')
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.plugin_context, bson.ObjectId('0' * 24))
+        self.assertEqual(self.registry.counter('primary_fallbacks_total'), 0)
+
+    def test_causal_token(self):
+        collection = self.plugin_context.dashboard_userdb._coll
+        with collection.database.client.start_session(causal_consistency=True) as session:
+            collection.update_one({'_id': self.user.user_id}, {'$set': {'displayName': 'John'}}, session=session)
+            token = db.causal_token(session)
+        attributes = attribute_fetcher(self.plugin_context, self.user.user_id, causal_token=token)
+        self.assertEqual(attributes['$set']['displayName'], 'John')
+
+    def test_projection_reads(self):
+        self.plugin_context.projection_reads = True
+        self.test_secondary_read()
+
+    def test_created_after_missing(self):
+        user = DashboardUser(data={
+            'eduPersonPrincipalName': 'test-new',
+            'passwords': [{'id': bson.ObjectId('2' * 24), 'salt': '456'}],
+        })
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.plugin_context, user.user_id)
+        self.plugin_context.dashboard_userdb.save(user)
+        modified_ts = self.plugin_context.dashboard_userdb._coll.find_one({'_id': user.user_id})['modified_ts']
+        self.assertIn('$set', attribute_fetcher(self.plugin_context, user.user_id, min_modified_ts=modified_ts))
+
+
+class ShardRouterTests(unittest.TestCase):
+
+    def test_hash_router(self):
+        router = HashRouter(3)
+        user_ids = [bson.ObjectId() for _ in range(30)]
+        shards = [router.shard(user_id) for user_id in user_ids]
+        self.assertEqual(shards, [HashRouter(3).shard(str(user_id)) for user_id in user_ids])
+        self.assertTrue(all(0 <= shard < 3 for shard in shards))
+
+    def test_range_router(self):
+        router = RangeRouter(['5' * 24, 'a' * 24])
+        self.assertEqual(router.count, 3)
+        self.assertEqual(router.shard(bson.ObjectId('1' * 24)), 0)
+        self.assertEqual(router.shard(bson.ObjectId('5' * 24)), 1)
+        self.assertEqual(router.shard('9' * 24), 1)
+        self.assertEqual(router.shard(bson.ObjectId('f' * 24)), 2)
+        self.assertEqual(router.shard('not an object id'), 0)
+        with self.assertRaises(ValueError):
+            RangeRouter(['a' * 24, '5' * 24])
+
+
+class ShardedContextTests(MongoTestCase):
+
+    def setUp(self):
+        super(ShardedContextTests, self).setUp(celery, get_attribute_manager)
+        # Two shards, both in the test database, spelled differently to get separate clients
+        self.shard_uris = [celery.conf['MONGO_URI'], celery.conf['MONGO_URI'].replace('localhost', '127.0.0.1')]
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_SHARD_URIS'] = self.shard_uris
+        self.plugin_context = plugin_init(am_conf)
+
+        self.users = save_test_users(self.plugin_context.dashboard_userdb, 4)
+
+    def test_shards(self):
+        shards = self.plugin_context.shards
+        self.assertEqual([shard.dashboard_uri for shard in shards], self.shard_uris)
+        self.assertIs(shards[1].metrics, self.plugin_context.metrics)
+        self.assertIs(shards[1].for_shard(1), shards[1])
+
+    def test_attribute_fetcher(self):
+        unsharded_context = plugin_init(celery.conf)
+        for user in self.users:
+            self.assertEqual(attribute_fetcher(self.plugin_context, user.user_id),
+                             attribute_fetcher(unsharded_context, user.user_id))
+        missing = bson.ObjectId('0' * 24)
+        user_ids = [user.user_id for user in self.users] + [missing]
+        results = list(attribute_fetcher_many(self.plugin_context, user_ids, raise_on_error=False))
+        self.assertEqual([user_id for user_id, _result in results], user_ids)
+        self.assertIsInstance(results[-1][1], UserDoesNotExist)
+
+    def test_merged_reads(self):
+        # Both shards have all users, so every user is read twice, in order
+        docs = list(_find_documents(self.plugin_context, {}, sort=[('_id', pymongo.ASCENDING)], limit=5))
+        user_ids = sorted(user.user_id for user in self.users)
+        self.assertEqual([doc['_id'] for doc in docs], [user_ids[0], user_ids[0], user_ids[1], user_ids[1],
+                                                         user_ids[2]])
+
+    def test_cached_routed(self):
+        # All users are in the first shard, the second one is down
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_SHARD_URIS'] = [self.shard_uris[0], 'mongodb://127.0.0.1:1/']
+        am_conf['DASHBOARD_AMP_SHARD_ROUTER'] = 'range'
+        am_conf['DASHBOARD_AMP_SHARD_BOUNDARIES'] = ['f' * 24]
+        am_conf['DASHBOARD_AMP_SERVER_SELECTION_TIMEOUT_MS'] = 50
+        context = plugin_init(am_conf)
+        user = self.users[0]
+        self.assertEqual(attribute_fetcher_cached(context, user.user_id),
+                         attribute_fetcher(self.plugin_context, user.user_id))
+
+    def test_sync_engine_per_shard(self):
+        with self.assertRaises(ValueError):
+            SyncEngine(self.plugin_context)
+        SyncEngine(self.plugin_context.for_shard(0), name='shard0')
+
+
+class DeadlineTests(MongoTestCase):
+
+    def setUp(self):
+        super(DeadlineTests, self).setUp(celery, get_attribute_manager)
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_DEADLINE_MS'] = 2000
+        self.plugin_context = plugin_init(am_conf)
+
+        self.user = save_test_user(self.plugin_context.dashboard_userdb)
+
+    def test_client_timeouts(self):
+        options = self.plugin_context.dashboard_db_options
+        self.assertEqual(options['serverSelectionTimeoutMS'], 2000)
+        self.assertNotIn('socketTimeoutMS', options)
+        self.assertNotIn('serverSelectionTimeoutMS', self.plugin_context.for_lane(BULK).dashboard_db_options)
+        self.assertNotIn('serverSelectionTimeoutMS', self.plugin_context.db_options)
+        self.assertEqual(self.plugin_context.with_deadline(10).dashboard_db_options, options)
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_DEADLINE_MS'] = 2000
+        am_conf['DASHBOARD_AMP_SERVER_SELECTION_TIMEOUT_MS'] = 10000
+        self.assertEqual(plugin_init(am_conf).dashboard_db_options['serverSelectionTimeoutMS'], 10000)
+
+    def test_with_deadline(self):
+        context = self.plugin_context.with_deadline(10)
+        self.assertEqual(context.deadline_ms, 10)
+        self.assertEqual(self.plugin_context.deadline_ms, 2000)
+        self.assertIs(context.with_deadline(10), context)
+
+    def test_fetch_within_deadline(self):
+        self.assertIn('$set', attribute_fetcher(self.plugin_context, self.user.user_id, deadline_ms=1000))
+
+    def test_server_side_time_limit(self):
+        with self.assertRaises(pymongo.errors.ExecutionTimeout):
+            list(_find_documents(self.plugin_context, {'$where': 'sleep(100) || true'}, max_time_ms=1))
+
+    def test_scans_not_limited(self):
+        am_conf = dict(celery.conf)
+        am_conf['DASHBOARD_AMP_DEADLINE_MS'] = 200
+        context = plugin_init(am_conf)
+        # The scan takes longer than the deadline, on the same client as the reads by id
+        self.assertEqual(len(list(_find_documents(context, {'$where': 'sleep(500) || true'}))), 1)
+        context.dashboard_userdb._coll.update_one({'_id': self.user.user_id},
+                                                  {'$set': {'displayName': 'John'}})
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.changes = []
+        self.breaker = CircuitBreaker('test', threshold=2, reset_timeout=10, timer=lambda: self.now,
+                                      on_change=lambda breaker: self.changes.append(breaker.state))
+
+    def _fail(self):
+        with self.assertRaises(pymongo.errors.AutoReconnect):
+            with self.breaker.guard():
+                raise pymongo.errors.AutoReconnect('down')
+
+    def _succeed(self):
+        with self.breaker.guard():
+            pass
+
+    def test_trip_and_recover(self):
+        self._fail()
+        self._succeed()
+        self._fail()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self._fail()
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpen):
+            self._succeed()
+
+        self.now += 10
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        with self.breaker.guard():
+            # Only one trial read at a time
+            with self.assertRaises(CircuitOpen):
+                self._succeed()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.changes, [OPEN, HALF_OPEN, CLOSED])
+
+    def test_failed_trial(self):
+        self._fail()
+        self._fail()
+        self.now += 10
+        self._fail()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.now += 9
+        with self.assertRaises(CircuitOpen):
+            self._succeed()
+
+    def test_other_errors(self):
+        for _ in range(3):
+            with self.assertRaises(pymongo.errors.OperationFailure):
+                with self.breaker.guard():
+                    raise pymongo.errors.OperationFailure('bad query')
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_pool_wait_timeouts(self):
+        self._fail()
+        with self.assertRaises(pymongo.errors.ConnectionFailure):
+            with self.breaker.guard():
+                # What pymongo 3 raises when no connection becomes free in time
+                raise pymongo.errors.ConnectionFailure(
+                    'Timed out while checking out a connection from connection pool '
+                    'with max_size 1 and wait_queue_timeout 0.1')
+        self.assertEqual(self.breaker.failures, 1)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_disabled(self):
+        breaker = CircuitBreaker('test', threshold=0)
+        for _ in range(10):
+            with self.assertRaises(pymongo.errors.AutoReconnect):
+                with breaker.guard():
+                    raise pymongo.errors.AutoReconnect('down')
+        self.assertEqual(breaker.state, CLOSED)
+
+
+class AttributeFetcherBreakerTests(unittest.TestCase):
+
+    def test_database_down(self):
+        context = plugin_init({
+            'MONGO_URI': 'mongodb://127.0.0.1:1/',
+            'DASHBOARD_AMP_SERVER_SELECTION_TIMEOUT_MS': 50,
+            'DASHBOARD_AMP_BREAKER_THRESHOLD': 2,
+        })
+        user_id = bson.ObjectId()
+        for _ in range(2):
+            with self.assertRaises(AttributeFetcherTimeout):
+                attribute_fetcher(context, user_id)
+        with self.assertRaises(CircuitOpen):
+            attribute_fetcher(context, user_id)
+        registry = context.metrics.registry
+        self.assertEqual(registry.gauge_value('circuit_open', circuit='dashboard', lane=INTERACTIVE), 1)
+        self.assertEqual(registry.counter('errors_total', type='CircuitOpen'), 1)
+        self.assertIn('eduid_dashboard_amp_circuit_open{circuit="dashboard",lane="interactive"} 1\n',
+                      registry.prometheus_text())
+        # The bulk lane has a circuit of its own
+        self.assertEqual(context.for_lane(BULK).breaker.state, CLOSED)
+
+    def test_cached_fetcher(self):
+        context = plugin_init({
+            'MONGO_URI': 'mongodb://127.0.0.1:1/',
+            'DASHBOARD_AMP_SERVER_SELECTION_TIMEOUT_MS': 50,
+            'DASHBOARD_AMP_BREAKER_THRESHOLD': 1,
+            'DASHBOARD_AMP_FINGERPRINT_COLLECTION': '',
+        })
+        user_id = bson.ObjectId()
+        with self.assertRaises(AttributeFetcherTimeout):
+            attribute_fetcher_cached(context, user_id)
+        with self.assertRaises(CircuitOpen):
+            attribute_fetcher_cached(context, user_id)
@@ -21,6 +21,10 @@ testing_extras = [
     'freezegun==0.3.10'
 ]
 
+async_extras = [
+    'motor >= 1.2',
+]
+
 
 setup(name='eduid-dashboard-amp',
       version=version,
@@ -40,6 +44,7 @@ setup(name='eduid-dashboard-amp',
       install_requires=requires,
       extras_require={
         'testing': testing_extras,
+        'async': async_extras,
         },
       test_suite='eduid_dashboard_amp',
       entry_points="""
@@ -48,5 +53,12 @@ setup(name='eduid-dashboard-amp',
 
       [eduid_am.plugin_init]
       eduid_dashboard = eduid_dashboard_amp:plugin_init
+
+      [console_scripts]
+      eduid-dashboard-amp-sync = eduid_dashboard_amp.sync:main
+      eduid-dashboard-amp-resync = eduid_dashboard_amp.resync:main
+      eduid-dashboard-amp-report = eduid_dashboard_amp.report:main
+      eduid-dashboard-amp-benchmark = eduid_dashboard_amp.benchmark:main
+      eduid-dashboard-amp-indexes = eduid_dashboard_amp.indexes:main
       """,
       )